@@ -0,0 +1,180 @@
+"""
+asyncio orchestration of the independent ffmpeg/ffprobe runs inside a job.
+
+Sub-steps that do not feed each other (the clips of a sentence mix, probes
+of several files, asset conversions) are started with
+asyncio.create_subprocess_exec, at most `limit` at a time. Each run gets
+what utils.run_command gives a command: the thread budget, -progress
+parsing for the tracer, registration on the job's CancelToken (so
+YTPEngine cancellation kills it) and a scratch measurement afterwards.
+stderr is captured and its tail printed when a command fails. When one run
+raises (JobCancelled, a quota, a cancelled task) the others are killed.
+
+The event loop lives only for the duration of run_sync() on the calling
+thread, so thread-local job state (token, tracer, scratch) applies as is
+and every synchronous API, YTPEngine.generate included, stays synchronous.
+generate() is the coroutine form for callers that already run a loop.
+
+Python 3.8+ only (subprocesses from loops on any thread); utils.run_many
+runs commands one at a time elsewhere.
+"""
+from __future__ import print_function, unicode_literals
+import asyncio
+import os
+import sys
+
+import tracing
+from utils import (JobCancelled, CancelToken, cancel_token, set_cancel_token, check_cancelled, scratch,
+                   with_thread_budget)
+
+SUPPORTED = sys.version_info >= (3, 8)
+DEFAULT_LIMIT = os.cpu_count() or 4
+# lines of stderr printed for a failed command
+STDERR_TAIL = 20
+
+
+class _Handle(object):
+    """What CancelToken needs of a process (poll/kill), for an asyncio one;
+    kill may come from another thread."""
+
+    def __init__(self, proc, loop):
+        self.proc = proc
+        self.loop = loop
+
+    def poll(self):
+        return self.proc.returncode
+
+    def kill(self):
+        try:
+            self.loop.call_soon_threadsafe(self._kill)
+        except RuntimeError:
+            # loop already closed: the process is gone
+            pass
+
+    def _kill(self):
+        if self.proc.returncode is None:
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                pass
+
+
+class _NoLimit(object):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+async def run(cmd, sem=None, capture=False):
+    """Run cmd like utils.run_command. Returns (ok, stdout, stderr); stdout
+    is only kept with capture (ffmpeg's own -progress output never is)."""
+    token = cancel_token()
+    cmd = tracing.with_progress(with_thread_budget(cmd))
+    progress = tracing.has_progress(cmd)
+    async with (sem or _NoLimit()):
+        check_cancelled()
+        print("Running:", " ".join(cmd))
+        timer = tracing.CommandTimer([cmd])
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE if progress or capture else None,
+                stderr=asyncio.subprocess.PIPE)
+        except OSError as e:
+            print("Command failed:", e)
+            timer.finish(False)
+            return False, b'', str(e).encode('utf-8')
+        handle = _Handle(proc, asyncio.get_running_loop())
+        if token is not None:
+            token.track(handle)
+        reader = tracing.ProgressReader() if progress else None
+        out = []
+
+        async def read_stdout():
+            if proc.stdout is None:
+                return
+            async for line in proc.stdout:
+                if reader is not None:
+                    reader.feed(line)
+                else:
+                    out.append(line)
+
+        try:
+            _, err = await asyncio.gather(read_stdout(), proc.stderr.read())
+            await proc.wait()
+        except BaseException:
+            handle._kill()
+            await proc.wait()
+            raise
+        finally:
+            if token is not None:
+                token.untrack(handle)
+        ok = proc.returncode == 0
+        timer.finish(ok, reader.stats() if reader is not None else {})
+        if not ok and not (token is not None and token.cancelled):
+            tail = err.decode('utf-8', errors='ignore').strip().splitlines()[-STDERR_TAIL:]
+            print("Command failed (exit %s): %s\n  %s" % (proc.returncode, " ".join(cmd), "\n  ".join(tail)))
+    check_cancelled()
+    if scratch() is not None:
+        scratch().measure()
+    return ok, b''.join(out), err
+
+
+async def gather(coros):
+    """Await coros together; if one raises, cancel the rest (killing their
+    processes) and re-raise once they are gone."""
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def run_all(cmds, limit=None, capture=False):
+    """run() every cmd, at most limit at once. [(ok, stdout, stderr)] in
+    cmd order."""
+    sem = asyncio.Semaphore(limit or DEFAULT_LIMIT)
+    return await gather([run(c, sem, capture) for c in cmds])
+
+
+def run_sync(coro):
+    """Run coro to completion on a private loop on this thread."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def generate(engine, input_video, output_path, options, progress=None, events=None):
+    """Coroutine form of engine.generate: the job renders on a worker thread
+    and cancelling the awaiting task cancels the job (its ffmpeg children
+    are killed and its temp files deleted) before CancelledError is
+    raised here."""
+    token = CancelToken()
+    loop = asyncio.get_running_loop()
+
+    def work():
+        set_cancel_token(token)
+        try:
+            return engine.generate(input_video, output_path, options, progress, events)
+        except JobCancelled:
+            token.cleanup()
+            raise
+        finally:
+            set_cancel_token(None)
+
+    job = loop.run_in_executor(None, work)
+    try:
+        return await asyncio.shield(job)
+    except asyncio.CancelledError:
+        token.cancel()
+        try:
+            await job
+        except JobCancelled:
+            pass
+        raise
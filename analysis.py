@@ -0,0 +1,232 @@
+"""
+Per-input analysis for placing cuts: where speech pauses, where shots change
+and how loud each moment is.
+
+One ffmpeg pass runs silencedetect and ebur128 on the audio and scene-change
+scoring on a small copy of the video. The result is kept in
+<work_dir>/analysis/<content sha1>.json.
+
+marks() turns it into cut boundaries: speech onsets (the end of a pause, or
+a jump in loudness where nothing pauses) and scene cuts. snap() moves a
+drawn cut time to the nearest boundary, and follow() carries the boundaries
+through effects that move time, so steps later in the chain snap too.
+"""
+from __future__ import print_function, unicode_literals
+import bisect
+import json
+import os
+import threading
+
+import stagecache
+from utils import run_command, safe_tempfile, rm_f, replace_file
+
+ANALYSIS_VERSION = 1
+# effects whose cut points are snapped
+SNAPPED = ('sentence_mix', 'stutter')
+# a cut moves at most this far (seconds) to reach a boundary
+SNAP_REACH = 1.0
+SILENCE_DB = -35
+SILENCE_MIN = 0.25
+SCENE_SCORE = 0.3
+# loudness is measured in frames of this length (seconds)
+LOUDNESS_STEP = 0.4
+# rise (LU) from one frame to the next that counts as an onset
+ONSET_RISE = 6.0
+# effects that leave every timestamp where it was
+TIME_KEEPING = ('earrape', 'chorus', 'vibrato', 'invert', 'mirror', 'dance', 'rainbow', 'explosion',
+                'frame_shuffle', 'meme', 'random_sound', 'mode_2009', 'mode_2012')
+
+
+def wanted(options):
+    """True when options may plan a step whose cuts are snapped."""
+    if not options.get('snap_cuts', True):
+        return False
+    return any(isinstance(options.get(n), dict) and options[n].get('enabled') for n in SNAPPED)
+
+
+def _filter_path(path):
+    # option-level escape inside a graph-level quote; ':' is the only
+    # separator a path can hold (C:/...)
+    return "'%s'" % path.replace('\\', '/').replace("'", "'\\''").replace(':', '\\:')
+
+
+def parse_metadata(text):
+    """[(pts_time, {key: value})] from the output of the (a)metadata
+    filter's print mode."""
+    frames = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('frame:'):
+            t = None
+            for part in line.split():
+                if part.startswith('pts_time:'):
+                    try:
+                        t = float(part[9:])
+                    except ValueError:
+                        pass
+            frames.append((t, {}))
+        elif '=' in line and frames:
+            k, v = line.split('=', 1)
+            frames[-1][1][k] = v
+    return frames
+
+
+def _float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def summarize(audio_frames, video_frames, duration=None):
+    """The analysis record: silences [[start, end]], scene cut times,
+    momentary loudness [[time, LUFS]] and the integrated loudness."""
+    silences, loudness, start, integrated = [], [], None, None
+    for t, meta in audio_frames:
+        if 'lavfi.silence_start' in meta:
+            start = _float(meta['lavfi.silence_start'])
+        if 'lavfi.silence_end' in meta and start is not None:
+            end = _float(meta['lavfi.silence_end'])
+            if end is not None:
+                silences.append([round(start, 3), round(end, 3)])
+            start = None
+        m = _float(meta.get('lavfi.r128.M'))
+        if t is not None and m is not None:
+            loudness.append([round(t, 3), round(m, 1)])
+        integrated = _float(meta.get('lavfi.r128.I', integrated))
+    if start is not None and duration:
+        silences.append([round(start, 3), round(duration, 3)])
+    scenes = [round(t, 3) for t, meta in video_frames if t is not None and 'lavfi.scene_score' in meta]
+    return {'version': ANALYSIS_VERSION, 'duration': duration, 'silences': silences, 'scenes': scenes,
+            'loudness': loudness, 'integrated': integrated}
+
+
+def onsets(result):
+    """Speech onsets: pause ends, plus loudness jumps out of quiet frames
+    (so speech over music, which never pauses, still has some)."""
+    out = [e for s, e in result.get('silences', []) if not result.get('duration') or e < result['duration']]
+    floor = (result.get('integrated') or -23.0) - 10.0
+    prev = None
+    for t, m in result.get('loudness', []):
+        if prev is not None and m - prev >= ONSET_RISE and m >= floor:
+            out.append(t)
+        prev = m
+    return out
+
+
+def marks(result):
+    """Sorted cut boundaries of an analysis record."""
+    return sorted(set(onsets(result) + result.get('scenes', [])))
+
+
+def snap(t, marks, lo=0.0, hi=None, reach=SNAP_REACH):
+    """The boundary in [lo, hi] nearest to t, if one is within reach."""
+    if not marks:
+        return t
+    i = bisect.bisect_left(marks, t)
+    best = t
+    for m in marks[max(0, i - 1):i + 1]:
+        if m < lo or (hi is not None and m > hi) or abs(m - t) > reach:
+            continue
+        if best == t or abs(m - t) < abs(best - t):
+            best = m
+    return best
+
+
+def follow(marks, name, params, info):
+    """marks on the timeline after effect name runs on a file described by
+    info, or None where the effect rebuilds the timeline."""
+    if marks is None:
+        return None
+    if name in TIME_KEEPING:
+        return marks
+    if name in ('speed', 'sus'):
+        total = 1.0
+        for f in ([params.get('level', 1.0)] if name == 'speed' else params.get('factors', [])):
+            total *= float(f)
+        return [t / total for t in marks] if total > 0 else None
+    if name == 'reverse' and (info or {}).get('duration'):
+        return sorted(info['duration'] - t for t in marks)
+    return None
+
+
+class AnalysisCache(object):
+    """Analysis records by content digest, one JSON file each."""
+
+    def __init__(self, root, ffmpeg, prober=None):
+        self.root = root
+        self.ffmpeg = ffmpeg
+        self.prober = prober
+        # digests whose pass failed in this process, not retried
+        self.failed = set()
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest + '.json')
+
+    def get(self, path):
+        """The analysis record of path, from the cache or a new pass. None
+        when the pass fails."""
+        digest = stagecache.file_digest(path)
+        try:
+            with open(self._path(digest), 'r') as f:
+                result = json.load(f)
+            if result.get('version') == ANALYSIS_VERSION:
+                return result
+        except (IOError, OSError, ValueError):
+            pass
+        if digest in self.failed:
+            return None
+        result = self._analyze(path)
+        if result is None:
+            self.failed.add(digest)
+            return None
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        # server jobs may analyze the same input at once
+        tmp = '%s.%d.%d.tmp' % (self._path(digest), os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(result, f)
+            replace_file(tmp, self._path(digest))
+        except (IOError, OSError):
+            rm_f(tmp)
+        return result
+
+    def marks(self, path):
+        """Cut boundaries of path, or None when it cannot be analyzed."""
+        result = self.get(path)
+        return marks(result) if result is not None else None
+
+    def _analyze(self, path):
+        info = self.prober.probe(path) if self.prober is not None else {}
+        has_audio, has_video = info.get('has_audio', True), info.get('has_video', True)
+        if not (has_audio or has_video):
+            return None
+        afile, vfile = safe_tempfile('.txt'), safe_tempfile('.txt')
+        graph, maps = [], []
+        if has_audio:
+            samples = int((info.get('sample_rate') or 48000) * LOUDNESS_STEP)
+            graph.append('[0:a]asetnsamples=n=%d:p=0,silencedetect=n=%ddB:d=%s,ebur128=metadata=1:framelog=quiet,'
+                         'ametadata=mode=print:file=%s[a]' % (samples, SILENCE_DB, SILENCE_MIN, _filter_path(afile)))
+            maps += ['-map', '[a]']
+        if has_video:
+            graph.append("[0:v]scale=160:-2,select='gt(scene,%s)',metadata=mode=print:file=%s[v]"
+                         % (SCENE_SCORE, _filter_path(vfile)))
+            maps += ['-map', '[v]']
+        try:
+            print("Analysis: %s" % path)
+            if not run_command([self.ffmpeg, '-y', '-i', path, '-filter_complex', ';'.join(graph)]
+                               + maps + ['-f', 'null', '-']):
+                print("Analysis failed: %s" % path)
+                return None
+            texts = []
+            for p in (afile, vfile):
+                try:
+                    with open(p, 'r') as f:
+                        texts.append(f.read())
+                except (IOError, OSError):
+                    texts.append('')
+            return summarize(parse_metadata(texts[0]), parse_metadata(texts[1]), info.get('duration'))
+        finally:
+            rm_f(afile)
+            rm_f(vfile)
@@ -0,0 +1,246 @@
+"""
+Persistent index of the assets folder, plus render-ready asset variants.
+
+The index (asset_index.json in the work dir) lists every file under the
+assets folder with its size, mtime and probed metadata: dimensions,
+duration, alpha and, for sounds, sample rate and channels. refresh() only
+re-lists directories whose mtime changed and only forgets the metadata of
+files whose size or mtime changed.
+
+Variants are assets converted once for the way a render uses them:
+overlays scaled (proxy renders) and turned into RGBA with their opacity
+already applied, animated images decoded into FFV1, sounds resampled to the
+video's rate as PCM WAV, named by the source file's identity and the
+conversion. Deleting the variants directory is always safe. prefetch() and
+make() let a caller probe and convert several assets at once.
+"""
+from __future__ import print_function, unicode_literals
+import hashlib
+import json
+import os
+import threading
+
+from filtergraph import STILL_IMAGE_EXTS
+from utils import run_command, run_many, rm_f, replace_file
+
+INDEX_VERSION = 1
+INFO_KEYS = ('width', 'height', 'duration', 'alpha', 'sample_rate', 'channels', 'has_video', 'has_audio')
+
+
+def has_alpha(pix_fmt):
+    """True for pixel formats with an alpha channel (pal8 may carry GIF
+    transparency)."""
+    if not pix_fmt:
+        return False
+    return pix_fmt == 'pal8' or pix_fmt.startswith(('rgba', 'bgra', 'argb', 'abgr', 'ya', 'yuva', 'gbrap'))
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+        return st.st_size, int(st.st_mtime * 1000)
+    except OSError:
+        return None
+
+
+def _publish(part, dst):
+    """Move a finished variant into place. True when dst is there after,
+    which includes another worker having made it first."""
+    try:
+        replace_file(part, dst)
+    except OSError:
+        rm_f(part)
+    return os.path.exists(dst)
+
+
+class AssetIndex(object):
+    def __init__(self, root, index_path=None, prober=None, ffmpeg=None, variant_dir=None):
+        self.root = root
+        self.index_path = index_path
+        self.prober = prober
+        self.ffmpeg = ffmpeg
+        self.variant_dir = variant_dir
+        # dir (relative to root) -> [mtime, subdirs, files]
+        self.dirs = {}
+        # asset path -> {'size', 'mtime', 'info'}; info is None until probed
+        self.files = {}
+        self.dirty = False
+        # variants whose conversion failed in this process, not retried
+        self.failed = set()
+        self._load()
+        self.refresh()
+
+    def _load(self):
+        if not self.index_path:
+            return
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('version') == INDEX_VERSION and data.get('root') == self.root:
+            self.dirs = data.get('dirs', {})
+            self.files = data.get('files', {})
+
+    def save(self):
+        if not self.index_path or not self.dirty:
+            return
+        # pool workers and server threads may write it at once
+        tmp = '%s.%d.%d.tmp' % (self.index_path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': INDEX_VERSION, 'root': self.root, 'dirs': self.dirs, 'files': self.files}, f)
+            replace_file(tmp, self.index_path)
+            self.dirty = False
+        except (IOError, OSError):
+            rm_f(tmp)
+
+    def refresh(self):
+        """Bring the index up to date with the assets folder."""
+        if not self.root or not os.path.isdir(self.root):
+            self.dirty = self.dirty or bool(self.files)
+            self.dirs, self.files = {}, {}
+            self.save()
+            return
+        dirs, files = {}, {}
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            path = os.path.join(self.root, rel) if rel else self.root
+            st = _stat(path)
+            if st is None:
+                continue
+            known = self.dirs.get(rel)
+            if known and known[0] == st[1]:
+                subdirs, names = known[1], known[2]
+            else:
+                subdirs, names = [], []
+                try:
+                    for fn in sorted(os.listdir(path)):
+                        (subdirs if os.path.isdir(os.path.join(path, fn)) else names).append(fn)
+                except OSError:
+                    continue
+                self.dirty = True
+            dirs[rel] = [st[1], subdirs, names]
+            pending.extend(os.path.join(rel, d) if rel else d for d in subdirs)
+            for fn in names:
+                p = os.path.join(path, fn)
+                fst = _stat(p)
+                if fst is None:
+                    continue
+                entry = self.files.get(p)
+                if not entry or (entry['size'], entry['mtime']) != fst:
+                    entry = {'size': fst[0], 'mtime': fst[1], 'info': None}
+                    self.dirty = True
+                files[p] = entry
+        if set(files) != set(self.files):
+            self.dirty = True
+        self.dirs, self.files = dirs, files
+        self.save()
+
+    def by_ext(self):
+        """{extension: [paths]} of every indexed asset, sorted."""
+        out = {}
+        for p in sorted(self.files):
+            out.setdefault(os.path.splitext(p)[1].lower(), []).append(p)
+        return out
+
+    def info(self, path):
+        """Metadata of path (INFO_KEYS). Indexed assets are probed once and
+        the result kept in the index; other files are probed every time."""
+        entry = self.files.get(path)
+        if entry is not None and entry['info'] is not None:
+            return dict(entry['info'])
+        info = {}
+        if self.prober is not None:
+            full = self.prober.probe(path, full=True)
+            info = dict((k, full.get(k)) for k in INFO_KEYS if k != 'alpha')
+            info['alpha'] = has_alpha(full.get('pix_fmt'))
+        if entry is not None and self.prober is not None:
+            entry['info'] = info
+            self.dirty = True
+            self.save()
+        return dict(info)
+
+    def prefetch(self, paths):
+        """Probe every path whose metadata is not known yet, all at once
+        (ProbeCache.probe_many), so info() finds them probed."""
+        todo = sorted(set(p for p in paths if p and (p not in self.files or self.files[p]['info'] is None)))
+        if self.prober is None or not todo:
+            return
+        self.prober.probe_many(todo, full=True)
+        for p in todo:
+            self.info(p)
+
+    # ---------------- Variants ----------------
+    def _variant(self, path, spec, ext, args, pending=None):
+        """Path of the variant of path described by spec, made with ffmpeg
+        args (input and output excluded) on first use. path itself when
+        the conversion fails. With pending (a dict), a missing variant is
+        not made but added to it for make(), and its future path returned."""
+        st = _stat(path)
+        if st is None or not self.ffmpeg or not self.variant_dir:
+            return path
+        blob = json.dumps({'src': os.path.abspath(path), 'stat': list(st), 'spec': spec}, sort_keys=True)
+        dst = os.path.join(self.variant_dir, hashlib.sha1(blob.encode('utf-8')).hexdigest() + ext)
+        if os.path.exists(dst):
+            return dst
+        if dst in self.failed:
+            return path
+        if not os.path.isdir(self.variant_dir):
+            os.makedirs(self.variant_dir)
+        part = '%s.%d.%d.part%s' % (dst, os.getpid(), threading.current_thread().ident, ext)
+        cmd = [self.ffmpeg, '-y', '-i', path] + args + [part]
+        if pending is not None:
+            pending[dst] = (cmd, part)
+            return dst
+        if not run_command(cmd) or not _publish(part, dst):
+            rm_f(part)
+            self.failed.add(dst)
+            return path
+        return dst
+
+    def make(self, pending):
+        """Run the conversions overlay()/sound() left in pending at once
+        (utils.run_many); the calls made again afterwards find them."""
+        jobs = sorted(pending.items())
+        for (dst, (cmd, part)), (ok, _, _) in zip(jobs, run_many([cmd for _, (cmd, _) in jobs])):
+            if not (ok and _publish(part, dst)):
+                rm_f(part)
+                self.failed.add(dst)
+        pending.clear()
+
+    def overlay(self, path, scale=1.0, opacity=1.0, pending=None):
+        """path ready to overlay: scaled by scale and converted to RGBA with
+        opacity multiplied into the alpha. Animated images are decoded once
+        into FFV1. An opaque still that needs neither is returned as is.
+        pending: see _variant."""
+        ext = os.path.splitext(path)[1].lower()
+        info = self.info(path)
+        # anything but a known still image format may have several frames
+        animated = ext not in STILL_IMAGE_EXTS and (info.get('duration') or 0) > 0.1
+        scale, opacity = round(float(scale), 4), round(float(opacity), 3)
+        if scale == 1.0 and opacity >= 0.99 and ext in STILL_IMAGE_EXTS:
+            return path
+        vf = []
+        if scale != 1.0:
+            vf.append('scale=iw*%s:ih*%s' % (scale, scale))
+        vf.append('format=rgba')
+        if opacity < 0.99:
+            vf.append('colorchannelmixer=aa=%s' % opacity)
+        spec = {'kind': 'overlay', 'scale': scale, 'opacity': opacity, 'animated': animated}
+        if animated:
+            return self._variant(path, spec, '.mkv', ['-an', '-vf', ','.join(vf), '-c:v', 'ffv1'], pending)
+        return self._variant(path, spec, '.png', ['-frames:v', '1', '-vf', ','.join(vf)], pending)
+
+    def sound(self, path, sample_rate=None, channels=2, pending=None):
+        """path as PCM WAV at sample_rate/channels; a WAV that already
+        matches is returned as is. pending: see _variant."""
+        info = self.info(path)
+        sample_rate = int(sample_rate or 44100)
+        if (os.path.splitext(path)[1].lower() == '.wav' and info.get('sample_rate') == sample_rate
+                and info.get('channels') == channels):
+            return path
+        spec = {'kind': 'sound', 'sample_rate': sample_rate, 'channels': channels}
+        return self._variant(path, spec, '.wav', ['-vn', '-ac', str(channels), '-ar', str(sample_rate),
+                                                  '-c:a', 'pcm_s16le'], pending)
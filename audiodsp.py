@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+In-process audio effects on float32 NumPy arrays (optional backend).
+
+Audio is decoded once with ffmpeg to interleaved float32 at the probed
+sample rate, processed as arrays of shape (samples, channels), and written
+back once. NumPy is optional: available() says whether the backend can run,
+and imports it on first use so loading this module (every engine import)
+stays cheap.
+
+Benchmark against the ffmpeg path:
+  python audiodsp.py input.mp4 [--repeat 3]
+"""
+from __future__ import print_function, unicode_literals
+import random
+import subprocess
+
+# numpy, once available() has imported it
+np = None
+
+import filtergraph
+import tracing
+from utils import cancel_token, check_cancelled
+
+# Effects this backend can run on an extracted audio stream.
+SUPPORTED = set(['earrape', 'chorus', 'vibrato', 'random_sound'])
+
+
+def available():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+        np = numpy
+    return True
+
+
+def _communicate(cmd, data=None):
+    check_cancelled()
+    timer = tracing.CommandTimer([cmd])
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE if data is not None else None,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    token = cancel_token()
+    if token is not None:
+        token.track(p)
+    try:
+        out, err = p.communicate(data)
+    finally:
+        if token is not None:
+            token.untrack(p)
+    timer.finish(p.returncode == 0)
+    check_cancelled()
+    return p.returncode, out, err
+
+
+def decode(ffmpeg, path, sample_rate, channels):
+    cmd = [ffmpeg, '-v', 'error', '-i', path, '-vn', '-f', 'f32le', '-acodec', 'pcm_f32le',
+           '-ac', str(channels), '-ar', str(sample_rate), 'pipe:1']
+    code, out, err = _communicate(cmd)
+    if code != 0:
+        raise RuntimeError("decode failed: %s" % (err or b'').decode('utf-8', errors='ignore').strip())
+    return np.frombuffer(out, dtype='<f4').reshape(-1, channels).copy()
+
+
+def encode_wav(ffmpeg, x, sample_rate, out):
+    x = clip(x)
+    cmd = [ffmpeg, '-y', '-v', 'error', '-f', 'f32le', '-ar', str(sample_rate), '-ac', str(x.shape[1]),
+           '-i', 'pipe:0', '-c:a', 'pcm_s16le', out]
+    code, _, err = _communicate(cmd, np.ascontiguousarray(x, dtype='<f4').tobytes())
+    if code != 0:
+        raise RuntimeError("encode failed: %s" % (err or b'').decode('utf-8', errors='ignore').strip())
+    return out
+
+
+def clip(x):
+    return np.clip(x, -1.0, 1.0)
+
+
+def gain_db(x, db):
+    return x * np.float32(10.0 ** (float(db) / 20.0))
+
+
+def echo(x, sample_rate, in_gain, out_gain, delays_ms, decays):
+    """Same model as ffmpeg's aecho: (in*in_gain + sum(decay*delayed in)) * out_gain."""
+    y = x * np.float32(in_gain)
+    for d, dec in zip(delays_ms, decays):
+        shift = int(sample_rate * d / 1000.0)
+        if 0 < shift < len(x):
+            y[shift:] += x[:-shift] * np.float32(dec)
+    return y * np.float32(out_gain)
+
+
+def resample(x, factor):
+    """Play x factor times faster by linear interpolation (pitch and
+    duration both change)."""
+    n = len(x)
+    m = max(1, int(round(n / float(factor))))
+    pos = np.linspace(0, n - 1, m)
+    base = np.arange(n)
+    return np.stack([np.interp(pos, base, x[:, c]) for c in range(x.shape[1])], axis=1).astype(np.float32)
+
+
+def time_stretch(x, rate, n_fft=2048, hop=512):
+    """Change duration by 1/rate keeping pitch (phase vocoder)."""
+    n, ch = x.shape
+    if n < n_fft + hop:
+        return resample(x, rate)
+    win = np.hanning(n_fft).astype(np.float32)
+    starts = np.arange(0, n - n_fft, hop)
+    spec = np.fft.rfft(x[starts[:, None] + np.arange(n_fft)[None, :]] * win[None, :, None], axis=1)
+    pos = np.arange(0, len(starts) - 1, float(rate))
+    i0 = pos.astype(np.int64)
+    frac = (pos - i0)[:, None, None]
+    mag = (1 - frac) * np.abs(spec[i0]) + frac * np.abs(spec[i0 + 1])
+    # phase advance per hop, unwrapped around each bin's nominal frequency
+    omega = (2 * np.pi * hop * np.arange(spec.shape[1]) / n_fft)[None, :, None]
+    dphi = np.angle(spec[i0 + 1]) - np.angle(spec[i0]) - omega
+    dphi = dphi - 2 * np.pi * np.round(dphi / (2 * np.pi)) + omega
+    phase = np.angle(spec[:1]) + np.concatenate([np.zeros_like(dphi[:1]), np.cumsum(dphi[:-1], axis=0)])
+    frames = np.fft.irfft(mag * np.exp(1j * phase), n=n_fft, axis=1) * win[None, :, None]
+    out_len = (len(pos) - 1) * hop + n_fft
+    y = np.zeros((out_len, ch), dtype=np.float64)
+    norm = np.zeros(out_len, dtype=np.float64)
+    idx = ((np.arange(len(pos)) * hop)[:, None] + np.arange(n_fft)[None, :]).ravel()
+    for c in range(ch):
+        np.add.at(y[:, c], idx, frames[:, :, c].ravel())
+    np.add.at(norm, idx, np.tile(win.astype(np.float64) ** 2, len(pos)))
+    return (y / np.maximum(norm, 1e-3)[:, None]).astype(np.float32)
+
+
+def fit_length(x, n):
+    if len(x) >= n:
+        return x[:n]
+    return np.concatenate([x, np.zeros((n - len(x), x.shape[1]), dtype=x.dtype)])
+
+
+def pitch_shift(x, factor):
+    """Raise the pitch by factor without changing the duration."""
+    return fit_length(time_stretch(resample(x, factor), 1.0 / factor), len(x))
+
+
+def mix(x, sound, offset):
+    """Add sound into x starting at sample offset, cut at the end of x."""
+    if offset >= len(x):
+        return x
+    end = min(len(x), offset + len(sound))
+    x[offset:end] += sound[:end - offset]
+    return x
+
+
+def apply_step(ffmpeg, x, sample_rate, name, params):
+    """Apply one resolved step to x. random_sound uses the planned times,
+    drawing them like the ffmpeg path when a step was not planned."""
+    if name == 'earrape':
+        return gain_db(x, params.get('level', 16.0))
+    if name == 'chorus':
+        in_gain, out_gain, delays, decays = filtergraph.chorus_params(params.get('level', 0.6))
+        return echo(x, sample_rate, in_gain, out_gain, delays, decays)
+    if name == 'vibrato':
+        return pitch_shift(x, filtergraph.vibrato_level(params.get('level', 1.03)))
+    if name == 'random_sound':
+        assets = params.get('asset') or []
+        if not isinstance(assets, (list, tuple)):
+            assets = [assets]
+        if not assets:
+            return x
+        times = params.get('times')
+        if times is None:
+            dur = len(x) / float(sample_rate)
+            times = [random.uniform(0, max(0.0, dur-0.5)) for i in range(int(params.get('count', 3)))]
+        decoded = {}
+        for i, t in enumerate(times):
+            a = assets[i % len(assets)]
+            if a not in decoded:
+                decoded[a] = decode(ffmpeg, a, sample_rate, x.shape[1])
+            x = mix(x, decoded[a], int(t * sample_rate))
+        return x
+    raise ValueError("audio backend cannot run %s" % name)
+
+
+def benchmark(input_path, repeat=3):
+    """Time each supported effect through the ffmpeg path and this backend
+    on the audio of input_path. Returns {effect: {'ffmpeg': s, 'numpy': s}}."""
+    import time
+    from engine import YTPEngine
+    from utils import rm_f, temp_filename_for
+    eng = YTPEngine(cache_size=0)
+    info = eng.probe.probe(input_path)
+    sr = info.get('sample_rate') or 44100
+    ch = info.get('channels') or 2
+    wav = temp_filename_for('.wav')
+    eng._run_encode([eng.ffmpeg, '-y', '-i', input_path, '-vn'], wav, video=False)
+    cases = [('earrape', {'level': 12.0}), ('chorus', {'level': 0.6}),
+             ('vibrato', {'level': 1.05, 'sample_rate': sr})]
+    results = {}
+    try:
+        for name, params in cases:
+            row = {}
+            t0 = time.time()
+            for i in range(repeat):
+                rm_f(eng._apply_step(wav, name, params))
+            row['ffmpeg'] = (time.time() - t0) / repeat
+            if available():
+                t0 = time.time()
+                for i in range(repeat):
+                    x = decode(eng.ffmpeg, wav, sr, ch)
+                    out = encode_wav(eng.ffmpeg, apply_step(eng.ffmpeg, x, sr, name, params), sr, temp_filename_for('.wav'))
+                    rm_f(out)
+                row['numpy'] = (time.time() - t0) / repeat
+            results[name] = row
+    finally:
+        rm_f(wav)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description="Benchmark the NumPy audio backend against ffmpeg filters.")
+    parser.add_argument('input', help='Media file with an audio stream')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    if not available():
+        print("NumPy is not installed; only the ffmpeg path will be timed.")
+    print(json.dumps(benchmark(args.input, args.repeat), indent=2, sort_keys=True))
@@ -0,0 +1,256 @@
+"""
+Reproducible engine benchmark on synthetic inputs.
+
+Inputs are made with ffmpeg's lavfi sources (testsrc2 video, sine audio),
+so the suite needs nothing but ffmpeg and runs offline. Every effect is
+timed on its own through YTPEngine._apply_step, then a few generate and
+auto_generate presets run end to end. The stage cache is off and the RNG
+is seeded before each run, so two runs do the same work.
+
+  python benchmark.py run -o results.json [--quick] [--repeat 3] [--only speed,reverse]
+  python benchmark.py compare old.json new.json [--threshold 0.10]
+
+compare exits 1 when any case's median time grew by more than the
+threshold (a fraction: 0.10 = 10%).
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import utils
+from engine import YTPEngine
+from scratch import ScratchArena
+from stagecache import string_types
+
+# (name, width, height, seconds)
+INPUTS = [
+    ('240p_4s', 426, 240, 4),
+    ('480p_8s', 854, 480, 8),
+    ('720p_8s', 1280, 720, 8),
+]
+QUICK_INPUTS = INPUTS[:1]
+
+# Resolved steps as _plan_steps would produce them; asset placeholders are
+# filled in with the generated overlay image and sound.
+EFFECTS = [
+    ('reverse', {}),
+    ('speed', {'level': 1.5}),
+    ('stutter', {'level': 3}),
+    ('earrape', {'level': 12.0}),
+    ('chorus', {'level': 0.6}),
+    ('vibrato', {'level': 1.05, 'sample_rate': 44100}),
+    ('sus', {'level': 1.1}),
+    ('invert', {}),
+    ('mirror', {}),
+    ('dance', {}),
+    ('rainbow', {'asset': '$image', 'opacity': 0.8}),
+    ('explosion', {'asset': '$image', 'count': 4}),
+    ('frame_shuffle', {'level': 8}),
+    ('meme', {'asset': '$image'}),
+    ('random_sound', {'asset': ['$sound'], 'count': 3}),
+    ('sentence_mix', {'parts': 6}),
+    ('mode_2009', {'overlay': '$image'}),
+    ('mode_2012', {}),
+]
+
+_FILTERS = {'speed': {'enabled': True, 'level': 1.3}, 'earrape': {'enabled': True, 'level': 10.0},
+            'chorus': {'enabled': True}, 'invert': {'enabled': True}, 'mirror': {'enabled': True}}
+PRESETS = [
+    ('generate_filters', _FILTERS),
+    ('generate_filters_streaming', dict(_FILTERS, streaming=True)),
+    ('generate_video_segmented', {'invert': {'enabled': True}, 'mirror': {'enabled': True}, 'segments': 4}),
+    ('generate_mixed', {'sentence_mix': {'enabled': True, 'parts': 4}, 'stutter': {'enabled': True, 'level': 2},
+                        'vibrato': {'enabled': True, 'level': 1.05}, 'frame_shuffle': {'enabled': True, 'level': 6},
+                        'explosion': {'enabled': True, 'asset': '$image', 'count': 3},
+                        'random_sound': {'enabled': True, 'asset': '$sound', 'count': 2}}),
+]
+AUTO_COUNT = 2
+SEED = 1234
+BETA_KEY = 'BETA-BENCHMARK'
+
+
+def _run(cmd):
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError("%s failed: %s" % (cmd[0], (err or b'').decode('utf-8', errors='ignore').strip()[-400:]))
+
+
+def make_input(ffmpeg, path, width, height, seconds, caps):
+    """testsrc2 + 440 Hz sine as H.264/AAC mp4 (mpeg4/mp3 without libx264),
+    encoded single-threaded and bitexact so it is the same on every run."""
+    src = ['-f', 'lavfi', '-i', 'testsrc2=size=%dx%d:rate=25:duration=%d' % (width, height, seconds),
+           '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100:duration=%d' % seconds]
+    exact = ['-threads', '1', '-fflags', '+bitexact', '-flags', '+bitexact', '-ac', '2', '-shortest']
+    if caps.has_encoder('libx264'):
+        codecs = ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-c:a', 'aac']
+    else:
+        codecs = ['-c:v', 'mpeg4', '-c:a', 'libmp3lame']
+    _run([ffmpeg, '-y', '-v', 'error'] + src + exact + codecs + [path])
+    return path
+
+
+def make_assets(ffmpeg, root):
+    image = os.path.join(root, 'overlay.png')
+    sound = os.path.join(root, 'sound.wav')
+    _run([ffmpeg, '-y', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc2=size=96x96:rate=1', '-frames:v', '1', image])
+    _run([ffmpeg, '-y', '-v', 'error', '-f', 'lavfi', '-i', 'sine=frequency=880:duration=1', '-ac', '2', sound])
+    return {'$image': image, '$sound': sound}
+
+
+def _fill(value, assets):
+    if isinstance(value, dict):
+        return dict((k, _fill(v, assets)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_fill(v, assets) for v in value]
+    return assets.get(value, value) if isinstance(value, string_types) else value
+
+
+def metadata(eng):
+    return {'ffmpeg': eng.ffmpeg_version(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpu_count': multiprocessing.cpu_count(),
+            'intermediate': eng.intermediate, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def _summary(runs):
+    runs = sorted(runs)
+    return {'runs': [round(r, 4) for r in runs], 'min': round(runs[0], 4),
+            'median': round(runs[len(runs) // 2], 4), 'mean': round(sum(runs) / len(runs), 4)}
+
+
+def reset_caches(eng):
+    """Forget the asset variants and input analyses, so every run converts
+    and analyzes as a first job would."""
+    utils.rm_f(eng.assets.variant_dir)
+    utils.rm_f(eng.analysis.root)
+    eng.assets.failed.clear()
+    eng.analysis.failed.clear()
+
+
+def _timed(fn, repeat, cleanup, scratch_dir=None, eng=None):
+    """Time fn repeat times. With scratch_dir, each run gets its own scratch
+    arena (as render_plan gives a job), emptied after it is timed. With eng,
+    its caches are reset before each run."""
+    runs = []
+    for i in range(repeat):
+        if eng is not None:
+            reset_caches(eng)
+        random.seed(SEED)
+        arena = ScratchArena(scratch_dir) if scratch_dir else None
+        prev = utils.set_scratch(arena)
+        try:
+            t0 = time.time()
+            out = fn()
+            runs.append(time.time() - t0)
+        finally:
+            utils.set_scratch(prev)
+            if arena is not None:
+                arena.close()
+        for path in cleanup(out):
+            if path and os.path.isfile(path):
+                os.remove(path)
+    return _summary(runs)
+
+
+def run_suite(quick=False, repeat=3, only=None, log=print):
+    """Time every case; returns {'meta': ..., 'results': {'input/case': summary}}."""
+    root = tempfile.mkdtemp(prefix='ytp_bench_')
+    try:
+        eng = YTPEngine(work_dir=os.path.join(root, 'work'), cache_size=0)
+        assets = make_assets(eng.ffmpeg, root)
+        results = {}
+        for name, w, h, secs in (QUICK_INPUTS if quick else INPUTS):
+            inp = make_input(eng.ffmpeg, os.path.join(root, name + '.mp4'), w, h, secs, eng.caps)
+            for eff, params in EFFECTS:
+                if only and eff not in only:
+                    continue
+                params = _fill(params, assets)
+                log("bench %s %s" % (name, eff))
+                results['%s/%s' % (name, eff)] = _timed(
+                    lambda: eng._apply_step(inp, eff, dict(params)), repeat,
+                    lambda out: [out] if out != inp else [], eng.scratch_dir, eng)
+            for preset, opts in PRESETS:
+                if only and preset not in only:
+                    continue
+                opts = _fill(opts, assets)
+                out = os.path.join(root, preset + '.mp4')
+                log("bench %s %s" % (name, preset))
+                results['%s/%s' % (name, preset)] = _timed(
+                    lambda: eng.generate(inp, out, dict(opts, seed=SEED)), repeat, lambda o: [o], eng=eng)
+            if not only or 'auto_generate' in only:
+                out_dir = os.path.join(root, 'auto')
+                log("bench %s auto_generate" % name)
+                results['%s/auto_generate' % name] = _timed(
+                    lambda: eng.auto_generate(inp, out_dir, _FILTERS, count=AUTO_COUNT, beta_key=BETA_KEY, seed=SEED),
+                    repeat, lambda outs: outs, eng=eng)
+        return {'meta': metadata(eng), 'repeat': repeat, 'results': results}
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def compare(old, new, threshold=0.10):
+    """Rows of (case, old_median, new_median, ratio, flag) for cases in both
+    runs; flag is 'REGRESSION' when new is slower by more than threshold."""
+    rows = []
+    for case in sorted(set(old['results']) & set(new['results'])):
+        a, b = old['results'][case]['median'], new['results'][case]['median']
+        ratio = b / a if a > 0 else 1.0
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        rows.append((case, a, b, ratio, flag))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark YTPEngine on synthetic lavfi inputs.")
+    sub = parser.add_subparsers(dest='cmd')
+    r = sub.add_parser('run', help='Run the suite')
+    r.add_argument('-o', '--output', default='benchmark.json')
+    r.add_argument('--quick', action='store_true', help='Smallest input only')
+    r.add_argument('--repeat', type=int, default=3)
+    r.add_argument('--only', help='Comma-separated effects/presets (e.g. speed,generate_filters,auto_generate)')
+    c = sub.add_parser('compare', help='Compare two result files')
+    c.add_argument('old')
+    c.add_argument('new')
+    c.add_argument('--threshold', type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    if args.cmd == 'run':
+        only = set(args.only.split(',')) if args.only else None
+        res = run_suite(args.quick, max(1, args.repeat), only, log=lambda m: print(m, file=sys.stderr))
+        with open(args.output, 'w') as f:
+            json.dump(res, f, indent=2, sort_keys=True)
+        print("Wrote %s (%d cases)" % (args.output, len(res['results'])))
+        return 0
+    if args.cmd == 'compare':
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        if old['meta'].get('ffmpeg') != new['meta'].get('ffmpeg'):
+            print("note: ffmpeg differs: %r vs %r" % (old['meta'].get('ffmpeg'), new['meta'].get('ffmpeg')))
+        rows = compare(old, new, args.threshold)
+        for case, a, b, ratio, flag in rows:
+            print("%-40s %8.3fs %8.3fs %6.2fx %s" % (case, a, b, ratio, flag))
+        bad = [row for row in rows if row[4] == 'REGRESSION']
+        print("%d cases, %d regressions (threshold %d%%)" % (len(rows), len(bad), args.threshold * 100))
+        return 1 if bad else 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+What an ffmpeg binary can do: encoders, filters, options and version.
+
+Probed once per binary (ffmpeg -encoders, -filters, -h long, -version) and
+cached on disk by the binary's path, size and mtime. The engine uses it to
+pick codecs and filter variants up front.
+"""
+from __future__ import print_function, unicode_literals
+import json
+import os
+import re
+import subprocess
+import threading
+
+from utils import replace_file, rm_f
+
+CACHE_VERSION = 1
+
+
+def _output(cmd):
+    try:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        return (out or b'').decode('utf-8', errors='ignore') + (err or b'').decode('utf-8', errors='ignore')
+    except Exception:
+        return ''
+
+
+def parse_encoders(text):
+    """Names from `ffmpeg -encoders`: lines like ' V....D libx264  ...'
+    after the '------' separator."""
+    names = set()
+    started = False
+    for line in text.splitlines():
+        if line.strip().startswith('------'):
+            started = True
+            continue
+        parts = line.split()
+        if started and len(parts) >= 2 and re.match(r'^[VAS][A-Z.]{5}$', parts[0]):
+            names.add(parts[1])
+    return names
+
+
+def parse_filters(text):
+    """Names from `ffmpeg -filters`, with or without the flags column."""
+    names = set()
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) >= 3 and '->' in parts[2]:
+            names.add(parts[1])
+        elif len(parts) >= 2 and '->' in parts[1]:
+            names.add(parts[0])
+    return names
+
+
+def parse_options(text):
+    return set(m.group(1) for m in re.finditer(r'^-([a-zA-Z][\w:]*)', text, re.M))
+
+
+class Capabilities(object):
+    """Probe results. When probing found nothing (a very old or broken
+    binary), known is False and every has_* answers True, so callers keep
+    their try-and-fall-back behaviour."""
+
+    def __init__(self, version='', encoders=(), filters=(), options=()):
+        self.version = version
+        self.encoders = set(encoders)
+        self.filters = set(filters)
+        self.options = set(options)
+        self.known = bool(self.encoders and self.filters)
+
+    def has_encoder(self, name):
+        return not self.known or name in self.encoders
+
+    def has_filter(self, name):
+        return not self.known or name in self.filters
+
+    def has_option(self, name):
+        return not self.options or name in self.options
+
+    def to_dict(self):
+        return {'version': self.version, 'encoders': sorted(self.encoders),
+                'filters': sorted(self.filters), 'options': sorted(self.options)}
+
+
+def probe(ffmpeg):
+    banner = _output([ffmpeg, '-version'])
+    return Capabilities(banner.split('\n')[0].strip(),
+                        parse_encoders(_output([ffmpeg, '-hide_banner', '-encoders'])),
+                        parse_filters(_output([ffmpeg, '-hide_banner', '-filters'])),
+                        parse_options(_output([ffmpeg, '-hide_banner', '-h', 'long'])))
+
+
+def _binary_key(ffmpeg):
+    try:
+        st = os.stat(ffmpeg)
+        return '%s|%d|%d' % (os.path.abspath(ffmpeg), st.st_size, int(st.st_mtime))
+    except OSError:
+        return None
+
+
+def load(ffmpeg, cache_path=None):
+    """Capabilities of ffmpeg, from cache_path when the binary is unchanged."""
+    key = _binary_key(ffmpeg)
+    cache = {}
+    if cache_path and key:
+        try:
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+            if cache.get('version') != CACHE_VERSION:
+                cache = {}
+        except (IOError, OSError, ValueError):
+            cache = {}
+        entry = cache.get('binaries', {}).get(key)
+        if entry:
+            return Capabilities(entry['version'], entry['encoders'], entry['filters'], entry['options'])
+    caps = probe(ffmpeg)
+    if cache_path and key and caps.known:
+        cache.setdefault('binaries', {})[key] = caps.to_dict()
+        cache['version'] = CACHE_VERSION
+        # pool workers and server threads may write it at once
+        tmp = '%s.%d.%d.tmp' % (cache_path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            replace_file(tmp, cache_path)
+        except (IOError, OSError):
+            rm_f(tmp)
+    return caps
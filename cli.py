@@ -0,0 +1,157 @@
+"""
+Headless entry point: renders without a display and never imports Tk.
+
+  python cli.py -c config_sample_updated.json input.mp4 output.mp4
+  python cli.py -c base.json --manifest jobs.jsonl --jobs 2
+
+A manifest has one JSON job per line:
+  {"input": "a.mp4", "output": "out/a.mp4", "options": {...}, "seed": 7}
+"options" is merged over the -c config (per effect), or "config" names
+another config file to start from. A job with "plan" replays a saved plan
+("input" is then optional). Blank lines and lines starting with # are
+skipped.
+
+Plans (see renderplan.py): render a cheap proxy, keep the plan, replay it:
+  python cli.py -c cfg.json in.mp4 preview.mp4 --proxy 480 --plan-out edit.json
+  python cli.py --plan edit.json final.mp4
+
+ffmpeg logs go to stderr. stdout gets one JSON summary; the exit status
+is 0 only if every job succeeded (1 = a job failed, 2 = bad arguments).
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import json
+import os
+import sys
+
+import engine
+
+
+def load_config(path):
+    if not path:
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def merge_options(base, override):
+    """override on top of base; effect dicts are merged key by key."""
+    out = dict((k, dict(v) if isinstance(v, dict) else v) for k, v in base.items())
+    for k, v in (override or {}).items():
+        if isinstance(v, dict) and isinstance(out.get(k), dict):
+            out[k].update(v)
+        else:
+            out[k] = v
+    return out
+
+
+def read_manifest(path, base):
+    """(input, output, options) for every job line of path."""
+    jobs = []
+    with open(path, 'r') as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                job = json.loads(line)
+                opts = load_config(job['config']) if job.get('config') else base
+                opts = merge_options(opts, job.get('options'))
+                if job.get('seed') is not None:
+                    opts['seed'] = job['seed']
+                if job.get('plan'):
+                    opts['plan'] = job['plan']
+                    jobs.append((job.get('input'), job['output'], opts))
+                else:
+                    jobs.append((job['input'], job['output'], opts))
+            except (ValueError, KeyError, IOError, OSError) as e:
+                raise ValueError("%s:%d: %s" % (path, n, e))
+    return jobs
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description="Render YTPs without the GUI.")
+    p.add_argument('input', nargs='?', help='Input video (single job)')
+    p.add_argument('output', nargs='?', help='Output file (single job)')
+    p.add_argument('-c', '--config', help='Options JSON (config_sample_updated.json shape)')
+    p.add_argument('-m', '--manifest', help='JSONL file of input/output/options jobs')
+    p.add_argument('-j', '--jobs', type=int, help='Jobs rendered at once (default: cores / 4)')
+    p.add_argument('-t', '--threads', type=int, help='Total ffmpeg thread budget (default: all cores)')
+    p.add_argument('--seed', type=int, help='RNG seed for jobs that do not set one')
+    p.add_argument('--intermediate', choices=sorted(engine.INTERMEDIATE_PROFILES), help='Intermediate profile')
+    p.add_argument('--work-dir', help='Temp/cache directory (default: ./ytp_temp)')
+    p.add_argument('--segments', type=int, help='Render frame-local effects on this many chunks at once')
+    p.add_argument('--scratch-dir', help='Where jobs keep intermediates (default: <work-dir>/scratch)')
+    p.add_argument('--scratch-ram', help='RAM-backed directory (e.g. /dev/shm) for intermediates of small clips')
+    p.add_argument('--scratch-quota', type=int, help='Per-job scratch limit in MB; a job over it fails')
+    p.add_argument('--no-cache', action='store_true', help='Disable the stage cache')
+    p.add_argument('--plan', help='Replay a saved render plan (input defaults to the planned one)')
+    p.add_argument('--plan-out', help='Save the render plan of a single job here')
+    p.add_argument('--proxy', type=int, help='Render on a copy of the input scaled to this width')
+    p.add_argument('--trace', action='store_true', help='Write a Chrome trace next to each output (<output>.trace.json)')
+    return p
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        base = load_config(args.config)
+        if args.manifest:
+            jobs = read_manifest(args.manifest, base)
+        elif args.plan and args.input and not args.output:
+            jobs = [(None, args.input, dict(base, plan=args.plan))]
+        elif args.input and args.output:
+            jobs = [(args.input, args.output, dict(base, plan=args.plan) if args.plan else base)]
+        else:
+            parser.error("give input and output, or --manifest")
+    except (ValueError, IOError, OSError) as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 2
+    if args.seed is not None:
+        jobs = [(i, o, dict(opts, seed=opts.get('seed', args.seed))) for i, o, opts in jobs]
+    if args.proxy:
+        jobs = [(i, o, dict(opts, proxy=args.proxy)) for i, o, opts in jobs]
+    if args.plan_out and len(jobs) == 1:
+        jobs = [(i, o, dict(opts, plan_out=args.plan_out)) for i, o, opts in jobs]
+    if args.trace:
+        jobs = [(i, o, dict(opts, trace=o + '.trace.json')) for i, o, opts in jobs]
+    for _, out, _ in jobs:
+        d = os.path.dirname(os.path.abspath(out))
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    engine_kwargs = {'work_dir': args.work_dir, 'intermediate': args.intermediate}
+    if args.segments:
+        engine_kwargs['segments'] = args.segments
+    if args.scratch_dir or args.scratch_ram or args.scratch_quota:
+        engine_kwargs.update(scratch_dir=args.scratch_dir, scratch_ram=args.scratch_ram,
+                             scratch_quota=args.scratch_quota and args.scratch_quota * 1024 * 1024)
+    if args.no_cache:
+        engine_kwargs['cache_size'] = 0
+
+    def report(res):
+        print("[%s] %s -> %s (%.1fs)%s" % ('ok' if res['ok'] else 'FAILED', res['input'], res['output'],
+                                            res['seconds'], '' if res['ok'] else ': ' + res['error']), file=sys.stderr)
+
+    # everything the engine and ffmpeg print goes to stderr (fd 2), so
+    # stdout carries only the summary
+    sys.stdout.flush()
+    real_stdout = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        results = engine.run_jobs(jobs, engine_kwargs, args.jobs, args.threads, callback=report)
+    except EnvironmentError as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 2
+    finally:
+        sys.stdout.flush()
+        os.dup2(real_stdout, 1)
+        os.close(real_stdout)
+    failed = sum(1 for r in results if not r['ok'])
+    print(json.dumps({'jobs': len(results), 'ok': len(results) - failed, 'failed': failed,
+                      'results': results}, indent=2, sort_keys=True))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,163 @@
 from __future__ import print_function, unicode_literals
 import os
+import multiprocessing
 import random
-import re
-import shutil
-import tempfile
-from utils import find_ffmpeg, temp_filename_for, run_command, rm_f, read_beta_key_from_file, is_valid_beta_key, find_assets_dir, list_asset_files
+import threading
+import time
+import utils
+from utils import find_ffmpeg, find_ffprobe, temp_filename_for, temp_dirname, run_command, run_parallel, run_many, rm_f, replace_file, set_ffmpeg_threads, JobCancelled, set_scratch, scratch, read_beta_key_from_file, is_valid_beta_key, find_assets_dir
+import analysis
+import assetindex
+import audiodsp
+import capabilities
+import filtergraph
+import journal
+import pipeline
+import probe
+import renderplan
+from scratch import ScratchArena
+import stagecache
+import tracing
+
+FINAL_VIDEO_ARGS = ['-c:v', 'libx264', '-preset', 'veryfast']
+FINAL_AUDIO_ARGS = ['-c:a', 'aac', '-b:a', '192k']
+FINAL_CODEC_ARGS = FINAL_VIDEO_ARGS + FINAL_AUDIO_ARGS
+FINAL_CODEC_ARGS_FALLBACK = ['-c:v', 'mpeg4', '-qscale:v', '5', '-c:a', 'libmp3lame', '-b:a', '192k']
+FINAL_VIDEO_ARGS_FALLBACK = FINAL_CODEC_ARGS_FALLBACK[:4]
+FINAL_AUDIO_ARGS_FALLBACK = FINAL_CODEC_ARGS_FALLBACK[4:]
+
+# Codec settings for the files passed between effect stages. 'fallback' names
+# the profile to retry with when an encoder is missing from the ffmpeg build.
+INTERMEDIATE_PROFILES = {
+    # lossy mp4, what every stage wrote before profiles existed
+    'legacy': {'ext': '.mp4', 'video': ['-c:v', 'libx264', '-preset', 'veryfast'], 'audio': ['-c:a', 'aac'], 'fallback': 'legacy_mpeg4'},
+    'legacy_mpeg4': {'ext': '.mp4', 'video': ['-c:v', 'mpeg4', '-qscale:v', '6'], 'audio': ['-c:a', 'libmp3lame']},
+    # lossless and fast to encode; falls back to ffv1 without libx264
+    'x264_lossless': {'ext': '.mkv', 'video': ['-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '0'], 'audio': ['-c:a', 'pcm_s16le'], 'fallback': 'ffv1'},
+    # built into every ffmpeg, no external encoder needed
+    'ffv1': {'ext': '.mkv', 'video': ['-c:v', 'ffv1'], 'audio': ['-c:a', 'pcm_s16le']},
+    'nut': {'ext': '.nut', 'video': ['-c:v', 'ffv1'], 'audio': ['-c:a', 'pcm_s16le']},
+    # no compression at all: fastest on CPU, largest on disk
+    'raw': {'ext': '.nut', 'video': ['-c:v', 'rawvideo'], 'audio': ['-c:a', 'pcm_s16le']},
+    # audio-only files inside an audio lane (see _render_unit)
+    'pcm_wav': {'ext': '.wav', 'video': [], 'audio': ['-c:a', 'pcm_s16le']},
+}
+DEFAULT_INTERMEDIATE = 'x264_lossless'
+
+# Segmented rendering (see _run_segmented) never cuts chunks shorter than this.
+MIN_SEGMENT_SECONDS = 2.0
+# The reverse filters hold the whole clip in memory; longer clips are
+# reversed in chunks of this many seconds (see _reverse_chunked).
+REVERSE_CHUNK_SECONDS = 5.0
+
+# Which streams each effect touches. Everything not listed changes both
+# (reverse, speed, sus, stutter, sentence_mix).
+AUDIO_ONLY = set(['earrape', 'chorus', 'vibrato', 'random_sound'])
+VIDEO_ONLY = set(['mode_2009', 'mode_2012', 'invert', 'mirror', 'dance', 'rainbow', 'meme',
+                  'explosion', 'frame_shuffle'])
+
+
+def stage_lane(stage):
+    """'audio' or 'video' when every step of stage touches only that stream."""
+    names = [name for group in stage for name, _ in group[1]]
+    if names and all(n in AUDIO_ONLY for n in names):
+        return 'audio'
+    if names and all(n in VIDEO_ONLY for n in names):
+        return 'video'
+    return None
+
+
+def thread_budget(count, jobs=None, threads=None):
+    """(jobs, threads_per_job) for concurrent renders sharing a thread budget."""
+    total = int(threads or multiprocessing.cpu_count() or 1)
+    if not jobs:
+        jobs = max(1, total // 4)
+    jobs = max(1, min(int(jobs), int(count)))
+    return jobs, max(1, total // jobs)
+
+
+# Planning seeds and draws from the shared random module; engines rendering
+# on several threads (server.py) take turns so every plan is reproducible.
+_rng_lock = threading.RLock()
+
+# Process-pool workers keep one warm engine each.
+_worker_engine = None
+
+def _pool_init(engine_kwargs, threads):
+    global _worker_engine
+    set_ffmpeg_threads(threads)
+    _worker_engine = YTPEngine(**engine_kwargs)
+
+def _pool_render(task):
+    index, input_video, out, base_options, seed, journal_dir = task
+    try:
+        _worker_engine._render_variant(input_video, out, base_options, seed,
+                                       journal=journal.VariantJournal(journal_dir, index))
+        return index, out, seed, None
+    except Exception as e:
+        return index, out, seed, str(e)
+
+def _pool_job(task):
+    index, input_video, out, options = task
+    t0 = time.time()
+    _worker_engine.last_scratch = {}
+    try:
+        _worker_engine.generate(input_video, out, options)
+        return index, None, time.time() - t0, _worker_engine.last_scratch.get('peak_bytes')
+    except Exception as e:
+        return index, str(e) or e.__class__.__name__, time.time() - t0, _worker_engine.last_scratch.get('peak_bytes')
+
+
+def run_jobs(jobs, engine_kwargs=None, concurrency=None, threads=None, callback=None):
+    """Render (input, output, options) jobs in a process pool; one result dict per job."""
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    concurrency, per_job = thread_budget(len(jobs), concurrency, threads)
+    tasks = [(i, inp, out, opts) for i, (inp, out, opts) in enumerate(jobs)]
+    results = {}
+
+    def finish(index, err, seconds, scratch_peak):
+        inp, out, _ = jobs[index]
+        results[index] = {'index': index, 'input': inp, 'output': out, 'ok': err is None,
+                          'error': err, 'seconds': round(seconds, 3), 'scratch_peak': scratch_peak}
+        if callback:
+            callback(results[index])
+
+    if concurrency == 1:
+        _pool_init(engine_kwargs or {}, threads and per_job)
+        for task in tasks:
+            finish(*_pool_job(task))
+    else:
+        YTPEngine(**(engine_kwargs or {}))  # fail here, not in every worker, if ffmpeg is missing
+        pool = multiprocessing.Pool(concurrency, initializer=_pool_init, initargs=(engine_kwargs or {}, per_job))
+        try:
+            for res in pool.imap_unordered(_pool_job, tasks):
+                finish(*res)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    return [results[i] for i in sorted(results)]
+
 
 class YTPEngine(object):
-    def __init__(self, ffmpeg_path=None, ffplay_path=None, work_dir=None):
+    def __init__(self, ffmpeg_path=None, ffplay_path=None, work_dir=None, intermediate=None,
+                 cache_dir=None, cache_size=stagecache.DEFAULT_CACHE_SIZE, audio_backend='ffmpeg',
+                 segments=0, scratch_dir=None, scratch_ram=None, scratch_quota=None,
+                 reverse_chunk=REVERSE_CHUNK_SECONDS):
+        self._init_kwargs = {'ffmpeg_path': ffmpeg_path, 'ffplay_path': ffplay_path,
+                             'work_dir': work_dir, 'intermediate': intermediate,
+                             'cache_dir': cache_dir, 'cache_size': cache_size,
+                             'audio_backend': audio_backend, 'segments': segments,
+                             'scratch_dir': scratch_dir, 'scratch_ram': scratch_ram, 'scratch_quota': scratch_quota,
+                             'reverse_chunk': reverse_chunk}
         ffmpeg, ffplay = find_ffmpeg()
         self.ffmpeg = ffmpeg_path or ffmpeg
         self.ffplay = ffplay_path or ffplay
+        self.ffprobe = find_ffprobe(self.ffmpeg)
         if not self.ffmpeg:
             raise EnvironmentError("ffmpeg not found. Place ffmpeg.exe on PATH or next to script.")
         if not work_dir:
@@ -19,7 +166,36 @@ class YTPEngine(object):
         if not os.path.exists(self.work_dir):
             os.makedirs(self.work_dir)
         self.assets_dir = find_assets_dir()
-        self.asset_index = list_asset_files(self.assets_dir) if self.assets_dir else {}
+        self.probe = probe.ProbeCache(self.ffprobe, self.ffmpeg)
+        # see assetindex.py
+        self.assets = assetindex.AssetIndex(self.assets_dir, os.path.join(self.work_dir, 'asset_index.json'),
+                                            self.probe, self.ffmpeg, os.path.join(self.work_dir, 'asset_variants'))
+        self.asset_index = self.assets.by_ext()
+        # see analysis.py
+        self.analysis = analysis.AnalysisCache(os.path.join(self.work_dir, 'analysis'), self.ffmpeg, self.probe)
+        # encoders/filters of this binary (see capabilities.py)
+        self.caps = capabilities.load(self.ffmpeg, os.path.join(self.work_dir, 'capabilities.json'))
+        tracing.set_progress_enabled(self.caps.has_option('progress'))
+        # only a build that lists the option gets it; unknown ones are not risked
+        utils.set_filter_threads_option('filter_threads' in self.caps.options)
+        # cache_size=0 turns the stage cache off
+        self.stage_cache = None
+        if cache_size:
+            self.stage_cache = stagecache.StageCache(cache_dir or os.path.join(self.work_dir, 'stage_cache'), cache_size)
+        self.intermediate = intermediate or DEFAULT_INTERMEDIATE
+        # 'numpy' runs audio-only effects in-process (see audiodsp.py)
+        self.audio_backend = audio_backend
+        # >1 renders frame-local effects on that many chunks at once
+        self.segments = segments
+        # 0 reverses every clip in one piece
+        self.reverse_chunk = reverse_chunk
+        # every job's intermediates live in its own arena (see scratch.py)
+        self.scratch_dir = scratch_dir or os.path.join(self.work_dir, 'scratch')
+        self.scratch_ram = scratch_ram
+        self.scratch_quota = scratch_quota
+        self.last_scratch = {}
+        if self.intermediate not in INTERMEDIATE_PROFILES:
+            raise ValueError("Unknown intermediate profile: %s" % self.intermediate)
 
     def cleanup(self):
         rm_f(self.work_dir)
@@ -36,31 +212,85 @@ class YTPEngine(object):
                 return random.choice(v)
         return None
 
-    def _probe_duration(self, path):
-        try:
-            cmd = [self.ffmpeg, '-i', path]
-            p = __import__('subprocess').Popen(cmd, stdout=__import__('subprocess').PIPE, stderr=__import__('subprocess').PIPE)
-            out, err = p.communicate()
-            text = (err or b'').decode('utf-8', errors='ignore') + (out or b'').decode('utf-8', errors='ignore')
-            m = re.search(r'Duration:\s*(\d+):(\d+):(\d+\.\d+)', text)
-            if m:
-                h, mm, ss = m.groups()
-                return int(h)*3600 + int(mm)*60 + float(ss)
-        except Exception:
-            pass
-        return 0.0
+    def ffmpeg_version(self):
+        return self.caps.version
 
-    # Public API
-    def generate(self, input_video, output_path, options):
-        cur = input_video
+    # ---------------- Intermediate codecs ----------------
+    def _can_encode(self, prof):
+        args = prof['video'] + prof['audio']
+        return all(self.caps.has_encoder(args[i + 1]) for i, a in enumerate(args[:-1]) if a in ('-c:v', '-c:a'))
 
-        if options.get('sentence_mix', {}).get('enabled'):
-            cur = self._sentence_mix(cur, options.get('sentence_mix', {}))
+    def _profile(self, fallback=False):
+        """The intermediate profile to encode with, skipping ones this build cannot encode."""
+        prof = INTERMEDIATE_PROFILES[self.intermediate]
+        while prof.get('fallback') and not self._can_encode(prof):
+            prof = INTERMEDIATE_PROFILES[prof['fallback']]
+        if fallback:
+            prof = INTERMEDIATE_PROFILES.get(prof.get('fallback'), prof)
+        return prof
+
+    def _tmp_media(self):
+        return temp_filename_for(self._profile()['ext'])
+
+    def _enc(self, video=True, audio=True, fallback=False):
+        """Codec args for an intermediate; streams not re-encoded are copied."""
+        prof = self._profile(fallback)
+        return ((prof['video'] if video else ['-c:v', 'copy']) +
+                (prof['audio'] if audio else ['-c:a', 'copy']))
+
+    def _run_encode(self, args, out, video=True, audio=True):
+        """Encode args (a command without codecs or output) into an intermediate."""
+        if run_command(args + self._enc(video, audio) + [out]):
+            return True
+        if self.caps.known or self._profile(True) is self._profile():
+            return False
+        with tracing.fallback():
+            return run_command(args + self._enc(video, audio, fallback=True) + [out])
+
+    def _final_codecs(self):
+        """(video_args, audio_args) for the output: x264/AAC, else mpeg4/MP3."""
+        vargs = FINAL_VIDEO_ARGS if self.caps.has_encoder('libx264') else FINAL_VIDEO_ARGS_FALLBACK
+        aargs = FINAL_AUDIO_ARGS if self.caps.has_encoder('aac') else FINAL_AUDIO_ARGS_FALLBACK
+        return vargs, aargs
+
+    def _final_attempts(self, args):
+        """args, plus the fallback codec set when the build's encoders are unknown."""
+        if self.caps.known:
+            return [args]
+        return [args, FINAL_CODEC_ARGS_FALLBACK]
+
+    def _final_args(self, path, video=True, audio=True):
+        """Final codec args; streams already in the target codecs are copied."""
+        info = self.probe.probe(path, full=True) if not (video and audio) else {}
+        known = info.get('has_video') is not None
+        vargs, aargs = self._final_codecs()
+        if not video and known and (not info['has_video'] or (info['video_codec'] == 'h264' and info['pix_fmt'] == 'yuv420p'
+                                                               and '4:4:4' not in (info['video_profile'] or ''))):
+            vargs = ['-c:v', 'copy']
+        if not audio and known and (not info['has_audio'] or info['audio_codec'] == 'aac'):
+            aargs = ['-c:a', 'copy']
+        return vargs + aargs
+
+    def _final_encode(self, cur, out):
+        """Encode (or remux) the last intermediate into the output file."""
+        for i, codec_args in enumerate(self._final_attempts(self._final_args(cur, video=False, audio=False))):
+            with tracing.fallback(i > 0):
+                if run_command([self.ffmpeg, '-y', '-i', cur] + codec_args + [out]):
+                    return True
+        return False
 
+    # Public API
+    def _plan_steps(self, options, info=None):
+        """Roll options into an ordered list of (effect, params) steps."""
+        info = info or {}
+        steps = []
+        if options.get('sentence_mix', {}).get('enabled'):
+            steps.append(('sentence_mix', dict(options.get('sentence_mix', {}))))
         if options.get('mode_2009'):
-            cur = self._mode_2009(cur, options)
+            overlay = options.get('assets', {}).get('2009_ad') or self._pick_asset(['.png','.jpg','.gif'])
+            steps.append(('mode_2009', {'overlay': overlay}))
         if options.get('mode_2012'):
-            cur = self._mode_2012(cur, options)
+            steps.append(('mode_2012', {}))
 
         # iterate effects in a stable order
         order = ['reverse','speed','stutter','earrape','chorus','vibrato','sus','invert','mirror','dance','rainbow','explosion','frame_shuffle','meme','random_sound']
@@ -70,73 +300,691 @@ class YTPEngine(object):
                 continue
             enabled = cfg.get('enabled', False)
             prob = float(cfg.get('prob', 1.0)) if 'prob' in cfg else 1.0
-            if enabled and random.random() <= prob:
-                # dispatch
-                try:
-                    if eff == 'reverse':
-                        cur = self._reverse(cur)
-                    elif eff == 'speed':
-                        cur = self._change_speed(cur, cfg.get('level', 1.0))
-                    elif eff == 'stutter':
-                        cur = self._stutter(cur, cfg.get('level', 2))
-                    elif eff == 'earrape':
-                        cur = self._earrape(cur, cfg.get('level', 16.0))
-                    elif eff == 'chorus':
-                        cur = self._chorus(cur, cfg.get('level', 0.6))
-                    elif eff == 'vibrato':
-                        cur = self._vibrato(cur, cfg.get('level', 1.03))
-                    elif eff == 'sus':
-                        cur = self._sus_effect(cur, cfg.get('level', 1.1))
-                    elif eff == 'invert':
-                        cur = self._invert_colors(cur)
-                    elif eff == 'mirror':
-                        cur = self._mirror(cur)
-                    elif eff == 'dance':
-                        cur = self._dance_mode(cur)
-                    elif eff == 'rainbow':
-                        asset = cfg.get('asset') or self._pick_asset(['.png','.gif','.jpg'])
-                        if asset:
-                            cur = self._overlay_image(cur, asset, x=cfg.get('x',0), y=cfg.get('y',0), opacity=cfg.get('opacity',0.9))
-                    elif eff == 'explosion':
-                        asset = cfg.get('asset') or self._pick_asset(['.png','.gif','.jpg'])
-                        if asset:
-                            cur = self._explosion_spam(cur, asset, count=cfg.get('count',4))
-                    elif eff == 'frame_shuffle':
-                        cur = self._frame_shuffle(cur, cfg.get('level',8))
-                    elif eff == 'meme':
-                        img = cfg.get('image') or self._pick_asset(['.png','.jpg','.gif'])
-                        if img:
-                            cur = self._overlay_image(cur, img, x='(main_w-overlay_w)/2', y='(main_h-overlay_h)-10')
-                    elif eff == 'random_sound':
-                        audio = cfg.get('asset') or self._pick_asset(['.wav','.mp3','.ogg','.aac'])
-                        if audio:
-                            cur = self._add_random_sound(cur, audio, cfg.get('count',3))
-                except Exception as e:
-                    print("Effect", eff, "failed:", e)
-
-        # final encode with fallback
+            if not (enabled and random.random() <= prob):
+                continue
+            if eff == 'speed':
+                steps.append((eff, {'level': cfg.get('level', 1.0)}))
+            elif eff == 'stutter':
+                steps.append((eff, {'level': cfg.get('level', 2)}))
+            elif eff == 'earrape':
+                steps.append((eff, {'level': cfg.get('level', 16.0)}))
+            elif eff == 'chorus':
+                steps.append((eff, {'level': cfg.get('level', 0.6)}))
+            elif eff == 'vibrato':
+                steps.append((eff, {'level': cfg.get('level', 1.03), 'sample_rate': info.get('sample_rate')}))
+            elif eff == 'sus':
+                level = cfg.get('level', 1.1)
+                steps.append((eff, {'level': level, 'factors': self._sus_factors(level)}))
+            elif eff == 'rainbow':
+                asset = cfg.get('asset') or self._pick_asset(['.png','.gif','.jpg'])
+                if asset:
+                    steps.append((eff, {'asset': asset, 'x': cfg.get('x',0), 'y': cfg.get('y',0), 'opacity': cfg.get('opacity',0.9)}))
+            elif eff == 'explosion':
+                asset = cfg.get('asset') or self._pick_asset(['.png','.gif','.jpg'])
+                if asset:
+                    steps.append((eff, {'asset': asset, 'count': cfg.get('count',4)}))
+            elif eff == 'frame_shuffle':
+                steps.append((eff, {'level': cfg.get('level',8)}))
+            elif eff == 'meme':
+                img = cfg.get('image') or self._pick_asset(['.png','.jpg','.gif'])
+                if img:
+                    steps.append((eff, {'asset': img, 'x': '(main_w-overlay_w)/2', 'y': '(main_h-overlay_h)-10'}))
+            elif eff == 'random_sound':
+                count = int(cfg.get('count',3))
+                if cfg.get('asset'):
+                    audio = [cfg['asset']]
+                else:
+                    # a fresh pick for every instance when nothing was chosen
+                    audio = [a for a in (self._pick_asset(['.wav','.mp3','.ogg','.aac']) for i in range(count)) if a]
+                if audio:
+                    steps.append((eff, {'asset': audio, 'count': count}))
+            else:
+                steps.append((eff, {}))
+        return steps
+
+    def _draw(self, name, params, info, marks=None):
+        """params with the random decisions of step name filled in; cuts snap to marks."""
+        params = dict(params)
+        info = info or {}
+        dur = info.get('duration')
+        if name == 'sentence_mix' and 'starts' not in params:
+            d = dur or 6.0
+            parts = int(params.get('parts', 6))
+            params['piece_len'] = min(1.5, max(0.15, d / max(1, parts*2.0)))
+            last = max(0.0, d - params['piece_len'])
+            params['starts'] = [analysis.snap(random.uniform(0, last), marks, 0, last) for i in range(parts)]
+        elif name == 'stutter' and 'start' not in params:
+            seg_len = max(0.05, min(0.6, 0.1 * float(params.get('level', 2))))
+            last = max(0.0, (dur or 3.0) - seg_len)
+            params['start'] = analysis.snap(random.uniform(0, last), marks, 0, last)
+        elif name == 'explosion' and 'spots' not in params:
+            d = dur or 5.0
+            spots = []
+            for i in range(int(params.get('count', 4))):
+                t = random.uniform(0, max(0.0, d-0.6))
+                x = random.randint(0, 200); y = random.randint(0, 200)
+                spots.append([x, y, t, min(t+0.6, d)])
+            params['spots'] = spots
+        elif name == 'frame_shuffle' and 'perm' not in params:
+            fps = info.get('fps') or 25.0
+            total = int((dur or 0) * fps) or None
+            n = max(2, int(params.get('level', 8)))
+            if total:
+                n = min(n, total)
+            perm = list(range(n)); random.shuffle(perm)
+            params['perm'] = perm
+            params['start'] = random.randint(0, max(0, total - n)) if total else 0
+            params['total'] = total
+        elif name == 'random_sound' and 'times' not in params:
+            d = dur or 6.0
+            params['times'] = [random.uniform(0, max(0.0, d-0.5)) for i in range(int(params.get('count', 3)))]
+        return params
+
+    def plan(self, input_video, options):
+        """Roll the effects and draw every random value into a RenderPlan."""
+        seed = options.get('seed')
+        info = self.probe.probe(input_video)
+        steps = []
+        cur = info
+        marks = self.analysis.marks(input_video) if analysis.wanted(options) else None
+        with _rng_lock:
+            if seed is not None:
+                random.seed(seed)
+            for name, params in self._plan_steps(options, info):
+                params = self._draw(name, params, cur, marks)
+                steps.append((name, params))
+                marks = analysis.follow(marks, name, params, cur)
+                cur = probe.apply_effect(cur, name, params)
+        settings = dict((k, options[k]) for k in renderplan.EXEC_OPTIONS if k in options)
+        try:
+            size = os.path.getsize(input_video)
+        except OSError:
+            size = None
+        return renderplan.RenderPlan(input_video, steps, info, seed, settings, size)
+
+    def _apply_step(self, cur, eff, params):
+        """Run one step through its own ffmpeg invocation(s)."""
+        if eff == 'sentence_mix':
+            return self._sentence_mix(cur, params)
+        elif eff == 'mode_2009':
+            return self._mode_2009(cur, params.get('overlay'))
+        elif eff == 'mode_2012':
+            return self._mode_2012(cur, {})
+        elif eff == 'reverse':
+            return self._reverse(cur)
+        elif eff == 'speed':
+            return self._change_speed(cur, params.get('level', 1.0))
+        elif eff == 'stutter':
+            return self._stutter(cur, params.get('level', 2), params.get('start'))
+        elif eff == 'earrape':
+            return self._earrape(cur, params.get('level', 16.0))
+        elif eff == 'chorus':
+            return self._chorus(cur, params.get('level', 0.6))
+        elif eff == 'vibrato':
+            return self._vibrato(cur, params.get('level', 1.03), params.get('sample_rate'))
+        elif eff == 'sus':
+            return self._sus_effect(cur, params.get('level', 1.1), factors=params.get('factors'))
+        elif eff == 'invert':
+            return self._invert_colors(cur)
+        elif eff == 'mirror':
+            return self._mirror(cur)
+        elif eff == 'dance':
+            return self._dance_mode(cur)
+        elif eff == 'rainbow':
+            return self._overlay_image(cur, params['asset'], x=params.get('x',0), y=params.get('y',0), opacity=params.get('opacity',0.9))
+        elif eff == 'explosion':
+            return self._explosion_spam(cur, params['asset'], count=params.get('count',4), spots=params.get('spots'))
+        elif eff == 'frame_shuffle':
+            return self._frame_shuffle(cur, params.get('level',8), params if 'perm' in params else None)
+        elif eff == 'meme':
+            return self._overlay_image(cur, params['asset'], x=params.get('x',0), y=params.get('y',0))
+        elif eff == 'random_sound':
+            return self._add_random_sound(cur, params['asset'], params.get('count',3), params.get('times'))
+        return cur
+
+    def _long_reverse(self, name, info):
+        """True when name reverses a clip long enough to be chunked."""
+        if name != 'reverse' or not self.reverse_chunk or not info:
+            return False
+        return (info.get('duration') or 0) > 1.5 * float(self.reverse_chunk)
+
+    def _group_steps(self, steps, fuse=True, split=False, info=None):
+        """Split steps into ('fused', [steps]) and ('single', [step]) runs."""
+        groups = []
+        for step in steps:
+            fusable = step[0] in filtergraph.FUSABLE and not self._long_reverse(step[0], info)
+            info = probe.apply_effect(info, step[0], step[1])
+            if (fuse or split) and fusable:
+                if fuse and groups and groups[-1][0] == 'fused':
+                    groups[-1][1].append(step)
+                else:
+                    groups.append(('fused', [step]))
+            else:
+                groups.append(('single', [step]))
+        return groups
+
+    def _stage_groups(self, groups, streaming=False):
+        """Split groups into stages, each writing one file."""
+        stages = []
+        for group in groups:
+            if (streaming and stages and group[0] == 'fused' and stages[-1][-1][0] == 'fused'
+                    and not pipeline.needs_file(group[1])):
+                stages[-1].append(group)
+            else:
+                stages.append([group])
+        return stages
+
+    def _run_fused(self, input_path, steps, out=None, final=False):
+        """Render a run of fusable steps in one ffmpeg; None on failure."""
+        graph = filtergraph.compile_steps(steps, self.caps)
+        if graph.is_empty():
+            return input_path
+        out = out or self._tmp_media()
+        video, audio = bool(graph.video), bool(graph.audio)
+        if final:
+            attempts = self._final_attempts(self._final_args(input_path, video, audio))
+        elif self.caps.known:
+            attempts = [self._enc(video, audio)]
+        else:
+            attempts = [self._enc(video, audio), self._enc(video, audio, fallback=True)]
+        for i, codec_args in enumerate(attempts):
+            cmd, script = filtergraph.build_command(self.ffmpeg, input_path, graph, out, codec_args)
+            try:
+                with tracing.fallback(i > 0):
+                    if run_command(cmd):
+                        return out
+            finally:
+                rm_f(script)
+        return None
+
+    def _run_streamed(self, input_path, runs, out=None, final=False):
+        """Render several fused runs as piped ffmpeg processes; None on failure."""
+        graphs = [g for g in (filtergraph.compile_steps(r, self.caps) for r in runs) if not g.is_empty()]
+        if not graphs:
+            return input_path
+        out = out or self._tmp_media()
+        cmds, scripts = [], []
+        try:
+            src = input_path
+            for i, graph in enumerate(graphs):
+                video, audio = bool(graph.video), bool(graph.audio)
+                if i < len(graphs) - 1:
+                    dst, codec_args = pipeline.PIPE_OUT, pipeline.pipe_codec_args(video, audio)
+                elif final:
+                    dst, codec_args = out, sum(self._final_codecs(), [])
+                else:
+                    dst, codec_args = out, self._enc(video, audio)
+                cmd, script = filtergraph.build_command(self.ffmpeg, src, graph, dst, codec_args)
+                cmds.append(cmd); scripts.append(script)
+                src = pipeline.PIPE_IN
+            if pipeline.run_pipeline(cmds):
+                return out
+            return None
+        finally:
+            for script in scripts:
+                rm_f(script)
+
+    def _segment_count(self, info):
+        if not self.segments or int(self.segments) < 2:
+            return 0
+        n = min(int(self.segments), int((info.get('duration') or 0) / MIN_SEGMENT_SECONDS))
+        return n if n > 1 else 0
+
+    def _run_segmented(self, input_path, steps, out=None, final=False):
+        """Render frame-local steps on keyframe chunks of the video at once; None on failure."""
+        info = self.probe.probe(input_path)
+        n = self._segment_count(info)
+        if not n or info.get('has_video') is False or (final and not self.caps.known):
+            return None
+        seg_dir = temp_dirname('ytp_seg_')
+        scripts = []
+        try:
+            times = ','.join('%.3f' % (info['duration'] * i / n) for i in range(1, n))
+            pattern = os.path.join(seg_dir, 'in%03d' + (os.path.splitext(input_path)[1] or '.mkv'))
+            if not run_command([self.ffmpeg, '-y', '-i', input_path, '-map', '0:v:0', '-c', 'copy', '-f', 'segment',
+                                '-segment_times', times, '-reset_timestamps', '1', pattern]):
+                return None
+            pieces = sorted(f for f in os.listdir(seg_dir) if f.startswith('in'))
+            if len(pieces) < 2:
+                # too few keyframes to cut at
+                return None
+            print("Segmented render: %d pieces" % len(pieces))
+            vargs = self._final_codecs()[0] if final else self._profile()['video']
+            ext = '.mkv' if final else self._profile()['ext']
+            # the pieces split this job's thread budget between them
+            threads = str(max(1, (utils.FFMPEG_THREADS or multiprocessing.cpu_count()) // len(pieces)))
+            graph = filtergraph.compile_steps(steps, self.caps)
+            cmds, outs = [], []
+            for i, name in enumerate(pieces):
+                outs.append(os.path.join(seg_dir, 'out%03d%s' % (i, ext)))
+                cmd, script = filtergraph.build_command(self.ffmpeg, os.path.join(seg_dir, name), graph, outs[-1],
+                                                        vargs + ['-threads', threads])
+                cmds.append(cmd); scripts.append(script)
+            if not run_parallel(cmds):
+                return None
+            listf = os.path.join(seg_dir, 'list.txt')
+            with open(listf, 'w') as f:
+                for o in outs:
+                    f.write("file '%s'\n" % o.replace("'", "'\\''"))
+            # the final audio args: vargs are the video half of _final_args
+            aargs = self._final_args(input_path, audio=False)[len(vargs):] if final else ['-c:a', 'copy']
+            out = out or self._tmp_media()
+            cmd = [self.ffmpeg, '-y', '-f', 'concat', '-safe', '0', '-i', listf, '-i', input_path,
+                   '-map', '0:v', '-map', '1:a?', '-c:v', 'copy'] + aargs + [out]
+            return out if run_command(cmd) else None
+        finally:
+            for script in scripts:
+                rm_f(script)
+            rm_f(seg_dir)
+
+    def _track(self, prev, cur, info, steps):
+        """Derive cur's metadata from prev's and remember it in the probe cache."""
+        if cur == prev:
+            return info
+        info = probe.apply_effects(info, steps)
+        self.probe.remember(cur, info)
+        return info
+
+    def _render_stage(self, cur, stage, out=None, final=False):
+        """Render one stage; (path, wrote_final)."""
+        if len(stage) > 1:
+            res = self._run_streamed(cur, [g[1] for g in stage], out=out, final=final)
+            if res is not None:
+                return res, final
+            print("Streamed pipeline failed, rendering its stages one at a time")
+            done = False
+            for i, group in enumerate(stage):
+                tail = i == len(stage) - 1
+                cur, done = self._render_stage(cur, [group], out=out if tail else None, final=final and tail)
+            return cur, done
+        kind, steps = stage[0]
+        if self.segments and filtergraph.frame_local(steps):
+            res = self._run_segmented(cur, steps, out=out, final=final)
+            if res is not None:
+                return res, final
+        if kind == 'fused':
+            res = self._run_fused(cur, steps, out=out, final=final)
+            if res is not None:
+                return res, final and res == out
+            print("Fused filtergraph failed, falling back to per-effect rendering")
+        for eff, params in steps:
+            try:
+                # the unit's own stage already covers a lone effect
+                with tracing.stage(eff if len(steps) > 1 else None), tracing.fallback(kind == 'fused'):
+                    cur = self._apply_step(cur, eff, params)
+            except JobCancelled:
+                raise
+            except Exception as e:
+                print("Effect", eff, "failed:", e)
+        return cur, False
+
+    def _units(self, stages, info):
+        """Group stages into cached units: (lane, stages)."""
+        units = []
+        for stage in stages:
+            lane = stage_lane(stage)
+            if lane and info.get('has_' + lane) is not False and units and units[-1][0] == lane:
+                units[-1][1].append(stage)
+            else:
+                units.append((lane, [stage]))
+        return [u if len(u[1]) > 1 or self._numpy_lane(u) else (None, u[1]) for u in units]
+
+    def _numpy_lane(self, unit):
+        """True when an audio unit will run on the NumPy backend."""
+        if unit[0] != 'audio' or self.audio_backend != 'numpy' or not audiodsp.available():
+            return False
+        return all(name in audiodsp.SUPPORTED for stage in unit[1] for g in stage for name, _ in g[1])
+
+    def _numpy_audio(self, cur, unit, info):
+        """Run an audio unit on the decoded samples into one WAV; None on failure."""
+        sr = info.get('sample_rate') or 44100
+        ch = info.get('channels') or 2
+        wav = temp_filename_for('.wav')
+        try:
+            x = audiodsp.decode(self.ffmpeg, cur, sr, ch)
+            for stage in unit[1]:
+                for g in stage:
+                    for name, params in g[1]:
+                        x = audiodsp.apply_step(self.ffmpeg, x, sr, name, params)
+            return audiodsp.encode_wav(self.ffmpeg, x, sr, wav)
+        except JobCancelled:
+            rm_f(wav)
+            raise
+        except Exception as e:
+            print("NumPy audio backend failed, using ffmpeg filters:", e)
+            rm_f(wav)
+            return None
+
+    def _render_unit(self, cur, unit, info):
+        """Render a unit; a lane unit is split out once and remuxed once."""
+        lane, stages = unit
+        if lane is None:
+            return self._render_stage(cur, stages[0])[0]
+        if self._numpy_lane(unit):
+            lane_file = self._numpy_audio(cur, unit, info)
+            if lane_file:
+                out = self._tmp_media()
+                cmd = [self.ffmpeg, '-y', '-i', cur, '-i', lane_file, '-map', '0:v?', '-map', '1:a']
+                ok = self._run_encode(cmd, out, video=False)
+                rm_f(lane_file)
+                return out if ok else cur
+        prev_profile = self.intermediate
+        arena = scratch()
+        lane_file = temp_filename_for('.wav') if lane == 'audio' else self._tmp_media()
+        if lane == 'audio':
+            ok = run_command([self.ffmpeg, '-y', '-i', cur, '-vn', '-c:a', 'pcm_s16le', lane_file])
+        else:
+            ok = run_command([self.ffmpeg, '-y', '-i', cur, '-an', '-c:v', 'copy', lane_file])
+        if not ok:
+            rm_f(lane_file)
+            for stage in stages:
+                cur = self._render_stage(cur, stage)[0]
+            return cur
+        linfo = dict(info)
+        linfo['has_video' if lane == 'audio' else 'has_audio'] = False
+        self.probe.remember(lane_file, linfo)
+        if lane == 'audio':
+            self.intermediate = 'pcm_wav'
+        try:
+            for stage in stages:
+                prev = lane_file
+                lane_file = self._render_stage(lane_file, stage)[0]
+                linfo = self._track(prev, lane_file, linfo, [s for g in stage for s in g[1]])
+                if arena is not None and lane_file != prev:
+                    # the lane's own intermediates have one reader, the next stage
+                    arena.release(prev)
+        finally:
+            self.intermediate = prev_profile
+        out = self._tmp_media()
+        if lane == 'audio':
+            cmd = [self.ffmpeg, '-y', '-i', cur, '-i', lane_file, '-map', '0:v?', '-map', '1:a']
+            ok = self._run_encode(cmd, out, video=False)
+        else:
+            cmd = [self.ffmpeg, '-y', '-i', lane_file, '-i', cur, '-map', '0:v', '-map', '1:a?']
+            ok = self._run_encode(cmd, out, video=False, audio=False)
+        return out if ok else cur
+
+    def _cached_unit(self, cur, parent_key, unit, info):
+        """Render a unit through the stage cache; (path, key or None)."""
+        steps = [s for stage in unit[1] for g in stage for s in g[1]]
+        if self.stage_cache is None or parent_key is None:
+            return self._render_unit(cur, unit, info), None
+        # the steps come from a plan with every random value drawn, so they
+        # describe the output completely
+        extra = {'ffmpeg': self.ffmpeg_version(), 'profile': self.intermediate, 'lane': unit[0],
+                 'numpy': self._numpy_lane(unit),
+                 'stages': [[g[0] for g in stage] for stage in unit[1]]}
+        key = stagecache.stage_key(parent_key, steps, extra)
+        path, meta = self.stage_cache.get(key)
+        if path:
+            return path, key
+        res = self._render_unit(cur, unit, info)
+        if res == cur or not os.path.exists(res) or os.path.getsize(res) == 0:
+            return res, None
+        return self.stage_cache.put(key, res), key
+
+    def generate(self, input_video, output_path, options, progress=None, events=None, checkpoint=None):
+        """Plan (or replay the "plan" option) and render input_video into output_path."""
+        if options.get('plan'):
+            plan = renderplan.coerce(options['plan'])
+            if input_video:
+                plan.check_input(input_video)
+                plan.input_path = input_video
+        else:
+            plan = self.plan(input_video, options)
+        if options.get('plan_out'):
+            plan.save(options['plan_out'])
+        return self.render_plan(plan, output_path, proxy=options.get('proxy'), progress=progress,
+                                events=events, trace=options.get('trace'), checkpoint=checkpoint)
+
+    def render_plan(self, plan, output_path, proxy=None, progress=None, events=None, trace=None,
+                    checkpoint=None):
+        """Execute a RenderPlan into output_path (see generate for the options)."""
+        tracer = None
+        if events or trace:
+            tracer = tracing.Tracer(events)
+            prev_tracer = tracing.set_tracer(tracer)
+        settings = plan.settings
+        prev = self.intermediate, self.audio_backend, self.segments, self.reverse_chunk
+        self.intermediate = settings.get('intermediate') or self.intermediate
+        self.audio_backend = settings.get('audio_backend') or self.audio_backend
+        self.segments = settings.get('segments', self.segments)
+        self.reverse_chunk = settings.get('reverse_chunk', self.reverse_chunk)
+        base, ext = os.path.splitext(output_path)
+        part = base + '.part' + ext
+        proxy_input = None
+        arena = ScratchArena(self.scratch_dir, self.scratch_quota, self.scratch_ram)
+        prev_arena = set_scratch(arena)
+        try:
+            with tracing.stage('generate'):
+                cur, steps = plan.input_path, plan.steps
+                factor = 1.0
+                if proxy:
+                    with tracing.stage('proxy'):
+                        proxy_input, factor = self._proxy_input(cur, int(proxy))
+                    if proxy_input:
+                        cur, steps = proxy_input, renderplan.scale_steps(steps, factor)
+                with tracing.stage('assets'):
+                    steps = self._ready_assets(steps, self.probe.probe(cur), factor)
+                self._generate(cur, part, steps, settings, progress, checkpoint)
+            replace_file(part, output_path)
+            return output_path
+        except BaseException:
+            rm_f(part)
+            raise
+        finally:
+            if proxy_input:
+                rm_f(proxy_input)
+            set_scratch(prev_arena)
+            arena.close()
+            self.last_scratch = arena.stats()
+            print("Scratch: peak %.1f MB (%s), %d files" % (arena.peak_bytes / 1048576.0, arena.peak_stage, arena.created))
+            self.intermediate, self.audio_backend, self.segments, self.reverse_chunk = prev
+            if tracer is not None:
+                tracing.set_tracer(prev_tracer)
+                if trace:
+                    tracer.save(trace)
+
+    def _ready_assets(self, steps, info, factor=1.0):
+        """steps with their assets swapped for render-ready variants (see assetindex.py)."""
+        # assets do not depend on each other: probe them all at once, then
+        # make the missing variants at once, then swap them in
+        paths = []
+        for _, params in steps:
+            for k in ('asset', 'overlay'):
+                v = params.get(k)
+                paths.extend(v if isinstance(v, (list, tuple)) else [v])
+        self.assets.prefetch(paths)
+        pending = {}
+        self._asset_variants(steps, info, factor, pending)
+        self.assets.make(pending)
+        return self._asset_variants(steps, info, factor)
+
+    def _asset_variants(self, steps, info, factor=1.0, pending=None):
+        """One pass of _ready_assets; with pending, missing variants are only collected."""
+        out = []
+        for (name, params), scale in zip(steps, renderplan.step_scales(steps, factor)):
+            params = dict(params)
+            if name in ('rainbow', 'meme', 'explosion') and params.get('asset'):
+                opacity = params.get('opacity', 1.0) if name == 'rainbow' else 1.0
+                ready = self.assets.overlay(params['asset'], scale, opacity, pending)
+                if ready != params['asset']:
+                    params['asset'] = ready
+                    if name == 'rainbow':
+                        params['opacity'] = 1.0
+            elif name == 'mode_2009' and params.get('overlay'):
+                # drawn after the 640-wide scale, so never proxy-scaled
+                params['overlay'] = self.assets.overlay(params['overlay'], pending=pending)
+            elif name == 'random_sound' and params.get('asset'):
+                assets = params['asset'] if isinstance(params['asset'], (list, tuple)) else [params['asset']]
+                params['asset'] = [self.assets.sound(a, info.get('sample_rate'), pending=pending) for a in assets]
+            out.append((name, params))
+        return out
+
+    def _proxy_input(self, input_path, width):
+        """(copy of input_path scaled to width, factor), or (None, 1.0)."""
+        info = self.probe.probe(input_path)
+        if not info.get('width') or info['width'] <= width:
+            return None, 1.0
+        out = self._tmp_media()
+        vf = 'scale=%d:-2' % (width - width % 2)
+        if not self._run_encode([self.ffmpeg, '-y', '-i', input_path, '-vf', vf], out, audio=False):
+            rm_f(out)
+            return None, 1.0
+        factor = float(width - width % 2) / info['width']
+        self.probe.remember(out, dict(info, width=width - width % 2,
+                                      height=probe._even(info['height'] * factor) if info.get('height') else None,
+                                      video_codec=None, video_profile=None, pix_fmt=None))
+        return out, factor
+
+    def _generate(self, input_video, output_path, steps, settings, progress=None, checkpoint=None):
+        cur = input_video
         out = output_path
-        final_cmd = [self.ffmpeg, '-y', '-i', cur, '-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'aac', '-b:a', '192k', out]
-        if not run_command(final_cmd):
-            final_cmd2 = [self.ffmpeg, '-y', '-i', cur, '-c:v', 'mpeg4', '-qscale:v', '5', '-c:a', 'libmp3lame', '-b:a', '192k', out]
-            run_command(final_cmd2)
+        fuse = settings.get('fuse_filters', True)
+        streaming = settings.get('streaming', False)
+        # streaming gives every effect its own process so the stages overlap on
+        # separate cores; the pipes carry raw frames, so no extra encodes
+        # metadata is probed once and then carried through the chain, so
+        # stages that need the duration never spawn another probe
+        info = self.probe.probe(cur)
+        groups = self._group_steps(steps, fuse=fuse and not streaming, split=streaming, info=info)
+        stages = self._stage_groups(groups, streaming)
+        # stage outputs are addressed by the input's content plus every stage
+        # before them, so a re-render only redoes stages after the first change
+        key = None
+        if self.stage_cache is not None and settings.get('stage_cache', True):
+            key = stagecache.file_digest(cur)
+        units = self._units(stages, info)
+        start = 0
+        if checkpoint is not None:
+            start, saved = checkpoint.resume(len(units))
+            if start:
+                print("Resuming after stage %d/%d from %s" % (start, len(units), saved))
+                cur, info = saved, self.probe.probe(saved)
+                if key is not None:
+                    key = stagecache.file_digest(cur)
+        arena = scratch()
+        done = False
+        for ui, unit in enumerate(units):
+            if ui < start:
+                continue
+            prev = cur
+            steps = [s for stage in unit[1] for g in stage for s in g[1]]
+            label = ', '.join(name for name, _ in steps)
+            if progress:
+                progress(ui, len(units) + 1, label)
+            if arena is not None:
+                arena.stage, mark = label, arena.mark()
+            with tracing.stage(label):
+                if ui == len(units) - 1 and unit[0] is None and unit[1][0][-1][0] == 'fused':
+                    # a trailing graph encodes straight into the output file
+                    cur, done = self._render_stage(cur, unit[1][0], out=out, final=True)
+                else:
+                    cur, key = self._cached_unit(cur, key, unit, info)
+            info = self._track(prev, cur, info, steps)
+            if arena is not None:
+                # what the unit made besides its result, and its input, have
+                # no consumer left
+                arena.sweep(mark, keep=[cur])
+                if cur != prev:
+                    arena.release(prev)
+            if checkpoint is not None and not done and cur != input_video:
+                checkpoint.save(ui + 1, len(units), cur)
+
+        if not done:
+            if arena is not None:
+                arena.stage = 'final encode'
+            if progress:
+                progress(len(units), len(units) + 1, 'final encode')
+            with tracing.stage('final encode'):
+                ok = self._final_encode(cur, out)
+            if not ok:
+                raise RuntimeError("Final encode failed: %s" % out)
+        if progress:
+            progress(len(units) + 1, len(units) + 1, 'done')
         return out
 
     # Auto generate
-    def auto_generate(self, input_video, out_dir, base_options, count=3, beta_key=None):
+    def _render_variant(self, input_video, out, base_options, seed, progress=None, journal=None):
+        # every random draw of a variant comes from its own seed, so any
+        # variant can be re-rendered on its own
+        opts, plan = journal.plan() if journal is not None else (None, None)
+        if plan:
+            plan = renderplan.coerce(plan)
+        else:
+            with _rng_lock:
+                random.seed(seed)
+                opts = self._randomize_options(base_options)
+                plan = self.plan(input_video, opts)
+            if journal is not None:
+                journal.start(seed, out, opts, plan.to_dict())
+        out = self.generate(input_video, out, dict(opts, plan=plan), progress, checkpoint=journal)
+        if journal is not None:
+            journal.complete()
+        return out
+
+    def auto_generate(self, input_video, out_dir, base_options, count=3, beta_key=None,
+                      parallel=False, jobs=None, threads=None, seed=None, callback=None, progress=None):
+        """Render count randomized variants into out_dir, resuming an interrupted batch."""
         b = beta_key or read_beta_key_from_file()
         if not b or not is_valid_beta_key(b):
             raise EnvironmentError("Auto-generate requires valid legacy beta key.")
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
-        outs = []
+        batch = journal.BatchJournal(out_dir)
+        seed = batch.open(input_video, base_options, seed)
+        tasks, finished = [], {}
         for i in range(1, int(count)+1):
-            opts = self._randomize_options(base_options)
             o = os.path.join(out_dir, 'ytp_auto_%03d.mp4' % i)
-            print("Auto-gen:", o)
-            self.generate(input_video, o, opts)
-            outs.append(o)
-        return outs
+            if batch.variant(i).done():
+                print("Auto-gen:", o, "already rendered")
+                finished[i] = o
+                if callback:
+                    callback(i, o)
+                continue
+            tasks.append((i, input_video, o, base_options, seed + i, batch.dir))
+        if not tasks:
+            batch.close()
+            return [finished[i] for i in sorted(finished)]
+
+        if not parallel:
+            for i, inp, o, opts, s, _ in tasks:
+                print("Auto-gen:", o, "(seed %d)" % s)
+                report = None
+                if progress:
+                    report = lambda d, t, label, i=i: progress(i, d, t, label)
+                self._render_variant(inp, o, opts, s, report, journal=batch.variant(i))
+                finished[i] = o
+                if callback:
+                    callback(i, o)
+            batch.close()
+            return [finished[i] for i in sorted(finished)]
+
+        if analysis.wanted(base_options):
+            # once here rather than in every worker at the same time
+            self.analysis.get(input_video)
+        jobs, per_job = thread_budget(len(tasks), jobs, threads)
+        print("Auto-gen: %d variants, %d jobs x %d threads" % (len(tasks), jobs, per_job))
+        done = dict(finished)
+        pool = multiprocessing.Pool(jobs, initializer=_pool_init, initargs=(self._init_kwargs, per_job))
+        try:
+            for i, o, s, err in pool.imap_unordered(_pool_render, tasks):
+                if err:
+                    print("Auto-gen: variant %d (seed %d) failed: %s" % (i, s, err))
+                    continue
+                print("Auto-gen:", o, "(seed %d)" % s)
+                done[i] = o
+                if callback:
+                    callback(i, o)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        if len(done) == len(finished) + len(tasks):
+            batch.close()
+        return [done[i] for i in sorted(done)]
 
     def preview(self, output_file):
         if self.ffplay:
@@ -148,32 +996,31 @@ class YTPEngine(object):
         tmp = temp_filename_for('.mp4')
         try:
             vf = "scale=480:-2,format=yuv420p,eq=contrast=1.05:brightness=0.01:saturation=1.2"
-            cmd = [self.ffmpeg, '-y', '-t', str(seconds), '-i', input_path, '-vf', vf, '-c:v', 'libx264', '-preset', 'ultrafast', tmp]
-            if not run_command(cmd):
-                cmd2 = [self.ffmpeg, '-y', '-t', str(seconds), '-i', input_path, '-vf', vf, '-c:v', 'mpeg4', '-qscale:v', '6', tmp]
-                run_command(cmd2)
+            cmd = [self.ffmpeg, '-y', '-t', str(seconds), '-i', input_path, '-vf', vf]
+            x264 = ['-c:v', 'libx264', '-preset', 'ultrafast']
+            mpeg4 = ['-c:v', 'mpeg4', '-qscale:v', '6']
+            codec = x264 if self.caps.has_encoder('libx264') else mpeg4
+            # only a build with unknown encoders gets a second try
+            if not run_command(cmd + codec + [tmp]) and not self.caps.known and codec is x264:
+                run_command(cmd + mpeg4 + [tmp])
             self.preview(tmp)
         finally:
             rm_f(tmp)
 
     # ---------------- Effect implementations ----------------
     def _sentence_mix(self, input_path, cfg):
-        dur = self._probe_duration(input_path) or 6.0
-        parts = int(cfg.get('parts', 6))
-        piece_len = min(1.5, max(0.15, dur / max(1, parts*2.0)))
-        clips = []
-        for i in range(parts):
-            start = random.uniform(0, max(0.0, dur - piece_len))
-            out = temp_filename_for('.mp4')
-            cmd = [self.ffmpeg, '-y', '-ss', str(start), '-t', str(piece_len), '-i', input_path, '-c', 'copy', out]
-            run_command(cmd)
-            clips.append(out)
+        cfg = self._draw('sentence_mix', cfg, self.probe.probe(input_path))
+        piece_len = cfg['piece_len']
+        clips = [self._tmp_media() for start in cfg['starts']]
+        # the pieces are cut independently, so at once
+        run_many([[self.ffmpeg, '-y', '-ss', str(start), '-t', str(piece_len), '-i', input_path, '-c', 'copy', out]
+                  for start, out in zip(cfg['starts'], clips)])
         concat = temp_filename_for('.txt')
         try:
             with open(concat, 'w') as f:
                 for c in clips:
                     f.write("file '%s'\n" % c.replace("'", "'\\''"))
-            out_all = temp_filename_for('.mp4')
+            out_all = self._tmp_media()
             cmd = [self.ffmpeg, '-y', '-f', 'concat', '-safe', '0', '-i', concat, '-c', 'copy', out_all]
             run_command(cmd)
         finally:
@@ -183,46 +1030,74 @@ class YTPEngine(object):
         return out_all
 
     def _reverse(self, input_path):
-        out = temp_filename_for('.mp4')
-        cmd = [self.ffmpeg, '-y', '-i', input_path, '-vf', 'reverse', '-af', 'areverse', out]
-        if not run_command(cmd):
+        info = self.probe.probe(input_path)
+        if self._long_reverse('reverse', info):
+            res = self._reverse_chunked(input_path, info)
+            if res is not None:
+                return res
+            print("Chunked reverse failed, reversing in one piece")
+        out = self._tmp_media()
+        if not self._run_encode([self.ffmpeg, '-y', '-i', input_path, '-vf', 'reverse', '-af', 'areverse'], out):
             return input_path
         return out
 
-    def _build_atempo_chain(self, factor):
+    def _reverse_chunked(self, input_path, info):
+        """Reverse input_path in reverse_chunk-second pieces; None on failure."""
+        dur = info['duration']
+        fps = info.get('fps') or 25.0
+        step = max(1, int(round(float(self.reverse_chunk) * fps)))
+        bounds = [0.0]
+        k = step
+        while (k + step / 2.0) / fps < dur:
+            bounds.append((k - 0.5) / fps)
+            k += step
+        bounds.append(None)
+        video, audio = info.get('has_video') is not False, info.get('has_audio') is not False
+        work = temp_dirname('ytp_rev_')
         try:
-            f = float(factor)
-        except Exception:
-            f = 1.0
-        if f == 1.0:
-            return 'anull'
-        parts = []
-        rem = f
-        while rem > 2.0:
-            parts.append('atempo=2.0'); rem /= 2.0
-        while rem < 0.5:
-            parts.append('atempo=0.5'); rem /= 0.5
-        parts.append('atempo=%s' % rem)
-        return ','.join(parts)
+            ext = self._profile()['ext']
+            at_once = max(1, int(self.segments or 1))
+            threads = str(max(1, (utils.FFMPEG_THREADS or multiprocessing.cpu_count()) // at_once))
+            cmds, outs = [], []
+            for i in range(len(bounds) - 1):
+                t0, t1 = bounds[i], bounds[i + 1]
+                # seek fast to a second before the chunk; trim makes the exact cut
+                # on timestamps that now start at the seek point
+                seek = max(0.0, t0 - 1.0)
+                span = 'start=%.6f' % (t0 - seek) + (':end=%.6f' % (t1 - seek) if t1 is not None else '')
+                cmd = [self.ffmpeg, '-y'] + (['-ss', '%.6f' % seek] if seek else []) + ['-i', input_path]
+                if video:
+                    cmd += ['-vf', 'trim=%s,setpts=PTS-STARTPTS,reverse' % span]
+                if audio:
+                    cmd += ['-af', 'atrim=%s,asetpts=PTS-STARTPTS,areverse' % span]
+                outs.append(os.path.join(work, 'rev%04d%s' % (i, ext)))
+                cmds.append(cmd + self._enc(video, audio) + ['-threads', threads, outs[-1]])
+            print("Chunked reverse: %d chunks, %d at a time" % (len(cmds), at_once))
+            for i in range(0, len(cmds), at_once):
+                if not run_parallel(cmds[i:i + at_once]):
+                    return None
+            listf = os.path.join(work, 'list.txt')
+            with open(listf, 'w') as f:
+                for o in reversed(outs):
+                    f.write("file '%s'\n" % o.replace("'", "'\\''"))
+            out = self._tmp_media()
+            if run_command([self.ffmpeg, '-y', '-f', 'concat', '-safe', '0', '-i', listf, '-c', 'copy', out]):
+                return out
+            return None
+        finally:
+            rm_f(work)
 
     def _change_speed(self, input_path, factor):
-        out = temp_filename_for('.mp4')
-        try:
-            f = float(factor)
-            if f <= 0: f = 1.0
-        except Exception:
-            f = 1.0
-        setpts = 'setpts=%s*PTS' % (1.0/f)
-        atempo = self._build_atempo_chain(f)
-        cmd = [self.ffmpeg, '-y', '-i', input_path, '-vf', setpts, '-af', atempo, out]
-        run_command(cmd)
+        out = self._tmp_media()
+        setpts, atempo = filtergraph.speed_filters(factor)
+        self._run_encode([self.ffmpeg, '-y', '-i', input_path, '-vf', setpts, '-af', atempo], out)
         return out
 
-    def _stutter(self, input_path, level=2):
-        dur = self._probe_duration(input_path) or 3.0
+    def _stutter(self, input_path, level=2, start=None):
         seg_len = max(0.05, min(0.6, 0.1 * float(level)))
-        start = random.uniform(0, max(0.0, dur - seg_len))
-        seg = temp_filename_for('.mp4')
+        if start is None:
+            start = self._draw('stutter', {'level': level}, self.probe.probe(input_path))['start']
+        seg = self._tmp_media()
         cmd = [self.ffmpeg, '-y', '-ss', str(start), '-t', str(seg_len), '-i', input_path, '-c', 'copy', seg]
         run_command(cmd)
         loops = 2 + int(level)
@@ -231,7 +1106,7 @@ class YTPEngine(object):
             with open(listf, 'w') as f:
                 for i in range(loops):
                     f.write("file '%s'\n" % seg.replace("'", "'\\''"))
-            out = temp_filename_for('.mp4')
+            out = self._tmp_media()
             cmd = [self.ffmpeg, '-y', '-f', 'concat', '-safe', '0', '-i', listf, '-c', 'copy', out]
             run_command(cmd)
         finally:
@@ -239,150 +1114,129 @@ class YTPEngine(object):
         return out
 
     def _earrape(self, input_path, gain=20.0):
-        out = temp_filename_for('.mp4')
-        try:
-            g = float(gain)
-        except Exception:
-            g = 20.0
-        cmd = [self.ffmpeg, '-y', '-i', input_path, '-af', 'volume=%sdB' % g, out]
-        run_command(cmd)
+        out = self._tmp_media()
+        self._run_encode([self.ffmpeg, '-y', '-i', input_path, '-af', filtergraph.earrape_filter(gain)], out, video=False)
         return out
 
     def _chorus(self, input_path, level=0.6):
-        out = temp_filename_for('.mp4')
-        try:
-            lev = float(level)
-        except Exception:
-            lev = 0.6
-        d1 = int(30 + 400*lev); d2 = int(90 + 500*lev)
-        decay1 = 0.4 + 0.3*lev; decay2 = 0.2 + 0.25*lev
-        aecho = "aecho=0.8:0.9:%d|%d:%.2f|%.2f" % (d1,d2,decay1,decay2)
-        cmd = [self.ffmpeg, '-y', '-i', input_path, '-af', aecho, out]
-        run_command(cmd)
+        out = self._tmp_media()
+        self._run_encode([self.ffmpeg, '-y', '-i', input_path, '-af', filtergraph.chorus_filter(level)], out, video=False)
         return out
 
-    def _vibrato(self, input_path, level=1.03):
-        out = temp_filename_for('.mp4')
-        try:
-            lev = float(level); 
-            if lev <= 0: lev = 1.03
-        except Exception:
-            lev = 1.03
-        asetrate = 'asetrate=44100*%f' % lev
-        atempo = self._build_atempo_chain(1.0/lev)
-        af = "%s,%s" % (asetrate, atempo)
-        cmd = [self.ffmpeg, '-y', '-i', input_path, '-af', af, '-c:v', 'copy', out]
-        run_command(cmd)
+    def _vibrato(self, input_path, level=1.03, sample_rate=None):
+        out = self._tmp_media()
+        sr = sample_rate or self.probe.probe(input_path).get('sample_rate')
+        self._run_encode([self.ffmpeg, '-y', '-i', input_path, '-af', filtergraph.vibrato_filter(level, sr)], out, video=False)
         return out
 
-    def _sus_effect(self, input_path, level=1.1):
+    def _sus_factors(self, level=1.1):
+        return [0.85 + random.random() * (float(level) + 0.3) for i in range(2)]
+
+    def _sus_effect(self, input_path, level=1.1, factors=None):
         cur = input_path
-        for i in range(2):
-            factor = 0.85 + random.random() * (level + 0.3)
+        for factor in (factors or self._sus_factors(level)):
             cur = self._change_speed(cur, factor)
         return cur
 
     def _invert_colors(self, input_path):
-        out = temp_filename_for('.mp4')
-        cmd = [self.ffmpeg, '-y', '-i', input_path, '-vf', 'negate', out]
-        if not run_command(cmd):
-            cmd2 = [self.ffmpeg, '-y', '-i', input_path, '-vf', "lutrgb='r=255-val:g=255-val:b=255-val'", out]
-            run_command(cmd2)
+        out = self._tmp_media()
+        vf = filtergraph.invert_filter(self.caps)
+        if not self._run_encode([self.ffmpeg, '-y', '-i', input_path, '-vf', vf], out, audio=False) and not self.caps.known:
+            self._run_encode([self.ffmpeg, '-y', '-i', input_path, '-vf', filtergraph.INVERT_LUT], out, audio=False)
         return out
 
     def _mirror(self, input_path):
-        out = temp_filename_for('.mp4')
-        cmd = [self.ffmpeg, '-y', '-i', input_path, '-vf', 'hflip', out]
-        if run_command(cmd):
+        out = self._tmp_media()
+        if self._run_encode([self.ffmpeg, '-y', '-i', input_path, '-vf', 'hflip'], out, audio=False):
             return out
         return input_path
 
     def _dance_mode(self, input_path):
-        out = temp_filename_for('.mp4')
+        out = self._tmp_media()
         # "Squidward" mode could be morph-like; we approximate with transpose + scale jitter
-        cmd = [self.ffmpeg, '-y', '-i', input_path, '-vf', 'transpose=1,scale=iw*0.95:ih*0.95', out]
-        if not run_command(cmd):
-            cmd2 = [self.ffmpeg, '-y', '-i', input_path, '-vf', 'scale=iw*0.95:ih*0.95', out]
-            run_command(cmd2)
+        vf = filtergraph.dance_filter(self.caps)
+        if not self._run_encode([self.ffmpeg, '-y', '-i', input_path, '-vf', vf], out, audio=False) and not self.caps.known:
+            self._run_encode([self.ffmpeg, '-y', '-i', input_path, '-vf', filtergraph.DANCE_SCALE], out, audio=False)
         return out
 
     def _overlay_image(self, input_path, image_path, x=0, y=0, opacity=1.0):
-        out = temp_filename_for('.mp4')
+        out = self._tmp_media()
         try:
             if float(opacity) >= 0.99:
-                cmd = [self.ffmpeg, '-y', '-i', input_path, '-i', image_path, '-filter_complex', 'overlay=%s:%s' % (x,y), out]
+                cmd = [self.ffmpeg, '-y', '-i', input_path, '-i', image_path, '-filter_complex', 'overlay=%s:%s' % (x,y)]
             else:
                 cmd = [self.ffmpeg, '-y', '-i', input_path, '-i', image_path,
-                       '-filter_complex', "[1]format=rgba,colorchannelmixer=aa=%f[ol];[0][ol]overlay=%s:%s" % (opacity, x, y), out]
-            run_command(cmd)
+                       '-filter_complex', "[1]format=rgba,colorchannelmixer=aa=%f[ol];[0][ol]overlay=%s:%s" % (opacity, x, y)]
+            self._run_encode(cmd, out, audio=False)
         except Exception:
-            cmd2 = [self.ffmpeg, '-y', '-i', input_path, '-i', image_path, '-filter_complex', 'overlay=0:0', out]
-            run_command(cmd2)
+            cmd2 = [self.ffmpeg, '-y', '-i', input_path, '-i', image_path, '-filter_complex', 'overlay=0:0']
+            self._run_encode(cmd2, out, audio=False)
         return out
 
-    def _explosion_spam(self, input_path, overlay_path, count=4):
-        current = input_path
-        dur = self._probe_duration(input_path) or 5.0
-        for i in range(int(count)):
-            t = random.uniform(0, max(0.0, dur-0.6))
-            x = random.randint(0, 200); y = random.randint(0, 200)
-            out = temp_filename_for('.mp4')
-            cmd = [self.ffmpeg, '-y', '-i', current, '-i', overlay_path,
-                   '-filter_complex', "overlay=%d:%d:enable='between(t,%.3f,%.3f)'" % (x,y,t,min(t+0.6,dur)),
-                   '-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'copy', out]
-            if not run_command(cmd):
-                cmd2 = [self.ffmpeg, '-y', '-i', current, '-i', overlay_path,
-                        '-filter_complex', "overlay=%d:%d:enable='between(t,%.3f,%.3f)'" % (x,y,t,min(t+0.6,dur)),
-                        '-c:v', 'mpeg4', '-qscale:v', '6', '-c:a', 'copy', out]
-                run_command(cmd2)
-            current = out
-        return current
-
-    def _frame_shuffle(self, input_path, level=8):
-        tmpdir = tempfile.mkdtemp(prefix='frames_')
+    def _explosion_spam(self, input_path, overlay_path, count=4, spots=None):
+        # all explosions go into one graph, so any count costs a single encode
+        if spots is None:
+            spots = self._draw('explosion', {'count': count}, self.probe.probe(input_path))['spots']
+        if not spots:
+            return input_path
+        out = self._tmp_media()
+        script = temp_filename_for('.txt')
         try:
-            pattern = os.path.join(tmpdir, 'frame_%05d.png')
-            if not run_command([self.ffmpeg, '-y', '-i', input_path, pattern]):
-                return input_path
-            frames = sorted([os.path.join(tmpdir,f) for f in os.listdir(tmpdir) if f.startswith('frame_')])
-            if not frames:
-                return input_path
-            num = min(len(frames), int(level))
-            idx = list(range(len(frames))); random.shuffle(idx); sel = idx[:num]
-            for i,j in enumerate(sel):
-                a = frames[i]; b = frames[j]
-                try:
-                    tmpname = a + '.swap'; os.rename(a, tmpname); os.rename(b, a); os.rename(tmpname, b)
-                except Exception:
-                    pass
-            out = temp_filename_for('.mp4')
-            cmd = [self.ffmpeg, '-y', '-framerate', '25', '-i', os.path.join(tmpdir, 'frame_%05d.png'),
-                   '-i', input_path, '-map', '0:v', '-map', '1:a?', '-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'copy', out]
-            if not run_command(cmd):
-                cmd2 = [self.ffmpeg, '-y', '-framerate', '25', '-i', os.path.join(tmpdir, 'frame_%05d.png'),
-                        '-i', input_path, '-map', '0:v', '-map', '1:a?', '-c:v', 'mpeg4', '-qscale:v', '6', '-c:a', 'copy', out]
-                run_command(cmd2)
-            return out
+            with open(script, 'w') as f:
+                f.write(filtergraph.explosion_graph(spots))
+            cmd = [self.ffmpeg, '-y', '-i', input_path, '-i', overlay_path,
+                   '-filter_complex_script', script, '-map', '[vout]', '-map', '0:a?']
+            if self._run_encode(cmd, out, audio=False):
+                return out
         finally:
-            try: shutil.rmtree(tmpdir)
-            except Exception: pass
+            rm_f(script)
+        return input_path
+
+    def _frame_shuffle(self, input_path, level=8, drawn=None):
+        # shuffle a window of `level` frames at a random spot in one pass; the
+        # source frame rate and timestamps are kept
+        info = self.probe.probe(input_path)
+        d = drawn or self._draw('frame_shuffle', {'level': level}, info)
+        # the plan drew the window on an estimated length; fit it to the real one
+        total = int((info.get('duration') or 0) * (info.get('fps') or 25.0)) or None
+        out = self._tmp_media()
+        cmd = [self.ffmpeg, '-y', '-i', input_path,
+               '-filter_complex', filtergraph.shuffle_window_graph(d['start'], d['perm'], total),
+               '-map', '[vout]', '-map', '0:a?']
+        if self._run_encode(cmd, out, audio=False):
+            return out
+        return input_path
 
-    def _add_random_sound(self, input_path, audio_asset, count=3):
+    def _add_random_sound(self, input_path, audio_asset, count=3, times=None):
+        """Mix count sound instances into the audio in one pass."""
         if not audio_asset:
             return input_path
-        cur = input_path
-        dur = self._probe_duration(input_path) or 6.0
-        for i in range(int(count)):
-            t = random.uniform(0, max(0.0, dur-0.5))
-            out = temp_filename_for('.mp4')
-            cmd = [self.ffmpeg, '-y', '-i', cur, '-itsoffset', str(t), '-i', audio_asset,
-                   '-filter_complex', '[0:a][1:a]amix=inputs=2:duration=first:dropout_transition=2', '-c:v', 'copy', '-c:a', 'aac', out]
-            if not run_command(cmd):
-                cmd2 = [self.ffmpeg, '-y', '-i', cur, '-itsoffset', str(t), '-i', audio_asset,
-                        '-filter_complex', '[0:a][1:a]amix=inputs=2:duration=first:dropout_transition=2', '-c:v', 'copy', '-c:a', 'libmp3lame', out]
-                run_command(cmd2)
-            cur = out
-        return cur
+        assets = audio_asset if isinstance(audio_asset, (list, tuple)) else [audio_asset]
+        if times is None:
+            times = self._draw('random_sound', {'count': count}, self.probe.probe(input_path))['times']
+        inputs = []
+        placements = []
+        for i, t in enumerate(times):
+            a = assets[i % len(assets)]
+            if a not in inputs:
+                inputs.append(a)
+            placements.append((inputs.index(a) + 1, t))
+        if not placements:
+            return input_path
+        out = self._tmp_media()
+        script = temp_filename_for('.txt')
+        try:
+            with open(script, 'w') as f:
+                f.write(filtergraph.sound_mix_graph(placements))
+            cmd = [self.ffmpeg, '-y', '-i', input_path]
+            for a in inputs:
+                cmd += ['-i', a]
+            cmd += ['-filter_complex_script', script, '-map', '0:v?', '-map', '[aout]']
+            if self._run_encode(cmd, out, video=False):
+                return out
+        finally:
+            rm_f(script)
+        return input_path
 
     # Auto-Tune placeholder (no real auto-tune included)
     def _auto_tune_placeholder(self, input_audio_path, params=None):
@@ -390,26 +1244,23 @@ class YTPEngine(object):
         print("Auto-Tune Chaos requested but not implemented. Provide autotune tool and call it here.")
         return input_audio_path
 
-    def _mode_2009(self, input_path, options):
-        out = temp_filename_for('.mp4')
-        overlay = options.get('assets', {}).get('2009_ad') or self._pick_asset(['.png','.jpg','.gif'])
-        vf = "scale=640:-2,eq=contrast=1.2:brightness=0.02:saturation=1.4,format=yuv420p"
-        if overlay:
-            cmd = [self.ffmpeg, '-y', '-i', input_path, '-i', overlay, '-filter_complex', vf + ",overlay=5:5", '-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'copy', out]
-        else:
-            cmd = [self.ffmpeg, '-y', '-i', input_path, '-vf', vf, '-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'copy', out]
-        if not run_command(cmd):
-            cmd2 = [self.ffmpeg, '-y', '-i', input_path, '-vf', vf, '-c:v', 'mpeg4', '-qscale:v', '6', '-c:a', 'copy', out]
-            run_command(cmd2)
+    def _mode_2009(self, input_path, overlay=None):
+        # the overlay is picked when planning; None renders without one
+        out = self._tmp_media()
+        vf = filtergraph.MODE_2009_VF
+        plain = [self.ffmpeg, '-y', '-i', input_path, '-vf', vf]
+        if not overlay or not self.caps.has_filter('overlay'):
+            self._run_encode(plain, out, audio=False)
+            return out
+        cmd = [self.ffmpeg, '-y', '-i', input_path, '-i', overlay, '-filter_complex', vf + ",overlay=5:5"]
+        if not self._run_encode(cmd, out, audio=False) and not self.caps.known:
+            self._run_encode(plain, out, audio=False)
         return out
 
     def _mode_2012(self, input_path, options):
-        out = temp_filename_for('.mp4')
-        vf = "scale=720:-2,eq=contrast=1.3:saturation=0.9,format=yuv420p"
-        cmd = [self.ffmpeg, '-y', '-i', input_path, '-vf', vf, '-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'copy', out]
-        if not run_command(cmd):
-            cmd2 = [self.ffmpeg, '-y', '-i', input_path, '-vf', vf, '-c:v', 'mpeg4', '-qscale:v', '6', '-c:a', 'copy', out]
-            run_command(cmd2)
+        out = self._tmp_media()
+        vf = filtergraph.MODE_2012_VF
+        self._run_encode([self.ffmpeg, '-y', '-i', input_path, '-vf', vf], out, audio=False)
         return out
 
     def _randomize_options(self, base):
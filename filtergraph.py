@@ -0,0 +1,319 @@
+from __future__ import print_function, unicode_literals
+import os
+from utils import temp_filename_for
+import pipeline
+
+# Effects whose whole work can be expressed as filters over the main input
+# (plus optional still/overlay inputs). Everything else keeps its own
+# per-step ffmpeg run in YTPEngine.
+FUSABLE = set(['mode_2009', 'mode_2012', 'reverse', 'speed', 'earrape', 'chorus',
+               'vibrato', 'sus', 'invert', 'mirror', 'dance', 'rainbow', 'meme'])
+
+# Effects that only look at one frame at a time, so a clip can be cut into
+# chunks, filtered in parallel and joined again (YTPEngine._run_segmented).
+# Overlays qualify only with still images: an animated one would restart in
+# every chunk.
+FRAME_LOCAL = set(['mode_2009', 'mode_2012', 'invert', 'mirror', 'dance', 'rainbow', 'meme'])
+STILL_IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+MODE_2009_VF = "scale=640:-2,eq=contrast=1.2:brightness=0.02:saturation=1.4,format=yuv420p"
+MODE_2012_VF = "scale=720:-2,eq=contrast=1.3:saturation=0.9,format=yuv420p"
+
+
+def atempo_chain(factor):
+    try:
+        f = float(factor)
+    except Exception:
+        f = 1.0
+    if f <= 0 or f == 1.0:
+        return 'anull'
+    parts = []
+    rem = f
+    while rem > 2.0:
+        parts.append('atempo=2.0'); rem /= 2.0
+    while rem < 0.5:
+        parts.append('atempo=0.5'); rem /= 0.5
+    parts.append('atempo=%s' % rem)
+    return ','.join(parts)
+
+
+def speed_filters(factor):
+    try:
+        f = float(factor)
+        if f <= 0: f = 1.0
+    except Exception:
+        f = 1.0
+    return 'setpts=%s*PTS' % (1.0/f), atempo_chain(f)
+
+
+def chorus_params(level):
+    """(in_gain, out_gain, delays_ms, decays) of the chorus echo."""
+    try:
+        lev = float(level)
+    except Exception:
+        lev = 0.6
+    d1 = int(30 + 400*lev); d2 = int(90 + 500*lev)
+    decay1 = 0.4 + 0.3*lev; decay2 = 0.2 + 0.25*lev
+    return 0.8, 0.9, [d1, d2], [round(decay1, 2), round(decay2, 2)]
+
+
+def chorus_filter(level):
+    in_gain, out_gain, delays, decays = chorus_params(level)
+    return "aecho=%s:%s:%s:%s" % (in_gain, out_gain, '|'.join('%d' % d for d in delays),
+                                  '|'.join('%.2f' % d for d in decays))
+
+
+def vibrato_level(level):
+    try:
+        lev = float(level)
+        if lev <= 0: lev = 1.03
+    except Exception:
+        lev = 1.03
+    return lev
+
+
+def vibrato_filter(level, sample_rate=None):
+    # raise the pitch by playing the samples faster, resample back to the
+    # source rate, then stretch the tempo back to the original duration
+    lev = vibrato_level(level)
+    sr = int(sample_rate or 44100)
+    return "asetrate=%d*%f,aresample=%d,%s" % (sr, lev, sr, atempo_chain(1.0/lev))
+
+
+def earrape_filter(gain):
+    try:
+        g = float(gain)
+    except Exception:
+        g = 20.0
+    return 'volume=%sdB' % g
+
+
+def shuffle_window_graph(start, perm, total=None):
+    """Graph text that plays frames [start, start+len(perm)) of input 0 in
+    the order perm and every other frame unchanged, ending at [vout].
+    shuffleframes only buffers the window, so memory does not grow with
+    the clip length. With total (the probed frame count) the window is
+    moved and cut to fit the stream, and the last segment has no end, so
+    a short estimate of total cannot drop frames."""
+    if total:
+        perm = [i for i in perm if i < total]
+        start = max(0, min(start, total - len(perm)))
+    n = len(perm)
+    segs = []
+    if start > 0:
+        segs.append('trim=end_frame=%d,setpts=PTS-STARTPTS' % start)
+    if total and start + n >= total:
+        segs.append('trim=start_frame=%d,setpts=PTS-STARTPTS,shuffleframes=%s'
+                    % (start, '|'.join(str(i) for i in perm)))
+    else:
+        segs.append('trim=start_frame=%d:end_frame=%d,setpts=PTS-STARTPTS,shuffleframes=%s'
+                    % (start, start + n, '|'.join(str(i) for i in perm)))
+        segs.append('trim=start_frame=%d,setpts=PTS-STARTPTS' % (start + n))
+    if len(segs) == 1:
+        return '[0:v]%s[vout]' % segs[0]
+    labels = ['s%d' % i for i in range(len(segs))]
+    lines = ['[0:v]split=%d%s' % (len(segs), ''.join('[%s]' % l for l in labels))]
+    for i, seg in enumerate(segs):
+        lines.append('[%s]%s[%s]' % (labels[i], seg, labels[i] + 'o'))
+    lines.append('%sconcat=n=%d:v=1:a=0[vout]' % (''.join('[%so]' % l for l in labels), len(segs)))
+    return ';'.join(lines)
+
+
+def explosion_graph(spots):
+    """Graph text placing input 1 over input 0 once per (x, y, start, end)
+    spot, ending at [vout]. The overlay input is split so it is decoded
+    once; each copy is shifted to its start time so animated overlays play
+    from their first frame."""
+    n = len(spots)
+    lines = ['[1:v]split=%d%s' % (n, ''.join('[e%d]' % i for i in range(n)))]
+    cur = '0:v'
+    for i, (x, y, t0, t1) in enumerate(spots):
+        lines.append('[e%d]setpts=PTS-STARTPTS+%.3f/TB[d%d]' % (i, t0, i))
+        out = 'vout' if i == n - 1 else 'x%d' % i
+        lines.append("[%s][d%d]overlay=%d:%d:enable='between(t,%.3f,%.3f)'[%s]" % (cur, i, x, y, t0, t1, out))
+        cur = out
+    return ';\n'.join(lines)
+
+
+def sound_mix_graph(placements):
+    """Graph text mixing sounds into the audio of input 0, ending at [aout].
+    placements is a list of (input_index, start_seconds); an input used
+    several times is split. Every sound is padded to the main length so
+    amix divides by a constant input count, and volume undoes that so the
+    original audio keeps its level."""
+    uses = {}
+    for idx, _ in placements:
+        uses[idx] = uses.get(idx, 0) + 1
+    lines = []
+    taken = {}
+    for idx in sorted(uses):
+        if uses[idx] > 1:
+            lines.append('[%d:a]asplit=%d%s' % (idx, uses[idx], ''.join('[i%d_%d]' % (idx, k) for k in range(uses[idx]))))
+    labels = []
+    for n, (idx, start) in enumerate(placements):
+        k = taken.get(idx, 0); taken[idx] = k + 1
+        src = ('i%d_%d' % (idx, k)) if uses[idx] > 1 else ('%d:a' % idx)
+        ms = int(round(max(0.0, start) * 1000))
+        lines.append('[%s]aformat=channel_layouts=stereo,adelay=%d|%d,apad[p%d]' % (src, ms, ms, n))
+        labels.append('p%d' % n)
+    k = len(labels) + 1
+    lines.append('[0:a]%samix=inputs=%d:duration=first:dropout_transition=0,volume=%d[aout]'
+                 % (''.join('[%s]' % l for l in labels), k, k))
+    return ';\n'.join(lines)
+
+
+class FilterGraph(object):
+    """Video and audio filter chains over input 0, rendered as one
+    -filter_complex graph. Extra inputs (overlay images) are numbered from 1."""
+
+    def __init__(self):
+        self.inputs = []
+        self.video = []
+        self.audio = []
+
+    def add_input(self, path):
+        self.inputs.append(path)
+        return len(self.inputs)
+
+    def add_video(self, chain):
+        if chain:
+            self.video.append(('chain', chain))
+
+    def add_audio(self, chain):
+        if chain and chain != 'anull':
+            self.audio.append(chain)
+
+    def add_overlay(self, path, x=0, y=0, opacity=1.0, prefilter=None):
+        idx = self.add_input(path)
+        pre = prefilter or ''
+        try:
+            if float(opacity) < 0.99:
+                pre = (pre + ',' if pre else '') + 'format=rgba,colorchannelmixer=aa=%f' % float(opacity)
+        except Exception:
+            pass
+        self.video.append(('overlay', idx, pre, '%s:%s' % (x, y)))
+
+    def is_empty(self):
+        return not self.video and not self.audio
+
+    def render(self):
+        """Return (graph_text, video_label, audio_label). A label is None
+        when that stream is left untouched and should be mapped from input 0."""
+        lines = []
+        vlabel = None
+        cur = '0:v'
+        n = 0
+        for item in self.video:
+            out = 'v%d' % n; n += 1
+            if item[0] == 'chain':
+                lines.append('[%s]%s[%s]' % (cur, item[1], out))
+            else:
+                _, idx, pre, pos = item
+                src = '%d:v' % idx
+                if pre:
+                    ol = 'ol%d' % n
+                    lines.append('[%s]%s[%s]' % (src, pre, ol))
+                    src = ol
+                lines.append('[%s][%s]overlay=%s[%s]' % (cur, src, pos, out))
+            cur = out
+        if self.video:
+            vlabel = cur
+        alabel = None
+        if self.audio:
+            alabel = 'aout'
+            lines.append('[0:a]%s[%s]' % (','.join(self.audio), alabel))
+        return ';\n'.join(lines), vlabel, alabel
+
+
+# Filter variants for builds that lack negate/transpose (see capabilities.py)
+INVERT_LUT = "lutrgb='r=255-val:g=255-val:b=255-val'"
+DANCE_SCALE = 'scale=iw*0.95:ih*0.95'
+
+
+def invert_filter(caps=None):
+    return 'negate' if caps is None or caps.has_filter('negate') else INVERT_LUT
+
+
+def dance_filter(caps=None):
+    if caps is None or caps.has_filter('transpose'):
+        return 'transpose=1,' + DANCE_SCALE
+    return DANCE_SCALE
+
+
+def add_step(graph, name, params, caps=None):
+    """Append one resolved effect step to graph. Returns False if the effect
+    cannot be fused. caps picks filter variants the build supports."""
+    if name not in FUSABLE:
+        return False
+    if name == 'mode_2009':
+        graph.add_video(MODE_2009_VF)
+        if params.get('overlay'):
+            graph.add_overlay(params['overlay'], 5, 5)
+    elif name == 'mode_2012':
+        graph.add_video(MODE_2012_VF)
+    elif name == 'reverse':
+        graph.add_video('reverse'); graph.add_audio('areverse')
+    elif name == 'speed':
+        v, a = speed_filters(params.get('level', 1.0))
+        graph.add_video(v); graph.add_audio(a)
+    elif name == 'sus':
+        for f in params.get('factors', []):
+            v, a = speed_filters(f)
+            graph.add_video(v); graph.add_audio(a)
+    elif name == 'earrape':
+        graph.add_audio(earrape_filter(params.get('level', 16.0)))
+    elif name == 'chorus':
+        graph.add_audio(chorus_filter(params.get('level', 0.6)))
+    elif name == 'vibrato':
+        graph.add_audio(vibrato_filter(params.get('level', 1.03), params.get('sample_rate')))
+    elif name == 'invert':
+        graph.add_video(invert_filter(caps))
+    elif name == 'mirror':
+        graph.add_video('hflip')
+    elif name == 'dance':
+        graph.add_video(dance_filter(caps))
+    elif name in ('rainbow', 'meme'):
+        if not params.get('asset'):
+            return True
+        graph.add_overlay(params['asset'], params.get('x', 0), params.get('y', 0), params.get('opacity', 1.0))
+    return True
+
+
+def frame_local(steps):
+    """True when every step is in FRAME_LOCAL and overlays only stills."""
+    for name, params in steps:
+        asset = params.get('overlay') or params.get('asset')
+        if name not in FRAME_LOCAL or (asset and os.path.splitext(asset)[1].lower() not in STILL_IMAGE_EXTS):
+            return False
+    return bool(steps)
+
+
+def compile_steps(steps, caps=None):
+    """Build a FilterGraph from a list of (name, params) fusable steps."""
+    graph = FilterGraph()
+    for name, params in steps:
+        if not add_step(graph, name, params, caps):
+            raise ValueError("effect %s cannot be fused" % name)
+    return graph
+
+
+def build_command(ffmpeg, input_path, graph, out, codec_args):
+    """Return (cmd, script_path). The graph is written to a script file and
+    passed with -filter_complex_script so long chains never hit command-line
+    limits. input_path/out may be pipeline.PIPE_IN/PIPE_OUT. The caller
+    removes script_path."""
+    text, vlabel, alabel = graph.render()
+    script = temp_filename_for('.txt')
+    with open(script, 'w') as f:
+        f.write(text)
+    cmd = [ffmpeg, '-y'] + pipeline.input_args(input_path)
+    for p in graph.inputs:
+        cmd += ['-i', p]
+    cmd += ['-filter_complex_script', script]
+    cmd += ['-map', '[%s]' % vlabel] if vlabel else ['-map', '0:v?']
+    cmd += ['-map', '[%s]' % alabel] if alabel else ['-map', '0:a?']
+    cmd += list(codec_args)
+    if not vlabel and '-c:v' not in codec_args:
+        cmd += ['-c:v', 'copy']
+    cmd += pipeline.output_args(out)
+    return cmd, script
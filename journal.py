@@ -0,0 +1,135 @@
+"""
+Checkpoint journal for auto_generate batches.
+
+The journal is a directory next to the batch's out_dir (<out_dir>.journal).
+job.json records the input, the base options and the batch seed. Each
+variant has variant_NNN.json with its seed, output path, randomized
+options and render plan, the number of finished stages and a hard link to
+the result of the last one, which stays in the job's scratch arena. Where
+it cannot be linked (RAM scratch on another filesystem) it is copied, but
+at most once every COPY_INTERVAL seconds of rendering, so quick stages are
+not all written out to disk. Every file is replaced atomically, and each
+variant is only ever written by the process rendering it.
+
+Running the same batch again skips variants marked done whose output
+exists, and restarts a half-finished variant from its checkpoint with the
+plan it was first given. The directory is deleted once every variant is
+done, so a later run of a finished batch starts from scratch.
+"""
+from __future__ import print_function, unicode_literals
+import json
+import os
+import random
+import shutil
+import time
+
+from utils import rm_f, replace_file
+
+JOURNAL_VERSION = 1
+# least rendering time (seconds) a checkpoint that must be copied saves
+COPY_INTERVAL = 30.0
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return data if data.get('version') == JOURNAL_VERSION else None
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write(path, data):
+    data = dict(data, version=JOURNAL_VERSION)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    replace_file(tmp, path)
+
+
+class BatchJournal(object):
+    def __init__(self, out_dir):
+        self.dir = os.path.normpath(os.path.abspath(out_dir)) + '.journal'
+
+    def open(self, input_video, base_options, seed=None):
+        """The batch seed: the journaled one when the same input and options
+        (and seed, if given) were started before, else seed or a new random
+        one. A journal of another batch is discarded."""
+        job = {'input': os.path.abspath(input_video), 'input_size': os.path.getsize(input_video),
+               'options': json.loads(json.dumps(base_options, sort_keys=True))}
+        old = _read(os.path.join(self.dir, 'job.json'))
+        if old and all(old.get(k) == v for k, v in job.items()) and seed in (None, old.get('seed')):
+            print("Auto-gen: resuming batch from %s" % self.dir)
+            return old['seed']
+        if seed is None:
+            seed = random.randrange(2**31)
+        rm_f(self.dir)
+        os.makedirs(self.dir)
+        _write(os.path.join(self.dir, 'job.json'), dict(job, seed=seed))
+        return seed
+
+    def variant(self, index):
+        return VariantJournal(self.dir, index)
+
+    def close(self):
+        rm_f(self.dir)
+
+
+class VariantJournal(object):
+    def __init__(self, journal_dir, index):
+        self.dir = journal_dir
+        self.index = index
+        self.path = os.path.join(journal_dir, 'variant_%03d.json' % index)
+        self.data = _read(self.path) or {}
+        # stage output the current checkpoint was made from, and when
+        self.saved_from = None
+        self.saved_at = time.time()
+
+    def done(self):
+        return self.data.get('state') == 'done' and os.path.isfile(self.data.get('output') or '')
+
+    def plan(self):
+        """(options, plan dict) recorded for this variant, or (None, None)."""
+        return self.data.get('options'), self.data.get('plan')
+
+    def start(self, seed, output, options, plan):
+        self.data = {'index': self.index, 'seed': seed, 'output': output, 'options': options,
+                     'plan': plan, 'state': 'rendering', 'stage': 0, 'stages': None, 'checkpoint': None}
+        _write(self.path, self.data)
+
+    def resume(self, stages):
+        """(stages done, checkpoint path) to continue from, or (0, None)
+        when nothing usable was saved for a chain of this many stages."""
+        ckpt = self.data.get('checkpoint')
+        if self.data.get('stages') != stages or not ckpt or not os.path.isfile(ckpt):
+            return 0, None
+        return self.data['stage'], ckpt
+
+    def save(self, stage, stages, path):
+        """Record path as the result of the first stage stages. path is left
+        where it is; True when a checkpoint was made."""
+        prev = self.data.get('checkpoint')
+        dst = os.path.join(self.dir, 'variant_%03d.stage%02d%s' % (self.index, stage, os.path.splitext(path)[1]))
+        if path in (prev, self.saved_from):
+            # the stage left its input as it was
+            dst = prev
+        else:
+            try:
+                os.link(path, dst)
+            except (AttributeError, OSError):
+                if time.time() - self.saved_at < COPY_INTERVAL:
+                    return False
+                shutil.copyfile(path, dst)
+        self.saved_from, self.saved_at = path, time.time()
+        self.data.update(stage=stage, stages=stages, checkpoint=dst)
+        _write(self.path, self.data)
+        if prev and prev != dst:
+            rm_f(prev)
+        return True
+
+    def complete(self):
+        prev = self.data.get('checkpoint')
+        self.data.update(state='done', checkpoint=None)
+        _write(self.path, self.data)
+        if prev:
+            rm_f(prev)
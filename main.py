@@ -2,18 +2,23 @@ from __future__ import print_function, unicode_literals
 import os
 import sys
 import json
+import threading
+import time
 import traceback
 try:
     import tkinter as tk
-    from tkinter import filedialog, messagebox, simpledialog
+    from tkinter import filedialog, messagebox, simpledialog, ttk
+    import queue
 except Exception:
     import Tkinter as tk
     import tkFileDialog as filedialog
     import tkMessageBox as messagebox
     import tkSimpleDialog as simpledialog
+    import ttk
+    import Queue as queue
 
 from engine import YTPEngine
-from utils import read_beta_key_from_file, is_valid_beta_key, find_assets_dir
+from utils import read_beta_key_from_file, is_valid_beta_key, find_assets_dir, CancelToken, JobCancelled, ScratchQuotaExceeded, set_cancel_token
 
 DEFAULT_CONFIG = {
     "reverse": {"enabled": False, "prob": 1.0},
@@ -39,6 +44,8 @@ class App(object):
         self.master = master
         master.title("YTP Deluxe Generator — Legacy")
         self.engine = None
+        # preview runs on the Tk thread, jobs on the worker; both may create it
+        self.engine_lock = threading.Lock()
         self.config = DEFAULT_CONFIG.copy()
         self.detected_key = read_beta_key_from_file()
         assets = find_assets_dir() or "(no assets folder)"
@@ -99,8 +106,27 @@ class App(object):
         tk.Button(master, text="Auto Generate", command=self.auto_generate).grid(row=row, column=4, pady=8)
         row += 1
 
+        jobs_frame = tk.LabelFrame(master, text="Jobs")
+        jobs_frame.grid(row=row, column=0, columnspan=5, sticky='we', padx=5, pady=5)
+        self.jobs_list = tk.Listbox(jobs_frame, height=5, width=90); self.jobs_list.grid(row=0, column=0, columnspan=3, sticky='we')
+        self.progress = ttk.Progressbar(jobs_frame, length=400, mode='determinate', maximum=1.0); self.progress.grid(row=1, column=0, sticky='w')
+        self.eta = tk.StringVar(value=""); tk.Label(jobs_frame, textvariable=self.eta).grid(row=1, column=1, sticky='w')
+        tk.Button(jobs_frame, text="Cancel", command=self.cancel_job).grid(row=1, column=2, sticky='e')
+        row += 1
+
         self.status = tk.StringVar(value="Ready"); tk.Label(master, textvariable=self.status).grid(row=row, column=0, columnspan=5, sticky='we')
 
+        # Renders run one at a time on a worker thread. It never touches Tk:
+        # it reports through self.events, which the UI drains every 100 ms.
+        self.jobs = []
+        self.job_queue = queue.Queue()
+        self.events = queue.Queue()
+        worker = threading.Thread(target=self._worker)
+        worker.daemon = True
+        worker.start()
+        master.protocol("WM_DELETE_WINDOW", self.on_close)
+        master.after(100, self._poll_events)
+
     def browse_input(self):
         path = filedialog.askopenfilename(title="Select input video", filetypes=[("Video","*.mp4;*.avi;*.mkv;*.mov;*.wmv"),("All","*.*")])
         if path: self.input_entry.delete(0,'end'); self.input_entry.insert(0,path)
@@ -167,30 +193,132 @@ class App(object):
         opts['beta_key'] = self.beta_entry.get().strip()
         return opts
 
+    # Background jobs
+    def _get_engine(self):
+        with self.engine_lock:
+            if not self.engine:
+                self.engine = YTPEngine()
+            return self.engine
+
+    def _submit(self, title, run):
+        """Queue run(report) for the worker; report(fraction, label) feeds
+        the progress bar. run returns the message shown when it finishes."""
+        job = {'id': len(self.jobs) + 1, 'title': title, 'run': run, 'token': CancelToken(),
+               'state': 'queued', 'fraction': 0.0, 'label': '', 'started': None, 'message': ''}
+        self.jobs.append(job)
+        self.job_queue.put(job)
+        self._refresh_jobs()
+
+    def _worker(self):
+        while True:
+            job = self.job_queue.get()
+            if job['token'].cancelled:
+                continue
+            set_cancel_token(job['token'])
+            self.events.put((job, 'running', None))
+            try:
+                msg = job['run'](lambda fraction, label: self.events.put((job, 'progress', (fraction, label))))
+                self.events.put((job, 'done', msg))
+            except ScratchQuotaExceeded as e:
+                job['token'].cleanup()
+                self.events.put((job, 'failed', str(e)))
+            except JobCancelled:
+                job['token'].cleanup()
+                self.events.put((job, 'cancelled', None))
+            except Exception as e:
+                traceback.print_exc()
+                self.events.put((job, 'failed', str(e)))
+            finally:
+                set_cancel_token(None)
+
+    def _poll_events(self):
+        try:
+            while True:
+                job, kind, data = self.events.get_nowait()
+                if kind == 'running':
+                    job['state'] = 'running'; job['started'] = time.time()
+                    self.status.set("Running: %s" % job['title'])
+                elif kind == 'progress':
+                    job['fraction'], job['label'] = data
+                elif kind == 'done':
+                    job['state'] = 'done'; job['fraction'] = 1.0; job['message'] = data
+                    self.status.set(data); messagebox.showinfo("Done", data)
+                elif kind == 'failed':
+                    job['state'] = 'failed'; job['message'] = data
+                    self.status.set("Error"); messagebox.showerror("%s failed" % job['title'], data)
+                elif kind == 'cancelled':
+                    job['state'] = 'cancelled'
+                    self.status.set("Cancelled: %s" % job['title'])
+                self._refresh_jobs()
+        except queue.Empty:
+            pass
+        running = [j for j in self.jobs if j['state'] == 'running']
+        if running:
+            self._show_progress(running[0])
+        self.master.after(100, self._poll_events)
+
+    def _show_progress(self, job):
+        self.progress['value'] = job['fraction']
+        elapsed = time.time() - job['started']
+        if 0 < job['fraction'] < 1:
+            self.eta.set("%s  ETA %ds" % (job['label'], elapsed * (1 - job['fraction']) / job['fraction']))
+        else:
+            self.eta.set(job['label'])
+
+    def _refresh_jobs(self):
+        sel = self.jobs_list.curselection()
+        self.jobs_list.delete(0, 'end')
+        for j in self.jobs:
+            state = j['state']
+            if state == 'running':
+                state = "running %d%% %s" % (j['fraction'] * 100, j['label'])
+            elif state == 'failed':
+                state = "failed: %s" % j['message']
+            self.jobs_list.insert('end', "#%d %s - %s" % (j['id'], j['title'], state))
+        for i in sel:
+            self.jobs_list.selection_set(i)
+        if not any(j['state'] == 'running' for j in self.jobs):
+            self.progress['value'] = 0; self.eta.set("")
+
+    def cancel_job(self):
+        """Cancel the selected job, or the running one if none is selected.
+        A running job's ffmpeg child is killed and its intermediates removed."""
+        sel = self.jobs_list.curselection()
+        if sel:
+            jobs = [self.jobs[sel[0]]]
+        else:
+            jobs = [j for j in self.jobs if j['state'] == 'running']
+        for job in jobs:
+            if job['state'] not in ('queued', 'running'):
+                continue
+            job['token'].cancel()
+            if job['state'] == 'queued':
+                job['state'] = 'cancelled'
+        self._refresh_jobs()
+
+    def on_close(self):
+        for job in self.jobs:
+            job['token'].cancel()
+        self.master.destroy()
+
     def generate(self):
         inp = self.input_entry.get().strip(); out = self.output_entry.get().strip()
         if not inp or not os.path.exists(inp):
             messagebox.showerror("Error","Input not found"); return
         if not out:
             messagebox.showerror("Error","Choose output"); return
-        try:
-            opts = self._gather_options()
-            if not self.engine:
-                self.engine = YTPEngine()
-            self.status.set("Generating..."); self.master.update()
-            self.engine.generate(inp, out, opts)
-            self.status.set("Generated: %s" % out)
-            messagebox.showinfo("Done","Generated: %s" % out)
-        except Exception as e:
-            traceback.print_exc(); messagebox.showerror("Generation failed", str(e)); self.status.set("Error")
+        opts = self._gather_options()
+        def run(report):
+            self._get_engine().generate(inp, out, opts, progress=lambda done, total, label: report(float(done) / total, label))
+            return "Generated: %s" % out
+        self._submit("Generate %s" % os.path.basename(out), run)
 
     def preview(self):
         out = self.output_entry.get().strip()
         if not out or not os.path.exists(out):
             messagebox.showerror("Error","Output not found"); return
         try:
-            if not self.engine: self.engine = YTPEngine()
-            self.engine.preview(out)
+            self._get_engine().preview(out)
         except Exception as e:
             messagebox.showerror("Preview failed", str(e))
 
@@ -199,8 +327,7 @@ class App(object):
         if not inp or not os.path.exists(inp):
             messagebox.showerror("Error","Input not found"); return
         try:
-            if not self.engine: self.engine = YTPEngine()
-            self.engine.preview2(inp, seconds=6)
+            self._get_engine().preview2(inp, seconds=6)
         except Exception as e:
             messagebox.showerror("Preview2 failed", str(e))
 
@@ -215,16 +342,15 @@ class App(object):
             cnt = 3
         out_dir = filedialog.askdirectory(title="Select output directory")
         if not out_dir: return
-        try:
-            opts = self._gather_options()
-            if not self.engine: self.engine = YTPEngine()
-            beta = opts.get('beta_key') or None
-            self.status.set("Auto-generating..."); self.master.update()
-            generated = self.engine.auto_generate(inp, out_dir, opts, count=cnt, beta_key=beta)
-            messagebox.showinfo("Auto Generate", "Generated %d files" % len(generated))
-            self.status.set("Auto-generated %d files" % len(generated))
-        except Exception as e:
-            traceback.print_exc(); messagebox.showerror("Auto Generate failed", str(e)); self.status.set("Error")
+        opts = self._gather_options()
+        beta = opts.get('beta_key') or None
+        def progress(report, i, done, total, label):
+            report((i - 1 + float(done) / total) / cnt, "variant %d/%d: %s" % (i, cnt, label))
+        def run(report):
+            generated = self._get_engine().auto_generate(inp, out_dir, opts, count=cnt, beta_key=beta,
+                                                         progress=lambda *a: progress(report, *a))
+            return "Auto-generated %d files" % len(generated)
+        self._submit("Auto Generate x%d" % cnt, run)
 
 if __name__ == '__main__':
     root = tk.Tk()
@@ -0,0 +1,84 @@
+from __future__ import print_function, unicode_literals
+import subprocess
+import tracing
+from utils import with_thread_budget, cancel_token, check_cancelled, kill_process
+
+# Stages connected by OS pipes exchange NUT with uncompressed video and PCM
+# audio: no encode cost between stages, and NUT carries both fine.
+PIPE_FORMAT = 'nut'
+PIPE_CODEC_ARGS = ['-c:v', 'rawvideo', '-c:a', 'pcm_s16le']
+PIPE_IN = 'pipe:0'
+PIPE_OUT = 'pipe:1'
+
+# Effects that must read a real file: seeking (-ss), probing the duration,
+# reading the input twice, or (reverse) buffering the whole clip anyway.
+NEEDS_FILE_INPUT = set(['sentence_mix', 'stutter', 'explosion', 'frame_shuffle', 'random_sound', 'reverse'])
+
+
+def needs_file(steps):
+    return any(name in NEEDS_FILE_INPUT for name, _ in steps)
+
+
+def pipe_codec_args(video=True, audio=True):
+    """Codec args for a pipe link; streams the stage did not touch are copied."""
+    return ((PIPE_CODEC_ARGS[:2] if video else ['-c:v', 'copy']) +
+            (PIPE_CODEC_ARGS[2:] if audio else ['-c:a', 'copy']))
+
+
+def input_args(path):
+    if path == PIPE_IN:
+        return ['-f', PIPE_FORMAT, '-i', PIPE_IN]
+    return ['-i', path]
+
+
+def output_args(path):
+    if path == PIPE_OUT:
+        return ['-f', PIPE_FORMAT, PIPE_OUT]
+    return [path]
+
+
+def run_pipeline(cmds):
+    """Run ffmpeg commands concurrently, each one's stdout feeding the next
+    one's stdin. Returns True only if every process exited cleanly."""
+    if not cmds:
+        return True
+    procs = []
+    prev = None
+    token = cancel_token()
+    check_cancelled()
+    # only the last process's stdout is free for -progress output
+    cmds = [with_thread_budget(c) for c in cmds[:-1]] + [tracing.with_progress(with_thread_budget(cmds[-1]))]
+    timer = tracing.CommandTimer(cmds)
+    try:
+        for i, cmd in enumerate(cmds):
+            if i < len(cmds) - 1 and '-nostats' not in cmd:
+                cmd = [cmd[0], '-nostats'] + cmd[1:]
+            print("Running:", " ".join(cmd) + (" |" if i < len(cmds) - 1 else ""))
+            stdout = subprocess.PIPE if i < len(cmds) - 1 or tracing.has_progress(cmd) else None
+            p = subprocess.Popen(cmd, stdin=prev.stdout if prev else None, stdout=stdout)
+            if prev is not None:
+                # only the consumer should hold the read end, so the producer
+                # gets SIGPIPE if the consumer dies
+                prev.stdout.close()
+            procs.append(p)
+            if token is not None:
+                token.track(p)
+            prev = p
+    except Exception as e:
+        print("Command failed:", e)
+        for p in procs:
+            kill_process(p)
+        for p in procs:
+            p.wait()
+        return False
+    try:
+        stats = tracing.read_progress(procs[-1].stdout) if tracing.has_progress(cmds[-1]) else {}
+        cpus = [tracing.wait(p) for p in procs]
+        codes = [p.returncode for p in procs]
+    finally:
+        if token is not None:
+            for p in procs:
+                token.untrack(p)
+    timer.finish(all(c == 0 for c in codes), stats, tracing.sum_cpu(cpus))
+    check_cancelled()
+    return all(c == 0 for c in codes)
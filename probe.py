@@ -0,0 +1,238 @@
+from __future__ import print_function, unicode_literals
+import json
+import os
+import re
+import subprocess
+
+from utils import run_many
+
+# Fields describing a media file. Missing values are None.
+INFO_FIELDS = ('duration', 'fps', 'width', 'height', 'sample_rate', 'channels',
+               'has_video', 'has_audio', 'video_codec', 'video_profile', 'pix_fmt', 'audio_codec')
+
+
+def empty_info():
+    return dict((k, None) for k in INFO_FIELDS)
+
+
+def _rate(text):
+    try:
+        if '/' in text:
+            n, d = text.split('/', 1)
+            return float(n) / float(d) if float(d) else None
+        return float(text)
+    except Exception:
+        return None
+
+
+def parse_ffprobe_json(text):
+    info = empty_info()
+    data = json.loads(text)
+    fmt = data.get('format', {})
+    try:
+        info['duration'] = float(fmt.get('duration'))
+    except Exception:
+        pass
+    info['has_video'] = False
+    info['has_audio'] = False
+    for st in data.get('streams', []):
+        kind = st.get('codec_type')
+        if kind == 'video' and not info['has_video']:
+            # attached cover art is a "video" stream too; skip it
+            if st.get('disposition', {}).get('attached_pic'):
+                continue
+            info['has_video'] = True
+            info['video_codec'] = st.get('codec_name')
+            info['video_profile'] = st.get('profile') or ''
+            info['pix_fmt'] = st.get('pix_fmt')
+            info['width'] = st.get('width')
+            info['height'] = st.get('height')
+            info['fps'] = _rate(st.get('avg_frame_rate') or '') or _rate(st.get('r_frame_rate') or '')
+        elif kind == 'audio' and not info['has_audio']:
+            info['has_audio'] = True
+            info['audio_codec'] = st.get('codec_name')
+            try:
+                info['sample_rate'] = int(st.get('sample_rate'))
+            except Exception:
+                pass
+            info['channels'] = st.get('channels')
+        if info['duration'] is None:
+            try:
+                info['duration'] = float(st.get('duration'))
+            except Exception:
+                pass
+    return info
+
+
+def parse_ffmpeg_banner(text):
+    """Fallback for builds without ffprobe: scrape `ffmpeg -i` stderr."""
+    info = empty_info()
+    m = re.search(r'Duration:\s*(\d+):(\d+):(\d+\.\d+)', text)
+    if m:
+        h, mm, ss = m.groups()
+        info['duration'] = int(h)*3600 + int(mm)*60 + float(ss)
+    info['has_video'] = False
+    info['has_audio'] = False
+    for m in re.finditer(r'Stream #\d+:\d+.*?: (Video|Audio): (\w+)(?: \(([^)]*)\))?([^\n]*)', text):
+        kind, codec, profile, rest = m.group(1), m.group(2), m.group(3) or '', m.group(4)
+        if kind == 'Video' and not info['has_video']:
+            info['has_video'] = True
+            info['video_codec'] = codec
+            info['video_profile'] = profile
+            pm = re.match(r'[^,]*, (\w+)', rest)
+            info['pix_fmt'] = pm.group(1) if pm else None
+            sm = re.search(r'(\d{2,5})x(\d{2,5})', rest)
+            if sm:
+                info['width'], info['height'] = int(sm.group(1)), int(sm.group(2))
+            fm = re.search(r'([\d.]+) fps', rest)
+            if fm:
+                info['fps'] = float(fm.group(1))
+        elif kind == 'Audio' and not info['has_audio']:
+            info['has_audio'] = True
+            info['audio_codec'] = codec
+            rm = re.search(r'(\d+) Hz', rest)
+            if rm:
+                info['sample_rate'] = int(rm.group(1))
+            if 'stereo' in rest:
+                info['channels'] = 2
+            elif 'mono' in rest:
+                info['channels'] = 1
+    return info
+
+
+class ProbeCache(object):
+    """Media metadata keyed by (path, size, mtime). Files the engine writes
+    itself can be recorded with remember() so they never need probing."""
+
+    def __init__(self, ffprobe=None, ffmpeg=None):
+        self.ffprobe = ffprobe
+        self.ffmpeg = ffmpeg
+        self.entries = {}
+        self.probes = 0
+
+    def _key(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (os.path.abspath(path), st.st_size, int(st.st_mtime * 1000))
+
+    def _cmd(self, path):
+        return [self.ffprobe, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path]
+
+    def _run(self, path):
+        self.probes += 1
+        if self.ffprobe:
+            try:
+                p = subprocess.Popen(self._cmd(path), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out, _ = p.communicate()
+                if p.returncode == 0 and out:
+                    return parse_ffprobe_json(out.decode('utf-8', errors='ignore'))
+            except Exception:
+                pass
+        if self.ffmpeg:
+            try:
+                p = subprocess.Popen([self.ffmpeg, '-i', path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out, err = p.communicate()
+                text = (err or b'').decode('utf-8', errors='ignore') + (out or b'').decode('utf-8', errors='ignore')
+                return parse_ffmpeg_banner(text)
+            except Exception:
+                pass
+        return empty_info()
+
+    def probe(self, path, full=False):
+        """Return the info dict for path. Remembered (derived) entries are
+        used unless full is set, which forces a real probe for codec fields."""
+        key = self._key(path)
+        entry = self.entries.get(key) if key else None
+        if entry is not None and not (full and entry[1]):
+            return dict(entry[0])
+        info = self._run(path)
+        if key:
+            self.entries[key] = (info, False)
+        return dict(info)
+
+    def probe_many(self, paths, full=False):
+        """probe() every path, running the ffprobes that are needed at once
+        (utils.run_many). Returns {path: info}."""
+        todo = []
+        for path in paths:
+            key = self._key(path)
+            entry = self.entries.get(key) if key else None
+            if path not in todo and (entry is None or (full and entry[1])):
+                todo.append(path)
+        if self.ffprobe and len(todo) > 1:
+            results = run_many([self._cmd(p) for p in todo], capture=True)
+            self.probes += len(todo)
+            for path, (ok, out, _) in zip(todo, results):
+                key = self._key(path)
+                if ok and out and key:
+                    self.entries[key] = (parse_ffprobe_json(out.decode('utf-8', errors='ignore')), False)
+        # anything left (no ffprobe, or it failed) goes through the fallbacks
+        return dict((path, self.probe(path, full)) for path in paths)
+
+    def remember(self, path, info):
+        key = self._key(path)
+        if key and info is not None:
+            self.entries[key] = (dict(info), True)
+
+
+def _even(v):
+    return int(v) - int(v) % 2
+
+
+def _scaled(info, width):
+    if info.get('width') and info.get('height'):
+        info['height'] = _even(float(width) * info['height'] / info['width'])
+    else:
+        info['height'] = None
+    info['width'] = width
+
+
+def apply_effect(info, name, params):
+    """Return the metadata after effect name runs on a file described by
+    info, or None when it cannot be worked out without probing."""
+    if info is None:
+        return None
+    info = dict(info)
+    dur = info.get('duration')
+    # every effect re-encodes at least one stream into the intermediate profile
+    info['video_codec'] = info['video_profile'] = info['pix_fmt'] = info['audio_codec'] = None
+    if name == 'speed':
+        try:
+            f = float(params.get('level', 1.0))
+        except Exception:
+            f = 1.0
+        if f > 0 and dur:
+            info['duration'] = dur / f
+    elif name == 'sus':
+        total = 1.0
+        for f in params.get('factors', []):
+            total *= float(f)
+        if dur and total > 0:
+            info['duration'] = dur / total
+    elif name == 'stutter':
+        level = float(params.get('level', 2))
+        seg_len = max(0.05, min(0.6, 0.1 * level))
+        info['duration'] = (2 + int(level)) * seg_len
+    elif name == 'sentence_mix':
+        parts = int(params.get('parts', 6))
+        piece_len = min(1.5, max(0.15, (dur or 6.0) / max(1, parts*2.0)))
+        info['duration'] = parts * piece_len
+    elif name == 'dance':
+        w, h = info.get('width'), info.get('height')
+        if w and h:
+            info['width'], info['height'] = int(h * 0.95), int(w * 0.95)
+    elif name == 'mode_2009':
+        _scaled(info, 640)
+    elif name == 'mode_2012':
+        _scaled(info, 720)
+    # reverse, earrape, chorus, invert, mirror, frame shuffle and the overlay
+    # effects keep duration, geometry and rates
+    return info
+
+
+def apply_effects(info, steps):
+    for name, params in steps:
+        info = apply_effect(info, name, params)
+    return info
@@ -0,0 +1,103 @@
+"""
+Render plans: every decision of a generate run, resolved up front.
+
+YTPEngine.plan() rolls the effect probabilities, picks assets and draws
+every random offset, position and permutation into the step parameters.
+Executing a plan (YTPEngine.render_plan) never touches the RNG, so the
+same plan renders the same edit at proxy or full resolution, now or on
+another machine. Plans are plain JSON.
+"""
+from __future__ import print_function, unicode_literals
+import json
+import os
+
+PLAN_VERSION = 1
+
+# Options that change how a plan is executed but not what it contains.
+EXEC_OPTIONS = ('fuse_filters', 'streaming', 'intermediate', 'audio_backend', 'stage_cache',
+               'segments', 'reverse_chunk')
+
+
+class RenderPlan(object):
+    def __init__(self, input_path, steps, info=None, seed=None, settings=None, input_size=None):
+        self.input_path = input_path
+        self.steps = [(name, dict(params)) for name, params in steps]
+        self.info = dict(info or {})
+        self.seed = seed
+        self.settings = dict(settings or {})
+        self.input_size = input_size
+
+    def to_dict(self):
+        return {'version': PLAN_VERSION, 'input': self.input_path, 'input_size': self.input_size,
+                'seed': self.seed, 'info': self.info, 'settings': self.settings,
+                'steps': [[name, params] for name, params in self.steps]}
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != PLAN_VERSION:
+            raise ValueError("Unsupported plan version: %r" % data.get('version'))
+        return cls(data['input'], [(s[0], s[1]) for s in data['steps']], data.get('info'),
+                   data.get('seed'), data.get('settings'), data.get('input_size'))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        return path
+
+    def check_input(self, path):
+        """Warn when path is not the file the plan was made for: offsets
+        and positions were drawn for that file's duration and size."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        if self.input_size is not None and size != self.input_size:
+            print("Warning: %s differs from the planned input (%s bytes, plan has %s)" % (path, size, self.input_size))
+
+
+def load(path):
+    with open(path, 'r') as f:
+        return RenderPlan.from_dict(json.load(f))
+
+
+def coerce(value):
+    """A RenderPlan from a plan, its dict form or a JSON file path."""
+    if isinstance(value, RenderPlan):
+        return value
+    if isinstance(value, dict):
+        return RenderPlan.from_dict(value)
+    return load(value)
+
+
+def _scale(v, factor):
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return int(round(v * factor))
+    return v
+
+
+def step_scales(steps, factor):
+    """The pixel scale factor in effect at each step of a plan rendered on
+    an input resized by factor. mode_2009/mode_2012 scale the video to a
+    fixed width, so every step after them sees the planned geometry."""
+    out = []
+    for name, params in steps:
+        out.append(factor)
+        if name in ('mode_2009', 'mode_2012'):
+            factor = 1.0
+    return out
+
+
+def scale_steps(steps, factor):
+    """steps with pixel positions multiplied by factor, for rendering a plan
+    on an input that was resized by factor (proxy renders)."""
+    out = []
+    for (name, params), f in zip(steps, step_scales(steps, factor)):
+        params = dict(params)
+        if name == 'explosion' and params.get('spots'):
+            params['spots'] = [[_scale(x, f), _scale(y, f), t0, t1] for x, y, t0, t1 in params['spots']]
+        elif name in ('rainbow', 'meme'):
+            for k in ('x', 'y'):
+                if k in params:
+                    params[k] = _scale(params[k], f)
+        out.append((name, params))
+    return out
@@ -0,0 +1,141 @@
+"""
+Per-job scratch space for intermediates.
+
+YTPEngine.render_plan opens a ScratchArena for every job and installs it on
+the rendering thread (utils.set_scratch), so utils.temp_filename_for makes
+its files inside it. Every file records the stage that made it, and each
+intermediate has a single reader, the step after the one that made it.
+_generate releases a unit's input once the unit is done and sweeps
+whatever the unit made but did not return, and lane units (one stream
+run through several stages) release each lane intermediate once the next
+stage has read it. So only a couple of intermediates exist at any time;
+the rest goes when the job ends.
+
+With ram_dir (e.g. /dev/shm) new files go to RAM while the RAM part, plus
+room for a file as large as the largest so far, stays under ram_limit; later
+files go to disk. Short clips never touch the disk that way. quota caps
+the bytes the job may hold at once: going over stops the job with
+utils.ScratchQuotaExceeded. Usage is measured after every ffmpeg run, and
+peak_bytes is the largest seen.
+"""
+from __future__ import print_function, unicode_literals
+import os
+import tempfile
+import threading
+import time
+
+import tracing
+from utils import rm_f, ScratchQuotaExceeded
+
+DEFAULT_RAM_LIMIT = 256 * 1024 * 1024
+
+
+def _size(path):
+    if os.path.isdir(path):
+        total = 0
+        for root, _, names in os.walk(path):
+            total += sum(_size(os.path.join(root, n)) for n in names)
+        return total
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _mb(n):
+    return '%.1f MB' % (n / 1048576.0)
+
+
+class ScratchArena(object):
+    def __init__(self, root, quota=None, ram_dir=None, ram_limit=DEFAULT_RAM_LIMIT):
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.dir = tempfile.mkdtemp(prefix='job_', dir=root)
+        self.ram = None
+        if ram_dir:
+            try:
+                self.ram = tempfile.mkdtemp(prefix='ytp_job_', dir=ram_dir)
+            except OSError as e:
+                print("Scratch: cannot use %s (%s), staying on disk" % (ram_dir, e))
+        self.quota = int(quota) if quota else None
+        self.ram_limit = int(ram_limit)
+        # path -> {'stage', 'size', 'seq'}
+        self.files = {}
+        # the stage files are made for, set by the engine
+        self.stage = None
+        self.seq = 0
+        self.created = 0
+        self.largest = 0
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.peak_stage = None
+        self.lock = threading.Lock()
+
+    def pick_dir(self):
+        """Directory for the next file: RAM while it is expected to fit."""
+        if self.ram is None:
+            return self.dir
+        with self.lock:
+            in_ram = sum(f['size'] for p, f in self.files.items() if p.startswith(self.ram))
+            return self.ram if in_ram + self.largest <= self.ram_limit else self.dir
+
+    def add(self, path):
+        with self.lock:
+            self.seq += 1
+            self.created += 1
+            self.files[path] = {'stage': self.stage, 'size': 0, 'seq': self.seq}
+
+    def owns(self, path):
+        return path in self.files
+
+    def release(self, path):
+        """Delete path once its reader is done; files the arena did not
+        make are left alone."""
+        with self.lock:
+            if self.files.pop(path, None) is None:
+                return
+        rm_f(path)
+
+    def mark(self):
+        return self.seq
+
+    def sweep(self, mark, keep=()):
+        """Delete every file made after mark except keep: what a stage
+        made along the way but did not hand on has no consumer left."""
+        with self.lock:
+            dead = [p for p, f in self.files.items() if f['seq'] > mark and p not in keep]
+            for p in dead:
+                del self.files[p]
+        for p in dead:
+            rm_f(p)
+
+    def measure(self):
+        """Re-measure the files held, update the peak and enforce the quota."""
+        with self.lock:
+            total = 0
+            for p, f in self.files.items():
+                f['size'] = _size(p)
+                total += f['size']
+                self.largest = max(self.largest, f['size'])
+            self.bytes = total
+            if total > self.peak_bytes:
+                self.peak_bytes, self.peak_stage = total, self.stage
+        tracer = tracing.current()
+        if tracer is not None:
+            tracer.emit({'type': 'scratch', 'name': 'scratch', 'start': time.time(), 'bytes': total,
+                         'thread': threading.current_thread().ident})
+        if self.quota and total > self.quota:
+            raise ScratchQuotaExceeded("scratch quota exceeded: %s in use, quota %s (stage %s)"
+                                       % (_mb(total), _mb(self.quota), self.stage))
+
+    def stats(self):
+        return {'peak_bytes': self.peak_bytes, 'peak_stage': self.peak_stage, 'files': self.created,
+                'quota': self.quota, 'ram': self.ram is not None}
+
+    def close(self):
+        """Delete everything the job left behind."""
+        with self.lock:
+            self.files = {}
+        rm_f(self.dir)
+        if self.ram:
+            rm_f(self.ram)
@@ -0,0 +1,445 @@
+"""
+Local render service: one long-running process with warm engines and a
+persistent, prioritized job queue.
+
+  python server.py -c config_sample_updated.json --port 8765 --jobs 2
+  python server.py -c cfg.json --watch incoming --watch-out rendered
+
+Each worker thread builds its YTPEngine once (ffmpeg lookup, capability
+cache, asset index) and keeps it for every job. The queue is saved to
+<work_dir>/server_queue.json on every change; jobs that were running when
+the server stopped are queued again on the next start.
+
+HTTP API on 127.0.0.1 (JSON in and out):
+  POST   /jobs        {"kind": "generate", "input": "a.mp4", "output": "out/a.mp4",
+                       "options": {...}, "seed": 7, "priority": 0}
+                      {"kind": "auto_generate", "input": "a.mp4", "out_dir": "out",
+                       "count": 3, "seed": 7, "beta_key": "..."}
+  GET    /jobs        every job
+  GET    /jobs/<id>   one job, with progress
+  DELETE /jobs/<id>   cancel a queued or running job
+  GET    /stats       queue counters and throughput
+
+"options" is merged over the -c config like a cli.py manifest line. Higher
+priorities run first, equal ones in submission order. POST answers 503
+when --max-queued jobs are already waiting.
+
+With --watch, video files that appear in the folder (and stop growing) are
+queued as generate jobs writing <name>_ytp.mp4 into --watch-out.
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import cli
+import engine
+from utils import CancelToken, JobCancelled, ScratchQuotaExceeded, set_cancel_token, set_ffmpeg_threads
+
+STORE_VERSION = 1
+KINDS = ('generate', 'auto_generate')
+FINISHED = ('done', 'failed', 'cancelled')
+VIDEO_EXTS = ('.mp4', '.mov', '.mkv', '.avi', '.webm', '.flv', '.m4v', '.wmv')
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobStore(object):
+    """Jobs by id, saved as JSON after every change. next() hands out the
+    queued job with the highest priority, oldest first."""
+
+    def __init__(self, path, max_queued=100):
+        self.path = path
+        self.max_queued = max_queued
+        self.cond = threading.Condition()
+        self.jobs = {}
+        self.seq = 0
+        # watch-folder files already queued, by path|size|mtime
+        self.seen = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('version') != STORE_VERSION:
+            return
+        self.seq = data.get('seq', 0)
+        self.seen = data.get('seen', {})
+        for job in data.get('jobs', []):
+            if job['state'] == 'running':
+                job['state'] = 'queued'
+                job['progress'] = None
+            self.jobs[job['id']] = job
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        data = {'version': STORE_VERSION, 'seq': self.seq, 'seen': self.seen,
+                'jobs': sorted(self.jobs.values(), key=lambda j: j['seq'])}
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+    def add(self, job):
+        with self.cond:
+            if sum(1 for j in self.jobs.values() if j['state'] == 'queued') >= self.max_queued:
+                raise QueueFull("queue is full (%d jobs waiting)" % self.max_queued)
+            self.seq += 1
+            job.update(id=str(self.seq), seq=self.seq, state='queued', submitted=time.time(),
+                       started=None, finished=None, error=None, result=None, progress=None)
+            job.setdefault('priority', 0)
+            self.jobs[job['id']] = job
+            self.save()
+            self.cond.notify()
+            return dict(job)
+
+    def next(self, timeout=1.0):
+        """Claim the next queued job (marked running), or None after timeout."""
+        with self.cond:
+            queued = [j for j in self.jobs.values() if j['state'] == 'queued']
+            if not queued:
+                self.cond.wait(timeout)
+                queued = [j for j in self.jobs.values() if j['state'] == 'queued']
+            if not queued:
+                return None
+            job = min(queued, key=lambda j: (-j['priority'], j['seq']))
+            job.update(state='running', started=time.time())
+            self.save()
+            return job
+
+    def update(self, job_id, persist=True, **fields):
+        with self.cond:
+            self.jobs[job_id].update(fields)
+            if persist:
+                self.save()
+
+    def get(self, job_id):
+        with self.cond:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def all(self):
+        with self.cond:
+            return [dict(j) for j in sorted(self.jobs.values(), key=lambda j: j['seq'])]
+
+    def mark_seen(self, key, job_id):
+        with self.cond:
+            self.seen[key] = job_id
+            self.save()
+
+
+class RenderServer(object):
+    def __init__(self, store, engine_kwargs=None, base_options=None, concurrency=1, threads=None):
+        self.store = store
+        self.engine_kwargs = engine_kwargs or {}
+        self.base_options = base_options or {}
+        self.concurrency, per_job = engine.thread_budget(max(1, concurrency), concurrency, threads)
+        # a lone worker without a budget leaves ffmpeg its own default
+        set_ffmpeg_threads(per_job if threads or self.concurrency > 1 else None)
+        self.engines = []
+        self.tokens = {}
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.t0 = time.time()
+        self.counters = {'done': 0, 'failed': 0, 'cancelled': 0, 'render_seconds': 0.0, 'media_seconds': 0.0}
+
+    def start(self):
+        # the first engine is built here so a missing ffmpeg fails at startup
+        first = engine.YTPEngine(**self.engine_kwargs)
+        for i in range(self.concurrency):
+            t = threading.Thread(target=self._worker, args=(first if i == 0 else None,))
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        """Stop the workers; running jobs are killed and queued again."""
+        self.stopping = True
+        with self.lock:
+            tokens = list(self.tokens.values())
+        for token in tokens:
+            token.cancel()
+
+    def submit(self, spec):
+        """Validate a job request and queue it. Raises ValueError or QueueFull."""
+        kind = spec.get('kind', 'generate')
+        if kind not in KINDS:
+            raise ValueError("kind must be one of %s" % ', '.join(KINDS))
+        if not spec.get('input') and not spec.get('plan'):
+            raise ValueError("input is required")
+        if kind == 'generate' and not spec.get('output'):
+            raise ValueError("output is required")
+        if kind == 'auto_generate' and not spec.get('out_dir'):
+            raise ValueError("out_dir is required")
+        if kind == 'auto_generate' and not spec.get('input'):
+            # the batch journal is keyed by the input file
+            raise ValueError("input is required for auto_generate")
+        base = cli.load_config(spec['config']) if spec.get('config') else self.base_options
+        options = cli.merge_options(base, spec.get('options'))
+        for k in ('seed', 'plan'):
+            if spec.get(k) is not None:
+                options[k] = spec[k]
+        job = {'kind': kind, 'input': spec.get('input'), 'output': spec.get('output'),
+               'out_dir': spec.get('out_dir'), 'count': int(spec.get('count', 3)),
+               'beta_key': spec.get('beta_key'), 'options': options,
+               'priority': int(spec.get('priority', 0)), 'source': spec.get('source', 'api')}
+        return self.store.add(job)
+
+    def cancel(self, job_id):
+        """Cancel a job; False when it does not exist or already finished."""
+        job = self.store.get(job_id)
+        if not job or job['state'] in FINISHED:
+            return False
+        if job['state'] == 'queued':
+            self.store.update(job_id, state='cancelled', finished=time.time())
+            with self.lock:
+                self.counters['cancelled'] += 1
+            return True
+        with self.lock:
+            token = self.tokens.get(job_id)
+        if token is not None:
+            token.cancel()
+        return True
+
+    def _worker(self, eng=None):
+        # one warm engine per worker: an engine holds per-job state while rendering
+        eng = eng or engine.YTPEngine(**self.engine_kwargs)
+        with self.lock:
+            self.engines.append(eng)
+        while not self.stopping:
+            job = self.store.next()
+            if job is None:
+                continue
+            token = CancelToken()
+            with self.lock:
+                self.tokens[job['id']] = token
+            set_cancel_token(token)
+            try:
+                self._run(eng, job)
+            finally:
+                set_cancel_token(None)
+                with self.lock:
+                    self.tokens.pop(job['id'], None)
+
+    def _run(self, eng, job):
+        job_id = job['id']
+        print("Job %s: %s %s" % (job_id, job['kind'], job['input']))
+
+        def progress(done, total, label, variant=None):
+            self.store.update(job_id, persist=False, progress={
+                'fraction': float(done) / total if total else 0.0, 'stage': label, 'variant': variant})
+
+        t0 = time.time()
+        try:
+            if job['kind'] == 'generate':
+                out = os.path.abspath(job['output'])
+                d = os.path.dirname(out)
+                if not os.path.isdir(d):
+                    os.makedirs(d)
+                eng.generate(job['input'], out, job['options'], progress=progress)
+                outputs = [out]
+            else:
+                opts = dict(job['options'])
+                seed = opts.pop('seed', None)
+                outputs = eng.auto_generate(job['input'], job['out_dir'], opts, count=job['count'],
+                                            beta_key=job['beta_key'], seed=seed,
+                                            progress=lambda i, d, t, label: progress(d, t, label, i))
+        except ScratchQuotaExceeded as e:
+            return self._finish(job_id, 'failed', t0, error=str(e))
+        except JobCancelled:
+            if self.stopping:
+                self.store.update(job_id, state='queued', started=None, progress=None)
+                return
+            return self._finish(job_id, 'cancelled', t0)
+        except Exception as e:
+            traceback.print_exc()
+            return self._finish(job_id, 'failed', t0, error=str(e) or e.__class__.__name__)
+        media = sum(eng.probe.probe(o).get('duration') or 0.0 for o in outputs)
+        self._finish(job_id, 'done', t0, result={'outputs': outputs, 'media_seconds': round(media, 3),
+                                                 'scratch_peak': eng.last_scratch.get('peak_bytes')}, media=media)
+
+    def _finish(self, job_id, state, t0, error=None, result=None, media=0.0):
+        seconds = time.time() - t0
+        self.store.update(job_id, state=state, finished=time.time(), error=error, result=result, progress=None,
+                          seconds=round(seconds, 3))
+        with self.lock:
+            self.counters[state] += 1
+            self.counters['render_seconds'] += seconds
+            self.counters['media_seconds'] += media
+        print("Job %s: %s (%.1fs)%s" % (job_id, state, seconds, ': ' + error if error else ''))
+
+    def stats(self):
+        jobs = self.store.all()
+        with self.lock:
+            c = dict(self.counters)
+            caches = [e.stage_cache.stats() for e in self.engines if e.stage_cache is not None]
+        uptime = time.time() - self.t0
+        states = {}
+        for j in jobs:
+            states[j['state']] = states.get(j['state'], 0) + 1
+        return {'uptime': round(uptime, 1), 'workers': self.concurrency, 'jobs': states,
+                'finished_this_run': {'done': c['done'], 'failed': c['failed'], 'cancelled': c['cancelled']},
+                'jobs_per_hour': round(c['done'] * 3600.0 / uptime, 2) if uptime else 0.0,
+                'render_seconds': round(c['render_seconds'], 1), 'media_seconds': round(c['media_seconds'], 1),
+                # seconds of output rendered per second of rendering
+                'realtime_factor': round(c['media_seconds'] / c['render_seconds'], 3) if c['render_seconds'] else None,
+                'stage_cache': {'hits': sum(s['hits'] for s in caches), 'misses': sum(s['misses'] for s in caches)}}
+
+    def watch(self, folder, out_dir, interval=2.0):
+        """Queue every video file that shows up in folder, once its size has
+        stopped changing between two polls. Runs until stop()."""
+        sizes = {}
+        while not self.stopping:
+            try:
+                names = sorted(os.listdir(folder))
+            except OSError:
+                names = []
+            for fn in names:
+                path = os.path.join(folder, fn)
+                if os.path.splitext(fn)[1].lower() not in VIDEO_EXTS or not os.path.isfile(path):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # removed or renamed since listdir
+                    continue
+                key = '%s|%d|%d' % (os.path.abspath(path), st.st_size, int(st.st_mtime))
+                if key in self.store.seen:
+                    continue
+                if sizes.get(path) != st.st_size:
+                    # still being copied in, or new: look again next poll
+                    sizes[path] = st.st_size
+                    continue
+                out = os.path.join(out_dir, os.path.splitext(fn)[0] + '_ytp.mp4')
+                try:
+                    job = self.submit({'kind': 'generate', 'input': path, 'output': out, 'source': 'watch'})
+                except QueueFull:
+                    break
+                self.store.mark_seen(key, job['id'])
+                print("Watch: queued %s as job %s" % (path, job['id']))
+            time.sleep(interval)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'ytp-server/1'
+
+    def log_message(self, fmt, *args):
+        print("HTTP %s - %s" % (self.client_address[0], fmt % args))
+
+    def _reply(self, status, body):
+        data = json.dumps(body, indent=1, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job_id(self):
+        parts = self.path.strip('/').split('/')
+        return parts[1] if len(parts) == 2 and parts[0] == 'jobs' else None
+
+    def do_GET(self):
+        render = self.server.render
+        if self.path.rstrip('/') == '/jobs':
+            return self._reply(200, {'jobs': render.store.all()})
+        if self.path.rstrip('/') == '/stats':
+            return self._reply(200, render.stats())
+        job = render.store.get(self._job_id()) if self._job_id() else None
+        if job:
+            return self._reply(200, job)
+        self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self._reply(404, {'error': 'not found'})
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            spec = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            job = self.server.render.submit(spec)
+        except QueueFull as e:
+            return self._reply(503, {'error': str(e)})
+        except (ValueError, IOError, OSError) as e:
+            return self._reply(400, {'error': str(e)})
+        self._reply(201, job)
+
+    def do_DELETE(self):
+        job_id = self._job_id()
+        if job_id and self.server.render.cancel(job_id):
+            return self._reply(200, self.server.render.store.get(job_id))
+        self._reply(404, {'error': 'no such unfinished job'})
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description="Run a local YTP render service.")
+    p.add_argument('-c', '--config', help='Default options JSON for jobs')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('-j', '--jobs', type=int, default=1, help='Jobs rendered at once')
+    p.add_argument('-t', '--threads', type=int, help='Total ffmpeg thread budget (default: all cores)')
+    p.add_argument('--max-queued', type=int, default=100, help='Waiting jobs before POST answers 503')
+    p.add_argument('--work-dir', help='Temp/cache directory, also holds the queue (default: ./ytp_temp)')
+    p.add_argument('--intermediate', choices=sorted(engine.INTERMEDIATE_PROFILES), help='Intermediate profile')
+    p.add_argument('--watch', help='Folder to take input videos from')
+    p.add_argument('--watch-out', help='Where watched inputs are rendered (default: <watch>/rendered)')
+    return p
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        base = cli.load_config(args.config)
+    except (ValueError, IOError, OSError) as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 2
+    work_dir = args.work_dir or os.path.join(os.getcwd(), 'ytp_temp')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    store = JobStore(os.path.join(work_dir, 'server_queue.json'), args.max_queued)
+    render = RenderServer(store, {'work_dir': work_dir, 'intermediate': args.intermediate}, base,
+                          args.jobs, args.threads)
+    try:
+        render.start()
+    except EnvironmentError as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 2
+    if args.watch:
+        out_dir = args.watch_out or os.path.join(args.watch, 'rendered')
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        t = threading.Thread(target=render.watch, args=(args.watch, out_dir))
+        t.daemon = True
+        t.start()
+    httpd = _HTTPServer((args.host, args.port), _Handler)
+    httpd.render = render
+    print("Serving on http://%s:%d (%d workers)" % (args.host, args.port, render.concurrency))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        render.stop()
+        httpd.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+from __future__ import print_function, unicode_literals
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from utils import temp_filename_for, replace_file, rm_f
+
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024  # 1 GiB
+
+try:
+    string_types = basestring  # noqa: F821
+except NameError:
+    string_types = str
+
+_digests = {}
+
+
+def file_digest(path):
+    """sha1 of a file's content, memoized by (path, size, mtime)."""
+    st = os.stat(path)
+    memo = (os.path.abspath(path), st.st_size, int(st.st_mtime * 1000))
+    if memo in _digests:
+        return _digests[memo]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            h.update(block)
+    _digests[memo] = h.hexdigest()
+    return _digests[memo]
+
+
+def _identify(value):
+    # asset paths enter the key by identity, so replacing an asset on disk
+    # invalidates every stage that used it
+    if isinstance(value, dict):
+        return dict((k, _identify(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_identify(v) for v in value]
+    if isinstance(value, string_types) and value and os.path.isfile(value):
+        st = os.stat(value)
+        return '%s|%d|%d' % (os.path.abspath(value), st.st_size, int(st.st_mtime))
+    return value
+
+
+def _link(src, dst):
+    """Hard-link src to dst (a copy across filesystems), replacing dst."""
+    part = '%s.%d.%d.part' % (dst, os.getpid(), threading.current_thread().ident)
+    try:
+        try:
+            os.link(src, part)
+        except (AttributeError, OSError):
+            shutil.copyfile(src, part)
+        replace_file(part, dst)
+    except BaseException:
+        rm_f(part)
+        raise
+
+
+def stage_key(parent, steps, extra=None):
+    """Content address of a stage output: the parent's address (or input
+    digest), the resolved steps, and anything else that changes the bytes
+    (ffmpeg version, intermediate profile)."""
+    blob = json.dumps({'parent': parent, 'steps': _identify([list(s) for s in steps]),
+                       'extra': extra}, sort_keys=True)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+
+class StageCache(object):
+    """Directory of stage outputs named by their key, evicted least recently
+    used first once the total size passes max_bytes. Each entry has a JSON
+    sidecar for metadata about the stage. Callers only ever hold their own
+    hard link to an entry, so any process may evict at any time and several
+    processes can use one cache."""
+
+    def __init__(self, root, max_bytes=DEFAULT_CACHE_SIZE):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def _media(self, key):
+        for fn in os.listdir(self.root):
+            if fn.startswith(key + '.') and not fn.endswith(('.json', '.part')):
+                return os.path.join(self.root, fn)
+        return None
+
+    def get(self, key):
+        """Return (path, meta) for a cached stage or (None, None). path is a
+        new temp file linked to the entry."""
+        path = self._media(key)
+        meta_path = os.path.join(self.root, key + '.json')
+        if path and os.path.exists(meta_path):
+            out = None
+            try:
+                with open(meta_path, 'r') as f:
+                    meta = json.load(f)
+                out = temp_filename_for(os.path.splitext(path)[1])
+                _link(path, out)
+                os.utime(path, None)
+                self.hits += 1
+                return out, meta
+            except Exception:
+                # evicted by another process since the lookup
+                if out:
+                    rm_f(out)
+        self.misses += 1
+        return None, None
+
+    def put(self, key, path, meta=None):
+        """Add a finished stage output to the cache. path stays the caller's."""
+        dst = os.path.join(self.root, key + os.path.splitext(path)[1])
+        with open(os.path.join(self.root, key + '.json'), 'w') as f:
+            json.dump(meta or {}, f)
+        if not os.path.exists(dst):
+            _link(path, dst)
+        os.utime(dst, None)
+        self.evict()
+        return path
+
+    def entries(self):
+        """(mtime, size, key, path) for every cached media file."""
+        out = []
+        for fn in os.listdir(self.root):
+            if fn.endswith(('.json', '.part')):
+                continue
+            p = os.path.join(self.root, fn)
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            out.append((st.st_mtime, st.st_size, fn.split('.', 1)[0], p))
+        return out
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, key, p in entries:
+            if total <= self.max_bytes:
+                break
+            for victim in (p, os.path.join(self.root, key + '.json')):
+                try:
+                    os.remove(victim)
+                except OSError:
+                    pass
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        entries = self.entries()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(entries), 'bytes': sum(e[1] for e in entries),
+                'max_bytes': self.max_bytes}
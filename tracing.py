@@ -0,0 +1,258 @@
+"""
+Per-stage timing for generate runs.
+
+A Tracer installed on the rendering thread with set_tracer() receives one
+event per engine stage and one per ffmpeg run. Each ffmpeg event has the
+stage it ran for, wall and CPU time, bytes in and out, whether it was a
+fallback attempt, and the last fps/speed/out_time/bitrate that ffmpeg
+reported through -progress. Events go to an optional callback and can be
+saved as a Chrome trace (chrome://tracing, Perfetto).
+
+CPU time is measured per child with os.wait4, so commands running at once
+do not get each other's time; a stage's CPU is the sum of its commands'.
+A command's CPU is None where that is unavailable: on Windows, for
+commands run through asyncio (aioexec.py), and for a child reaped by a
+cancel. A stage then sums the rest and is marked cpu_partial.
+"""
+from __future__ import print_function, unicode_literals
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Added to every ffmpeg command run through utils.run_command; the progress
+# blocks arrive as key=value lines on stdout.
+PROGRESS_ARGS = ['-progress', 'pipe:1', '-nostats']
+PROGRESS_KEYS = ('frame', 'fps', 'bitrate', 'total_size', 'out_time', 'out_time_ms', 'speed')
+# off for ffmpeg builds older than -progress (see capabilities.py)
+PROGRESS_ENABLED = True
+
+_local = threading.local()
+
+
+def wait(proc):
+    """proc.wait(), returning the CPU seconds (user + sys) of that child
+    alone, or None where they cannot be had."""
+    if not hasattr(os, 'wait4') or proc.returncode is not None:
+        proc.wait()
+        return None
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except OSError:
+        # already reaped (a cancel's poll()); Popen knows the exit code
+        proc.wait()
+        return None
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return usage.ru_utime + usage.ru_stime
+
+
+def sum_cpu(values):
+    """Total of the known CPU times, None if none is known."""
+    known = [v for v in values if v is not None]
+    return sum(known) if known else None
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+class Tracer(object):
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.events = []
+        self.t0 = time.time()
+        self.stages = []
+        self.fallback = False
+        self.lock = threading.Lock()
+
+    def emit(self, event):
+        with self.lock:
+            self.events.append(event)
+        if self.callback:
+            self.callback(event)
+
+    def stage_name(self):
+        return self.stages[-1] if self.stages else None
+
+    def chrome_trace(self):
+        """The events in Chrome's trace event format: one complete ('X')
+        event per stage and command, one counter ('C') per progress block
+        and scratch measurement."""
+        pid = os.getpid()
+        out = []
+        for ev in self.events:
+            ts = int((ev['start'] - self.t0) * 1e6)
+            if ev['type'] == 'progress':
+                out.append({'name': 'ffmpeg progress', 'ph': 'C', 'ts': ts, 'pid': pid, 'tid': ev['thread'],
+                            'args': dict((k, ev[k]) for k in ('fps', 'speed') if ev.get(k) is not None)})
+                continue
+            if ev['type'] == 'scratch':
+                out.append({'name': 'scratch bytes', 'ph': 'C', 'ts': ts, 'pid': pid, 'tid': ev['thread'],
+                            'args': {'bytes': ev['bytes']}})
+                continue
+            args = dict((k, v) for k, v in ev.items() if k not in ('type', 'name', 'start', 'wall', 'thread'))
+            out.append({'name': ev['name'], 'cat': ev['type'], 'ph': 'X', 'ts': ts,
+                        'dur': int(ev['wall'] * 1e6), 'pid': pid, 'tid': ev['thread'], 'args': args})
+        return {'traceEvents': out, 'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f, indent=1)
+        return path
+
+
+def set_tracer(tracer):
+    """Install tracer for the current thread; returns the previous one."""
+    prev = getattr(_local, 'tracer', None)
+    _local.tracer = tracer
+    return prev
+
+
+def current():
+    return getattr(_local, 'tracer', None)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time the enclosed block as a stage; ffmpeg runs inside it are
+    attributed to name. A None name records nothing."""
+    tracer = current()
+    if tracer is None or name is None:
+        yield
+        return
+    tracer.stages.append(name)
+    start, first = time.time(), len(tracer.events)
+    try:
+        yield
+    finally:
+        tracer.stages.pop()
+        with tracer.lock:
+            cpus = [ev['cpu'] for ev in tracer.events[first:] if ev['type'] == 'command']
+        tracer.emit({'type': 'stage', 'name': name, 'start': start, 'wall': time.time() - start,
+                     'cpu': sum_cpu(cpus), 'cpu_partial': None in cpus,
+                     'thread': threading.current_thread().ident})
+
+
+@contextlib.contextmanager
+def fallback(active=True):
+    """Mark ffmpeg runs inside the block as fallback attempts."""
+    tracer = current()
+    if tracer is None or not active:
+        yield
+        return
+    prev, tracer.fallback = tracer.fallback, True
+    try:
+        yield
+    finally:
+        tracer.fallback = prev
+
+
+def set_progress_enabled(flag):
+    global PROGRESS_ENABLED
+    PROGRESS_ENABLED = bool(flag)
+
+
+def with_progress(cmd):
+    """cmd with PROGRESS_ARGS after the executable, if it is an ffmpeg list
+    command."""
+    if not PROGRESS_ENABLED or not isinstance(cmd, (list, tuple)) or len(cmd) < 2:
+        return cmd
+    if not os.path.basename(cmd[0]).lower().startswith('ffmpeg'):
+        return cmd
+    return [cmd[0]] + PROGRESS_ARGS + list(cmd[1:])
+
+
+def has_progress(cmd):
+    return isinstance(cmd, (list, tuple)) and PROGRESS_ARGS[1] in cmd
+
+
+def _number(text):
+    text = text.strip().rstrip('x')
+    if text.endswith('kbits/s'):
+        text = text[:-7]
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+class ProgressReader(object):
+    """Parses ffmpeg -progress output fed one line at a time; each finished
+    block is emitted as a progress event when a tracer is installed."""
+
+    def __init__(self):
+        self.tracer = current()
+        self.last = {}
+        self.block = {}
+
+    def feed(self, raw):
+        line = raw.decode('utf-8', errors='ignore').strip()
+        if '=' not in line:
+            return
+        key, value = line.split('=', 1)
+        if key in PROGRESS_KEYS:
+            self.block[key] = value
+        elif key == 'progress':
+            block = self.block
+            self.last.update(block)
+            if self.tracer is not None:
+                self.tracer.emit({'type': 'progress', 'name': self.tracer.stage_name(), 'start': time.time(),
+                                  'fps': _number(block.get('fps', '')), 'speed': _number(block.get('speed', '')),
+                                  'thread': threading.current_thread().ident})
+            self.block = {}
+
+    def stats(self):
+        """The last values of PROGRESS_KEYS."""
+        last = self.last
+        stats = {}
+        if 'fps' in last:
+            stats['fps'] = _number(last['fps'])
+        if 'speed' in last:
+            stats['speed'] = _number(last['speed'])
+        if 'bitrate' in last:
+            stats['bitrate_kbps'] = _number(last['bitrate'])
+        if 'out_time_ms' in last:
+            # despite the name, microseconds
+            stats['out_time'] = (_number(last['out_time_ms']) or 0) / 1e6
+        return stats
+
+
+def read_progress(stream):
+    """Consume ffmpeg -progress output until EOF and return its stats (see
+    ProgressReader)."""
+    reader = ProgressReader()
+    for raw in iter(stream.readline, b''):
+        reader.feed(raw)
+    return reader.stats()
+
+
+class CommandTimer(object):
+    """Measures one ffmpeg run (or one pipeline of them) for the current
+    tracer; a no-op without one."""
+
+    def __init__(self, cmds):
+        self.tracer = current()
+        if self.tracer is None:
+            return
+        self.cmds = cmds
+        self.start = time.time()
+        self.bytes_in = sum(_size(c[i + 1]) for c in cmds if isinstance(c, (list, tuple))
+                            for i, a in enumerate(c[:-1]) if a == '-i')
+
+    def finish(self, ok, stats=None, cpu=None):
+        """cpu: the CPU seconds of the processes (see wait()), or None."""
+        if self.tracer is None:
+            return
+        last = self.cmds[-1]
+        ev = {'type': 'command', 'name': self.tracer.stage_name() or 'ffmpeg', 'start': self.start,
+              'wall': time.time() - self.start, 'cpu': cpu,
+              'bytes_in': self.bytes_in, 'bytes_out': _size(last[-1]) if isinstance(last, (list, tuple)) else 0,
+              'fallback': self.tracer.fallback, 'ok': bool(ok), 'processes': len(self.cmds),
+              'cmd': ' '.join(last) if isinstance(last, (list, tuple)) else last,
+              'thread': threading.current_thread().ident}
+        ev.update(stats or {})
+        self.tracer.emit(ev)
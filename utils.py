@@ -3,6 +3,8 @@ import os
 import tempfile
 import shutil
 import subprocess
+import threading
+import tracing
 
 def which(exe_name):
     paths = os.environ.get('PATH', '').split(os.pathsep)
@@ -28,13 +30,119 @@ def find_ffmpeg():
         ffplay = os.path.join(cur, 'ffplay.exe')
     return ffmpeg, ffplay
 
+def find_ffprobe(ffmpeg=None):
+    ffprobe = which('ffprobe') or which('ffprobe.exe')
+    if not ffprobe and ffmpeg:
+        d = os.path.dirname(ffmpeg)
+        for name in ('ffprobe', 'ffprobe.exe'):
+            if os.path.exists(os.path.join(d, name)):
+                ffprobe = os.path.join(d, name)
+                break
+    cur = os.getcwd()
+    if not ffprobe and os.path.exists(os.path.join(cur, 'ffprobe.exe')):
+        ffprobe = os.path.join(cur, 'ffprobe.exe')
+    return ffprobe
+
+# Cancellation: a job running on some thread installs a CancelToken with
+# set_cancel_token(); every ffmpeg child and temp file made on that thread is
+# recorded on it, so another thread can kill the children and delete the files.
+class JobCancelled(Exception):
+    pass
+
+class ScratchQuotaExceeded(JobCancelled):
+    """The job's scratch files outgrew its quota (see scratch.py); the job
+    is stopped and cleaned up like a cancelled one."""
+
+class CancelToken(object):
+    def __init__(self):
+        self.cancelled = False
+        self.procs = set()
+        self.temps = []
+        self.lock = threading.Lock()
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled("cancelled")
+
+    def track(self, proc):
+        with self.lock:
+            self.procs.add(proc)
+            cancelled = self.cancelled
+        if cancelled:
+            kill_process(proc)
+
+    def untrack(self, proc):
+        with self.lock:
+            self.procs.discard(proc)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            procs = list(self.procs)
+        for p in procs:
+            kill_process(p)
+
+    def cleanup(self):
+        """Delete the temp files made under this token (files since moved
+        elsewhere, e.g. into the stage cache, are already gone)."""
+        for path in self.temps:
+            rm_f(path)
+        self.temps = []
+
+_job = threading.local()
+
+def set_cancel_token(token):
+    _job.token = token
+
+def cancel_token():
+    return getattr(_job, 'token', None)
+
+# The job's scratch.ScratchArena, if any: temp files are made inside it.
+def set_scratch(arena):
+    """Install arena for the current thread; returns the previous one."""
+    prev = getattr(_job, 'scratch', None)
+    _job.scratch = arena
+    return prev
+
+def scratch():
+    return getattr(_job, 'scratch', None)
+
+def check_cancelled():
+    token = cancel_token()
+    if token is not None:
+        token.check()
+
+def kill_process(proc):
+    try:
+        if proc.poll() is None:
+            proc.kill()
+    except Exception:
+        pass
+
+def _register_temp(path):
+    token = cancel_token()
+    if token is not None:
+        token.temps.append(path)
+    arena = scratch()
+    if arena is not None:
+        arena.add(path)
+    return path
+
 def safe_tempfile(suffix='', prefix='ytp_', dir=None):
+    arena = scratch()
+    if dir is None and arena is not None:
+        dir = arena.pick_dir()
     fd, path = tempfile.mkstemp(suffix=suffix, prefix=prefix, dir=dir)
     try:
         os.close(fd)
     except Exception:
         pass
-    return path
+    return _register_temp(path)
+
+def temp_dirname(prefix='ytp_'):
+    """A new temp directory, deleted with the job's temp files on cancel."""
+    arena = scratch()
+    return _register_temp(tempfile.mkdtemp(prefix=prefix, dir=arena.pick_dir() if arena is not None else None))
 
 def temp_filename_for(ext):
     if not ext.startswith('.'):
@@ -50,19 +158,131 @@ def rm_f(path):
     except Exception:
         pass
 
+def replace_file(src, dst):
+    """Rename src to dst, replacing dst (atomically, except on Windows)."""
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+# Per-process ffmpeg thread budget, set by schedulers that run several
+# renders at once so they do not oversubscribe the CPU. None = ffmpeg default.
+FFMPEG_THREADS = None
+
+def set_ffmpeg_threads(n):
+    global FFMPEG_THREADS
+    FFMPEG_THREADS = int(n) if n else None
+
+# Whether the ffmpeg build takes -filter_threads (older ones reject the whole
+# command); set from the capability probe by the engine.
+FILTER_THREADS_OPTION = False
+
+def set_filter_threads_option(flag):
+    global FILTER_THREADS_OPTION
+    FILTER_THREADS_OPTION = bool(flag)
+
+def with_thread_budget(cmd):
+    """Insert -threads into an ffmpeg command list when a budget is set,
+    plus -filter_threads when the build is known to take it. -threads goes
+    just before the output so it applies to the encoder. Commands that set
+    -threads or -filter_threads themselves are left alone."""
+    if not FFMPEG_THREADS or not isinstance(cmd, (list, tuple)) or len(cmd) < 2:
+        return cmd
+    if '-threads' in cmd or '-filter_threads' in cmd:
+        return cmd
+    if not os.path.basename(cmd[0]).lower().startswith('ffmpeg'):
+        return cmd
+    n = str(FFMPEG_THREADS)
+    head = [cmd[0], '-filter_threads', n] if FILTER_THREADS_OPTION else [cmd[0]]
+    return head + list(cmd[1:-1]) + ['-threads', n, cmd[-1]]
+
 def run_command(cmd, shell=False):
+    """Run cmd and wait; True on exit status 0. ffmpeg list commands also
+    get tracing.PROGRESS_ARGS, and their progress is parsed for the
+    current tracer."""
+    token = cancel_token()
     try:
+        cmd = tracing.with_progress(with_thread_budget(cmd))
         if isinstance(cmd, (list, tuple)):
             print("Running:", " ".join(cmd))
         else:
             print("Running:", cmd)
-        p = subprocess.Popen(cmd, shell=shell)
-        p.communicate()
+        check_cancelled()
+        progress = tracing.has_progress(cmd)
+        timer = tracing.CommandTimer([cmd])
+        p = subprocess.Popen(cmd, shell=shell, stdout=subprocess.PIPE if progress else None)
+        if token is not None:
+            token.track(p)
+        try:
+            stats = tracing.read_progress(p.stdout) if progress else {}
+            cpu = tracing.wait(p)
+        finally:
+            if token is not None:
+                token.untrack(p)
+        timer.finish(p.returncode == 0, stats, cpu)
+        check_cancelled()
+        if scratch() is not None:
+            scratch().measure()
         return p.returncode == 0
+    except JobCancelled:
+        raise
     except Exception as e:
         print("Command failed:", e)
         return False
 
+def run_parallel(cmds):
+    """run_command every cmd at once, each on its own thread; True only if
+    all of them succeeded. The threads share the caller's cancel token,
+    tracer and scratch arena, and a cancellation on any of them is raised
+    here."""
+    token, tracer, arena = cancel_token(), tracing.current(), scratch()
+    results = [None] * len(cmds)
+
+    def work(i):
+        set_cancel_token(token)
+        tracing.set_tracer(tracer)
+        set_scratch(arena)
+        try:
+            results[i] = run_command(cmds[i])
+        except JobCancelled as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(len(cmds))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    for r in results:
+        if isinstance(r, JobCancelled):
+            raise r
+    return all(r is True for r in results)
+
+def _aioexec():
+    # imported late (it imports this module); a SyntaxError is Python 2
+    try:
+        import aioexec
+    except (ImportError, SyntaxError):
+        return None
+    return aioexec if aioexec.SUPPORTED else None
+
+def run_many(cmds, limit=None, capture=False):
+    """Run independent commands at most limit at a time through asyncio
+    (see aioexec.py), one at a time where that is unavailable. Returns
+    [(ok, stdout, stderr)] in cmd order; stdout is only kept with capture."""
+    cmds = list(cmds)
+    aio = _aioexec()
+    if aio is not None and len(cmds) > 1:
+        return aio.run_sync(aio.run_all(cmds, limit, capture))
+    results = []
+    for cmd in cmds:
+        if capture:
+            p = subprocess.Popen(with_thread_budget(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+            results.append((p.returncode == 0, out, err))
+        else:
+            results.append((run_command(cmd), b'', b''))
+    return results
+
 # Beta key helpers (legacy)
 def read_beta_key_from_file(path='beta_key.txt'):
     try:
@@ -89,17 +309,3 @@ def find_assets_dir(default='assets'):
     if os.path.isdir(default):
         return default
     return None
-
-def list_asset_files(assets_dir):
-    files = {}
-    if not assets_dir:
-        return files
-    try:
-        for root, _, filenames in os.walk(assets_dir):
-            for fn in filenames:
-                path = os.path.join(root, fn)
-                ext = os.path.splitext(fn)[1].lower()
-                files.setdefault(ext, []).append(path)
-    except Exception:
-        pass
-    return files
\ No newline at end of file